@@ -0,0 +1,78 @@
+"""
+JWT authentication that resolves the user from a short-lived cache.
+
+The stock JWTAuthentication loads the whole User row on every authenticated
+request. CachedJWTAuthentication keeps a small snapshot of the user in the
+Django cache for USER_SNAPSHOT_CACHE_TTL seconds (dropped whenever the User
+is saved or deleted, see account/signals.py) and builds the request user
+from it, so authenticated requests do not query auth_user at all.
+
+The same check rejects revoked tokens, see account/revocation.py.
+
+request.user is a real User instance with only the snapshot fields loaded;
+any other field is fetched from the database on first access.
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .revocation import is_revoked
+
+SNAPSHOT_FIELDS = ("id", "username", "email", "is_staff", "is_active")
+# not a User field, carried along so revocation checks need no query
+CUTOFF_FIELD = "token_cutoff__not_before"
+
+
+def user_cache_key(user_id):
+    return f"account:user-snapshot:{user_id}"
+
+
+def invalidate_user_snapshot(user_id):
+    cache.delete(user_cache_key(user_id))
+
+
+def load_user_snapshot(user_id):
+    """Return the snapshot dict of a user, or None if there is no such user."""
+    key = user_cache_key(user_id)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = User.objects.filter(id=user_id).values(*SNAPSHOT_FIELDS, CUTOFF_FIELD).first()
+        if snapshot is None:
+            return None
+        cache.set(key, snapshot, settings.USER_SNAPSHOT_CACHE_TTL)
+    return snapshot
+
+
+def user_from_snapshot(snapshot):
+    """Build a User with only the snapshot fields loaded (the rest deferred)."""
+    field_names = [
+        field.attname for field in User._meta.concrete_fields
+        if field.attname in snapshot
+    ]
+    return User.from_db(None, field_names, [snapshot[name] for name in field_names])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        snapshot = load_user_snapshot(user_id)
+        if snapshot is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        if not snapshot["is_active"]:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        if is_revoked(validated_token, snapshot[CUTOFF_FIELD]):
+            raise AuthenticationFailed(_('Token has been revoked'), code='token_revoked')
+
+        return user_from_snapshot(snapshot)
@@ -0,0 +1,83 @@
+"""
+Username and email availability checks.
+
+Taken usernames and emails are kept in a per-process Bloom filter so the
+common case (the value is free) is answered without touching the database.
+Possible hits are confirmed with a query. The filter is rebuilt every
+REGISTRATION_BLOOM_FILTER_TTL seconds to pick up users created by other
+processes; registration itself is always enforced by the unique indexes.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from .bloom import BloomFilter
+
+# never size the filter below this, so a young site does not rebuild it
+# on every signup burst
+MIN_CAPACITY = 10000
+
+_filter = None
+_built_at = 0
+_lock = threading.Lock()
+
+
+def _key(field, value):
+    # emails are unique case-insensitively, usernames are not
+    if field == "email":
+        value = value.lower()
+    return f"{field}:{value}"
+
+
+def _build():
+    users = User.objects.values_list("username", "email")
+    bloom = BloomFilter(max(users.count() * 2, MIN_CAPACITY), settings.REGISTRATION_BLOOM_FILTER_ERROR_RATE)
+    for username, email in users.iterator(chunk_size=2000):
+        bloom.add(_key("username", username))
+        if email:
+            bloom.add(_key("email", email))
+    return bloom
+
+
+def get_filter():
+    """Return the taken usernames/emails filter, or None when disabled."""
+    global _filter, _built_at
+
+    if not settings.REGISTRATION_BLOOM_FILTER:
+        return None
+
+    if _filter is None or time.monotonic() - _built_at > settings.REGISTRATION_BLOOM_FILTER_TTL:
+        with _lock:
+            if _filter is None or time.monotonic() - _built_at > settings.REGISTRATION_BLOOM_FILTER_TTL:
+                _filter = _build()
+                _built_at = time.monotonic()
+    return _filter
+
+
+def reset_filter():
+    """Drop the filter, it is rebuilt on next use."""
+    global _filter
+    _filter = None
+
+
+def remember_user(user):
+    """Add a new or updated user to the filter, if it is built."""
+    bloom = _filter
+    if bloom is not None:
+        bloom.add(_key("username", user.username))
+        if user.email:
+            bloom.add(_key("email", user.email))
+
+
+def is_taken(field, value):
+    """Whether `value` is already used as a username or email."""
+    bloom = get_filter()
+    if bloom is not None and _key(field, value) not in bloom:
+        return False
+
+    if field == "email":
+        return User.objects.filter(email__iexact=value).exists()
+    return User.objects.filter(username=value).exists()
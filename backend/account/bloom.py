@@ -0,0 +1,45 @@
+"""
+A small in-memory Bloom filter.
+
+Used to answer "is this value definitely not taken?" without a database
+query. A negative answer is always correct; a positive answer may be a false
+positive and has to be confirmed against the database.
+"""
+
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Bloom filter sized for `capacity` items at a false positive rate of
+    `error_rate`.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.num_bits = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        # double hashing: two 64 bit halves of one digest give k positions
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,123 @@
+"""
+Background account deletion.
+
+Deleting a user with `user.delete()` makes Django's collector load every
+order, address, card, cart and cart item of the account into memory and
+delete them in one long transaction. Instead, `request_account_deletion`
+only disables the account, revokes its tokens and records an
+AccountDeletion row; `delete_account` then runs in the background and
+removes the account's rows table by table in bounded batches with plain
+DELETE ... WHERE id IN (...) statements, each batch in its own short
+transaction. What is left (the user row and small tables hanging off it)
+goes through the regular `user.delete()` at the end.
+
+Deleting is idempotent, so a deletion interrupted half way is simply run
+again by `manage.py process_account_deletions`.
+"""
+
+import logging
+
+import stripe
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from cart.models import Cart, CartItem
+from my_project.background import run_in_background
+from payments.gateway import get_gateway
+from payments.models import Charge, StripeCustomer
+
+from .models import AccountDeletion, BillingAddress, OrderModel, StripeModel
+from .revocation import revoke_user_tokens
+from .rollups import RollupDeltas, row_contribution
+
+logger = logging.getLogger(__name__)
+
+# placeholder StripeModel.customer_id for cards without a Stripe customer
+NO_CUSTOMER_ID = "0000-0000-0000-0000"
+
+
+def request_account_deletion(user):
+    """Disable `user` right away and delete their data in the background."""
+    with transaction.atomic():
+        user.is_active = False
+        user.save(update_fields=["is_active"])
+        AccountDeletion.objects.get_or_create(user=user)
+        revoke_user_tokens(user)
+        run_in_background(delete_account, user.id)
+
+
+def forget_order_rollups(orders):
+    """Take a batch of orders about to be raw deleted out of the sales rollups."""
+    deltas = RollupDeltas()
+    for row in orders.values_list("created_at", "status", "total_price", "paid_status", "is_delivered"):
+        deltas.add(row_contribution(*row), -1)
+    deltas.apply()
+
+
+def delete_in_batches(queryset, batch_size, before_delete=None):
+    """
+    Delete the rows of `queryset` `batch_size` at a time, without loading
+    them or sending delete signals. `before_delete(batch)` runs in the same
+    transaction as each batch.
+
+    Returns the number of rows deleted.
+    """
+    model = queryset.model
+    deleted = 0
+    while True:
+        with transaction.atomic(using=queryset.db):
+            ids = list(queryset.order_by().values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            batch = model._base_manager.using(queryset.db).filter(pk__in=ids)
+            if before_delete is not None:
+                before_delete(batch)
+            deleted += batch._raw_delete(batch.db)
+
+
+def delete_stripe_customers(user_id):
+    """Delete the user's Stripe customer and the ones behind their saved cards."""
+    customer_ids = set(
+        StripeModel.objects.filter(user_id=user_id)
+        .exclude(customer_id=NO_CUSTOMER_ID)
+        .values_list("customer_id", flat=True)
+    )
+    customer_ids.update(StripeCustomer.objects.filter(user_id=user_id).values_list("customer_id", flat=True))
+    for customer_id in customer_ids:
+        try:
+            get_gateway().delete_customer(customer_id)
+            logger.info(f"Customer deleted from Stripe: {customer_id}")
+        except stripe.error.StripeError as e:
+            logger.warning(f"Could not delete customer from Stripe: {str(e)}")
+
+
+def delete_account(user_id, batch_size=None):
+    """
+    Delete a user whose deletion was requested, along with all their data.
+
+    Returns False if there is no pending deletion for `user_id`.
+    """
+    batch_size = batch_size or settings.ACCOUNT_DELETION_BATCH_SIZE
+    if not AccountDeletion.objects.filter(user_id=user_id).update(
+        attempts=F("attempts") + 1, last_attempt_at=timezone.now()
+    ):
+        return False
+
+    delete_stripe_customers(user_id)
+
+    # children before parents, the raw deletes do not cascade
+    delete_in_batches(CartItem.objects.filter(cart__user_id=user_id), batch_size)
+    delete_in_batches(Cart.objects.filter(user_id=user_id), batch_size)
+    delete_in_batches(Charge.objects.filter(user_id=user_id), batch_size)
+    delete_in_batches(OrderModel.objects.filter(user_id=user_id), batch_size, forget_order_rollups)
+    delete_in_batches(BillingAddress.objects.filter(user_id=user_id), batch_size)
+    delete_in_batches(StripeModel.objects.filter(user_id=user_id), batch_size)
+
+    user = User.objects.filter(id=user_id).first()
+    if user is not None:
+        user.delete()
+    logger.info(f"Deleted account {user_id}")
+    return True
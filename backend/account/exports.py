@@ -0,0 +1,70 @@
+"""
+Streaming order exports (CSV and NDJSON).
+
+Rows are read with values_list().iterator(), so neither model instances nor
+the full result set are ever held in memory, and are encoded one at a time
+as the response (or file) is written. Used by OrdersExportView and the
+`export_orders` management command.
+"""
+
+import csv
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+EXPORT_FIELDS = (
+    "id", "user_id", "name", "ordered_item", "total_price", "status",
+    "paid_status", "paid_at", "is_delivered", "delivered_at", "address",
+    "created_at",
+)
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+class Echo:
+    """File-like object whose write() returns the value, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def iter_order_rows(orders, chunk_size=None):
+    # primary key order needs no sort, so the first rows come back at once
+    return orders.order_by("id").values_list(*EXPORT_FIELDS).iterator(
+        chunk_size=chunk_size or settings.ORDER_EXPORT_CHUNK_SIZE
+    )
+
+
+# spreadsheets run cells starting with these as formulas
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def csv_cell(value):
+    """`value`, with text that a spreadsheet would run as a formula quoted."""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow([csv_cell(value) for value in row])
+
+
+def ndjson_lines(rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(dict(zip(EXPORT_FIELDS, row))) + "\n"
+
+
+def export_lines(orders, export_format, chunk_size=None):
+    """Encoded lines of `orders` in `export_format` ("csv" or "ndjson")."""
+    rows = iter_order_rows(orders, chunk_size)
+    if export_format == "csv":
+        return csv_lines(rows)
+    return ndjson_lines(rows)
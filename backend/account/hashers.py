@@ -0,0 +1,55 @@
+"""
+Password hashing off the request thread.
+
+PBKDF2 is deliberately slow. Hashing runs on a small process-wide thread
+pool (PASSWORD_HASHING_WORKERS threads), which bounds how many hashes run
+at once: a burst of logins or signups queues up there instead of putting
+every web thread on the CPU at once. The request thread still waits for
+its hash, the pool does not free it. The iteration count comes from
+PASSWORD_HASHER_ITERATIONS, see `manage.py calibrate_password_hasher`.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the hashing pool, creating a new one after a fork."""
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        with _lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.PASSWORD_HASHING_WORKERS,
+                    thread_name_prefix="password-hasher",
+                )
+                _executor_pid = os.getpid()
+    return _executor
+
+
+class PooledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 hasher that computes hashes on the hashing pool.
+
+    Uses the same algorithm name as Django's PBKDF2PasswordHasher, so existing
+    hashes keep working and are upgraded on login when the iteration count
+    changes.
+    """
+
+    @property
+    def iterations(self):
+        return getattr(settings, "PASSWORD_HASHER_ITERATIONS", PBKDF2PasswordHasher.iterations)
+
+    def encode(self, password, salt, iterations=None):
+        # verify() and harden_runtime() both go through encode()
+        parent_encode = super().encode
+        return get_executor().submit(parent_encode, password, salt, iterations).result()
@@ -0,0 +1,80 @@
+"""
+Pick the PBKDF2 iteration count for a target login latency.
+
+Times the password hasher on this machine and prints the iteration count
+that makes one hash take about --target-ms milliseconds:
+
+    python manage.py calibrate_password_hasher --target-ms 200
+
+Put the result in the PASSWORD_HASHER_ITERATIONS environment variable.
+Existing password hashes are rehashed with the new count on each user's
+next login, whichever way it changed, so a count below the current one
+weakens every hash; the command never suggests less than Django's own
+default and warns when the suggestion is below the current setting.
+"""
+
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.core.management.base import BaseCommand, CommandError
+
+# never recommend less than the Django release's default for PBKDF2-SHA256
+# (OWASP currently recommends 600000)
+MIN_ITERATIONS = PBKDF2PasswordHasher.iterations
+
+
+class Command(BaseCommand):
+    help = "Measure password hashing speed and suggest PASSWORD_HASHER_ITERATIONS."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target-ms",
+            type=float,
+            default=200,
+            help="Target time for a single password hash, in milliseconds.",
+        )
+        parser.add_argument(
+            "--sample-iterations",
+            type=int,
+            default=100000,
+            help="Iterations used for each timing sample.",
+        )
+        parser.add_argument(
+            "--rounds",
+            type=int,
+            default=5,
+            help="Number of timing samples, the fastest one is used.",
+        )
+
+    def handle(self, *args, **options):
+        if options["target_ms"] <= 0 or options["sample_iterations"] < 1 or options["rounds"] < 1:
+            raise CommandError("--target-ms, --sample-iterations and --rounds must be positive")
+
+        # time Django's hasher directly, the pooled one only adds a thread hop
+        hasher = PBKDF2PasswordHasher()
+        salt = hasher.salt()
+        sample = options["sample_iterations"]
+
+        best = None
+        for _ in range(options["rounds"]):
+            start = time.perf_counter()
+            hasher.encode("calibration-password", salt, sample)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        per_iteration = best / sample
+        iterations = int(options["target_ms"] / 1000 / per_iteration)
+        # round to a readable number
+        iterations = max(round(iterations, -4), MIN_ITERATIONS)
+
+        self.stdout.write(f"{sample} iterations took {best * 1000:.1f} ms")
+        self.stdout.write(
+            f"{iterations} iterations take about {iterations * per_iteration * 1000:.0f} ms"
+        )
+        self.stdout.write(self.style.SUCCESS(f"PASSWORD_HASHER_ITERATIONS={iterations}"))
+        if iterations < settings.PASSWORD_HASHER_ITERATIONS:
+            self.stdout.write(self.style.WARNING(
+                f"This is below the current {settings.PASSWORD_HASHER_ITERATIONS} iterations: "
+                "existing hashes would be weakened at each user's next login."
+            ))
@@ -0,0 +1,42 @@
+"""
+Export orders as CSV or NDJSON, streamed in constant memory:
+
+    python manage.py export_orders --output ndjson --date-from 2025-01-01 > orders.ndjson
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from account.exports import EXPORT_FORMATS, export_lines
+from account.models import OrderModel
+from account.views import filter_orders
+
+
+class Command(BaseCommand):
+    help = "Stream orders to stdout (or a file) as CSV or NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", choices=sorted(EXPORT_FORMATS), default="csv")
+        parser.add_argument("--file", help="Write to this file instead of stdout.")
+        parser.add_argument("--date-from", help="First day to export (YYYY-MM-DD).")
+        parser.add_argument("--date-to", help="Last day to export (YYYY-MM-DD).")
+        parser.add_argument("--status", help="Only export orders with this status.")
+        parser.add_argument("--chunk-size", type=int, default=None, help="Rows fetched per query.")
+
+    def handle(self, *args, **options):
+        params = {
+            "date_from": options["date_from"],
+            "date_to": options["date_to"],
+            "status": options["status"],
+        }
+        try:
+            orders = filter_orders(OrderModel.objects.all(), {k: v for k, v in params.items() if v}, True)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        lines = export_lines(orders, options["output"], options["chunk_size"])
+        if options["file"]:
+            with open(options["file"], "w", newline="", encoding="utf-8") as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
@@ -0,0 +1,40 @@
+"""
+Finish account deletions that did not complete in the background.
+
+Deletions normally run right after the user asks for them; this picks up
+the ones lost to a restart or a crash. Run it periodically (e.g. from cron):
+
+    python manage.py process_account_deletions --min-age 15
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from account.deletion import delete_account
+from account.models import AccountDeletion
+
+
+class Command(BaseCommand):
+    help = "Delete the data of accounts whose deletion is still pending."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=10,
+            help="Only pick up deletions requested at least this many minutes ago, "
+                 "so deletions still running in the background are left alone.",
+        )
+        parser.add_argument("--batch-size", type=int, help="Rows deleted per transaction.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(minutes=options["min_age"])
+        pending = AccountDeletion.objects.filter(requested_at__lte=cutoff).values_list("user_id", flat=True)
+
+        deleted = 0
+        for user_id in list(pending):
+            if delete_account(user_id, options["batch_size"]):
+                deleted += 1
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} account(s)."))
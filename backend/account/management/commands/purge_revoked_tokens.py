@@ -0,0 +1,22 @@
+"""
+Delete revoked access tokens that have expired anyway.
+
+Keeps the revocation table (and the in-memory filter loaded from it) small:
+
+    python manage.py purge_revoked_tokens
+
+simplejwt's `flushexpiredtokens` does the same for refresh tokens.
+"""
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from account.models import RevokedAccessToken
+
+
+class Command(BaseCommand):
+    help = "Delete expired rows from the revoked access token table."
+
+    def handle(self, *args, **options):
+        deleted, _ = RevokedAccessToken.objects.filter(expires_at__lte=timezone.now()).delete()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired revoked token(s)."))
@@ -0,0 +1,32 @@
+"""
+Recompute the sales rollups from the orders table.
+
+Backfills the rollups after deploying them and repairs drift (e.g. after
+orders were changed with raw SQL):
+
+    python manage.py rebuild_sales_rollups --date-from 2025-09-01
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from account.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per day / status sales rollups from OrderModel."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--date-from", help="First day to rebuild (YYYY-MM-DD).")
+        parser.add_argument("--date-to", help="Last day to rebuild (YYYY-MM-DD).")
+
+    def handle(self, *args, **options):
+        dates = {}
+        for option in ("date_from", "date_to"):
+            if options[option]:
+                dates[option] = parse_date(options[option])
+                if dates[option] is None:
+                    raise CommandError(f"--{option.replace('_', '-')} must be a date (YYYY-MM-DD)")
+
+        written = rebuild_rollups(**dates)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} rollup row(s)."))
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:30
+
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+def check_duplicate_emails(apps, schema_editor):
+    """Fail with a readable error instead of the index's if emails clash."""
+    User = apps.get_model('auth', 'User')
+    duplicates = list(
+        User.objects.exclude(email='').annotate(email_ci=Lower('email'))
+        .values('email_ci').annotate(users=Count('id')).filter(users__gt=1)
+        .values_list('email_ci', flat=True)[:20]
+    )
+    if duplicates:
+        raise RuntimeError(
+            "Cannot add the case-insensitive unique index on auth_user.email, these emails are used by "
+            f"more than one user (ignoring case): {', '.join(duplicates)}. Change or clear the emails of "
+            "the extra accounts, then migrate again."
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('account', '0025_auto_20250906_2048'),
+    ]
+
+    operations = [
+        # auth_user.email is neither unique nor indexed; registration relies on
+        # this index instead of checking for duplicates first. Users without an
+        # email (e.g. createsuperuser) are left out.
+        migrations.RunPython(check_duplicate_emails, migrations.RunPython.noop),
+        migrations.RunSQL(
+            sql="CREATE UNIQUE INDEX account_user_email_ci_uniq ON auth_user (LOWER(email)) WHERE email <> ''",
+            reverse_sql="DROP INDEX account_user_email_ci_uniq",
+        ),
+    ]
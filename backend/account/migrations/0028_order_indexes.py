@@ -0,0 +1,25 @@
+# Generated by Django 3.2.4 on 2026-10-19 09:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0027_token_revocation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ordermodel',
+            index=models.Index(fields=['user', '-created_at'], name='order_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ordermodel',
+            index=models.Index(fields=['status', '-created_at'], name='order_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ordermodel',
+            index=models.Index(fields=['paid_status', 'is_delivered'], name='order_paid_delivered_idx'),
+        ),
+    ]
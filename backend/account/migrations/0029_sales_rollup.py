@@ -0,0 +1,34 @@
+# Generated by Django 3.2.4 on 2026-10-19 09:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0028_order_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('paid', 'Paid'), ('processing', 'Processing'), ('shipped', 'Shipped'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('order_count', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('paid_count', models.IntegerField(default=0)),
+                ('delivered_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Sales Rollup',
+                'verbose_name_plural': 'Sales Rollups',
+                'ordering': ['day', 'status'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='salesrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'status'), name='sales_rollup_day_status_uniq'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('account', '0029_sales_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('requested_at', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_attempt_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='account_deletion', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0030_account_deletion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ordermodel',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('paid', 'Paid'), ('processing', 'Processing'), ('shipped', 'Shipped'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled'), ('refunded', 'Refunded'), ('disputed', 'Disputed')], default='pending', help_text='Current status of the order', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='salesrollup',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('paid', 'Paid'), ('processing', 'Processing'), ('shipped', 'Shipped'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled'), ('refunded', 'Refunded'), ('disputed', 'Disputed')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0031_order_payment_statuses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripemodel',
+            name='reconciled_at',
+            field=models.DateTimeField(blank=True, help_text='Last time the card was checked against Stripe (see payments/reconciliation.py)', null=True),
+        ),
+    ]
@@ -5,15 +5,20 @@ This module contains models for:
 - StripeModel: Stores payment card information
 - BillingAddress: User billing addresses
 - OrderModel: Order tracking and management
+- SalesRollup: Per day and status order totals
+- RevokedAccessToken / TokenCutoff: JWT revocation
+- AccountDeletion: Accounts waiting for background deletion
 """
 
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.validators import RegexValidator
 from django.utils import timezone
 
+from my_project.mixins import DirtyFieldsMixin
 
-class StripeModel(models.Model):
+
+class StripeModel(DirtyFieldsMixin, models.Model):
     """
     Model to store Stripe payment card information.
     
@@ -85,6 +90,11 @@ class StripeModel(models.Model):
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    reconciled_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Last time the card was checked against Stripe (see payments/reconciliation.py)"
+    )
 
     class Meta:
         verbose_name = "Stripe Payment Card"
@@ -95,7 +105,7 @@ class StripeModel(models.Model):
         return f"{self.name_on_card} - {self.card_number[-4:]}"
 
 
-class BillingAddress(models.Model):
+class BillingAddress(DirtyFieldsMixin, models.Model):
     """
     Model to store user billing addresses.
     
@@ -163,7 +173,70 @@ class BillingAddress(models.Model):
         return f"{self.house_no}, {self.landmark}, {self.city}, {self.state} - {self.pin_code}"
 
 
-class OrderModel(models.Model):
+class OrderQuerySet(models.QuerySet):
+    """Bulk status changes for orders."""
+
+    def transition(self, new_status, transitions=None):
+        """
+        Move every order in this queryset to `new_status` with a single UPDATE.
+
+        Orders whose current status does not allow the move (according to
+        `transitions`, OrderModel.STATUS_TRANSITIONS by default) are left
+        alone. Sales rollups are adjusted in one batch.
+
+        Returns:
+            dict: order id -> None if moved, else the status that blocked it
+        """
+        from .rollups import RollupDeltas, row_contribution
+
+        transitions = self.model.STATUS_TRANSITIONS if transitions is None else transitions
+        if new_status not in transitions:
+            raise ValueError(f"Cannot bulk move orders to {new_status!r}")
+        allowed = transitions[new_status]
+
+        now = timezone.now()
+        changes = {'status': new_status, 'updated_at': now}
+        if new_status == 'delivered':
+            changes.update(is_delivered=True, delivered_at=now)
+        elif new_status == 'paid':
+            changes.update(paid_status=True, paid_at=now)
+
+        with transaction.atomic(using=self.db):
+            rows = list(
+                self.select_for_update().order_by().values_list(
+                    'id', 'created_at', 'status', 'total_price', 'paid_status', 'is_delivered'
+                )
+            )
+            movable = [row for row in rows if row[2] in allowed]
+            ids = [row[0] for row in movable]
+
+            if ids:
+                self.model._base_manager.using(self.db).filter(id__in=ids).update(**changes)
+
+                deltas = RollupDeltas()
+                for order_id, created_at, status, total_price, paid, delivered in movable:
+                    deltas.move(
+                        row_contribution(created_at, status, total_price, paid, delivered),
+                        row_contribution(
+                            created_at, new_status, total_price,
+                            changes.get('paid_status', paid), changes.get('is_delivered', delivered),
+                        ),
+                    )
+                deltas.apply()
+
+        return {row[0]: (None if row[2] in allowed else row[2]) for row in rows}
+
+    def mark_shipped(self):
+        return self.transition('shipped')
+
+    def mark_delivered(self):
+        return self.transition('delivered')
+
+    def mark_cancelled(self):
+        return self.transition('cancelled')
+
+
+class OrderModel(DirtyFieldsMixin, models.Model):
     """
     Model to track customer orders and their status.
     
@@ -179,7 +252,24 @@ class OrderModel(models.Model):
         ('shipped', 'Shipped'),
         ('delivered', 'Delivered'),
         ('cancelled', 'Cancelled'),
+        ('refunded', 'Refunded'),
+        ('disputed', 'Disputed'),
     ]
+
+    # statuses orders can be bulk moved to, and the statuses they may come from
+    STATUS_TRANSITIONS = {
+        'shipped': ('paid', 'processing'),
+        'delivered': ('paid', 'processing', 'shipped'),
+        'cancelled': ('pending', 'paid', 'processing'),
+    }
+
+    # moves driven by the payment gateway (webhooks, refunds)
+    PAYMENT_TRANSITIONS = {
+        'paid': ('pending',),
+        'cancelled': ('pending',),
+        'disputed': ('paid', 'processing', 'shipped', 'delivered'),
+        'refunded': ('paid', 'processing', 'shipped', 'delivered', 'cancelled', 'disputed'),
+    }
     
     # User relationship
     user = models.ForeignKey(
@@ -247,14 +337,51 @@ class OrderModel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Order"
         verbose_name_plural = "Orders"
         ordering = ['-created_at']
+        # back the order list filters (see OrdersListView)
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='order_user_created_idx'),
+            models.Index(fields=['status', '-created_at'], name='order_status_created_idx'),
+            models.Index(fields=['paid_status', 'is_delivered'], name='order_paid_delivered_idx'),
+        ]
 
     def __str__(self):
         return f"Order #{self.id} - {self.name} ({self.status})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remembered so the sales rollups can move this order between buckets
+        instance._rollup_contribution = instance.rollup_contribution()
+        return instance
+
+    def rollup_contribution(self):
+        """
+        What this order adds to the sales rollups:
+        (day, status, revenue, paid, delivered), or None if unknown.
+        """
+        deferred = self.get_deferred_fields()
+        if self.created_at is None or deferred & {'created_at', 'status', 'total_price', 'paid_status', 'is_delivered'}:
+            return None
+
+        from .rollups import row_contribution
+
+        # fields may still hold the raw values they were assigned
+        # (e.g. "True" from request data), normalise them like the db would
+        field = self._meta.get_field
+        return row_contribution(
+            self.created_at,
+            self.status,
+            field('total_price').to_python(self.total_price),
+            field('paid_status').to_python(self.paid_status),
+            field('is_delivered').to_python(self.is_delivered),
+        )
+
     def mark_as_paid(self):
         """Mark order as paid and set payment timestamp."""
         from django.utils import timezone
@@ -269,4 +396,95 @@ class OrderModel(models.Model):
         self.is_delivered = True
         self.delivered_at = timezone.now()
         self.status = 'delivered'
-        self.save() 
\ No newline at end of file
+        self.save() 
+
+class SalesRollup(models.Model):
+    """
+    Order totals for one day (order creation date) and order status.
+
+    Kept up to date incrementally whenever an order is created, changed or
+    deleted (see account/rollups.py); `manage.py rebuild_sales_rollups`
+    recomputes it from OrderModel.
+    """
+
+    day = models.DateField()
+    status = models.CharField(max_length=20, choices=OrderModel.ORDER_STATUS_CHOICES)
+    order_count = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    paid_count = models.IntegerField(default=0)
+    delivered_count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Sales Rollup"
+        verbose_name_plural = "Sales Rollups"
+        ordering = ['day', 'status']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'status'], name='sales_rollup_day_status_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.status}: {self.order_count} orders"
+
+
+class RevokedAccessToken(models.Model):
+    """
+    An access token revoked before it expired (e.g. on logout).
+
+    Checked through the in-memory filter in account/revocation.py, rows can be
+    removed once `expires_at` has passed (`manage.py purge_revoked_tokens`).
+    """
+
+    jti = models.CharField(max_length=255, unique=True)
+    user = models.ForeignKey(
+        User,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="revoked_access_tokens"
+    )
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Revoked Access Token"
+        verbose_name_plural = "Revoked Access Tokens"
+
+    def __str__(self):
+        return f"{self.jti} (expires {self.expires_at})"
+
+
+class TokenCutoff(models.Model):
+    """Tokens issued to `user` before `not_before` are no longer accepted."""
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name="token_cutoff"
+    )
+    not_before = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user} tokens before {self.not_before}"
+
+
+class AccountDeletion(models.Model):
+    """
+    A disabled user account waiting for its data to be deleted.
+
+    The rows are removed in the background in bounded batches (see
+    account/deletion.py); the deletion row goes away with the user.
+    `manage.py process_account_deletions` picks up deletions that did not
+    finish, e.g. after a restart.
+    """
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name="account_deletion"
+    )
+    requested_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_attempt_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Deletion of {self.user} requested {self.requested_at}"
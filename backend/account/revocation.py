@@ -0,0 +1,119 @@
+"""
+JWT revocation.
+
+Two mechanisms, both checked by CachedJWTAuthentication:
+
+- single tokens are revoked by `jti` (RevokedAccessToken). Revoked jtis are
+  kept in a per-process Bloom filter, so a token that was never revoked is
+  accepted without any I/O. A filter hit is confirmed with a query. The
+  filter is reloaded every TOKEN_REVOCATION_FILTER_REFRESH seconds to pick up
+  revocations made by other processes.
+- all tokens of a user issued before a point in time are revoked with a
+  TokenCutoff. The cutoff travels in the cached user snapshot, so checking it
+  is free as well.
+"""
+
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .bloom import BloomFilter
+from .models import RevokedAccessToken, TokenCutoff
+
+# minimum filter size, revocations are rare compared to requests
+MIN_CAPACITY = 10000
+
+_filter = None
+_loaded_at = 0
+_lock = threading.Lock()
+
+
+def _load():
+    jtis = RevokedAccessToken.objects.filter(expires_at__gt=timezone.now()).values_list("jti", flat=True)
+    bloom = BloomFilter(max(jtis.count() * 2, MIN_CAPACITY), 0.001)
+    for jti in jtis.iterator(chunk_size=2000):
+        bloom.add(jti)
+    return bloom
+
+
+def get_filter():
+    global _filter, _loaded_at
+
+    if _filter is None or time.monotonic() - _loaded_at > settings.TOKEN_REVOCATION_FILTER_REFRESH:
+        with _lock:
+            if _filter is None or time.monotonic() - _loaded_at > settings.TOKEN_REVOCATION_FILTER_REFRESH:
+                _filter = _load()
+                _loaded_at = time.monotonic()
+    return _filter
+
+
+def reset_filter():
+    """Drop the filter, it is reloaded on next use."""
+    global _filter
+    _filter = None
+
+
+def issue_refresh_token(user):
+    """
+    RefreshToken.for_user plus a precise `iat` claim (copied to its access
+    token), which the per-user cutoff is compared against.
+    """
+    token = RefreshToken.for_user(user)
+    token["iat"] = token.current_time.timestamp()
+    return token
+
+
+def token_issued_at(token):
+    """When `token` was issued."""
+    if "iat" in token:
+        return datetime.fromtimestamp(token["iat"], tz=dt_timezone.utc)
+
+    # tokens issued without an iat claim: exp is always issue time plus the
+    # lifetime of the token type (rounded down to the second)
+    expires_at = datetime.fromtimestamp(token["exp"], tz=dt_timezone.utc)
+    return expires_at - token.lifetime
+
+
+def is_revoked(token, cutoff=None):
+    """
+    Whether `token` (a validated token) has been revoked.
+
+    `cutoff` is the user's TokenCutoff.not_before, if any.
+    """
+    if cutoff is not None and token_issued_at(token) < cutoff:
+        return True
+
+    jti = token.get(api_settings.JTI_CLAIM)
+    if jti is None or jti not in get_filter():
+        return False
+    return RevokedAccessToken.objects.filter(jti=jti).exists()
+
+
+def revoke_token(token, user=None):
+    """Revoke a single access token."""
+    jti = token[api_settings.JTI_CLAIM]
+    RevokedAccessToken.objects.get_or_create(
+        jti=jti,
+        defaults={
+            "user": user,
+            "expires_at": datetime.fromtimestamp(token["exp"], tz=dt_timezone.utc),
+        },
+    )
+    get_filter().add(jti)
+
+
+def revoke_user_tokens(user):
+    """Revoke every token issued to `user` so far (access and refresh)."""
+    TokenCutoff.objects.update_or_create(user=user, defaults={"not_before": timezone.now()})
+
+    outstanding = OutstandingToken.objects.filter(user=user, expires_at__gt=timezone.now())
+    BlacklistedToken.objects.bulk_create(
+        [BlacklistedToken(token=token) for token in outstanding],
+        ignore_conflicts=True,
+    )
@@ -0,0 +1,137 @@
+"""
+Incrementally maintained sales rollups.
+
+Every order contributes (1 order, its revenue, 0/1 paid, 0/1 delivered) to the
+SalesRollup row of its creation day and status. When an order is created,
+changed or deleted the old contribution is taken out and the new one added,
+with one UPDATE ... SET x = x + delta per affected row, so the dashboard
+never has to aggregate OrderModel. Bulk updates collect their deltas and
+apply them in one go with `apply_deltas`.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import OrderModel, SalesRollup
+
+
+def row_contribution(created_at, status, total_price, paid, delivered):
+    """What an order with these values adds to the rollups."""
+    return (timezone.localdate(created_at), status, total_price, int(paid), int(delivered))
+
+
+class RollupDeltas:
+    """Accumulates changes to the rollups, keyed by (day, status)."""
+
+    def __init__(self):
+        self.deltas = defaultdict(lambda: [0, Decimal("0"), 0, 0])
+
+    def add(self, contribution, sign=1):
+        if contribution is None:
+            return
+        day, status, revenue, paid, delivered = contribution
+        delta = self.deltas[(day, status)]
+        delta[0] += sign
+        delta[1] += sign * (revenue or 0)
+        delta[2] += sign * paid
+        delta[3] += sign * delivered
+
+    def move(self, old, new):
+        if old != new:
+            self.add(old, -1)
+            self.add(new)
+
+    def apply(self):
+        apply_deltas(self.deltas)
+        self.deltas.clear()
+
+
+def apply_deltas(deltas):
+    """Add {(day, status): [orders, revenue, paid, delivered]} to the rollups."""
+    for (day, status), (orders, revenue, paid, delivered) in deltas.items():
+        if not (orders or revenue or paid or delivered):
+            continue
+
+        changes = dict(
+            order_count=F("order_count") + orders,
+            revenue=F("revenue") + revenue,
+            paid_count=F("paid_count") + paid,
+            delivered_count=F("delivered_count") + delivered,
+        )
+        if SalesRollup.objects.filter(day=day, status=status).update(**changes):
+            continue
+
+        try:
+            with transaction.atomic():
+                SalesRollup.objects.create(
+                    day=day, status=status, order_count=orders, revenue=revenue,
+                    paid_count=paid, delivered_count=delivered,
+                )
+        except IntegrityError:
+            # created concurrently, add to it instead
+            SalesRollup.objects.filter(day=day, status=status).update(**changes)
+
+
+def record_order_saved(order, created):
+    """Move `order` from the bucket it was loaded from to its current one."""
+    old = None if created else getattr(order, "_rollup_contribution", None)
+    new = order.rollup_contribution()
+    if not created and old is None:
+        # loaded without the rollup fields, nothing reliable to move
+        return
+
+    deltas = RollupDeltas()
+    deltas.move(old, new)
+    deltas.apply()
+    order._rollup_contribution = new
+
+
+def record_order_deleted(order):
+    deltas = RollupDeltas()
+    deltas.add(getattr(order, "_rollup_contribution", None) or order.rollup_contribution(), -1)
+    deltas.apply()
+
+
+def day_bounds(date_from=None, date_to=None):
+    """created_at filter for whole local days from `date_from` to `date_to`."""
+    bounds = Q()
+    if date_from:
+        bounds &= Q(created_at__gte=timezone.make_aware(datetime.combine(date_from, datetime.min.time())))
+    if date_to:
+        bounds &= Q(created_at__lt=timezone.make_aware(datetime.combine(date_to + timedelta(days=1), datetime.min.time())))
+    return bounds
+
+
+@transaction.atomic
+def rebuild_rollups(date_from=None, date_to=None):
+    """
+    Recompute the rollups of the given days (all days by default) from
+    OrderModel. Returns the number of rollup rows written.
+    """
+    stale = SalesRollup.objects.all()
+    if date_from:
+        stale = stale.filter(day__gte=date_from)
+    if date_to:
+        stale = stale.filter(day__lte=date_to)
+    stale.delete()
+
+    totals = (
+        OrderModel.objects.filter(day_bounds(date_from, date_to))
+        .annotate(day=TruncDate("created_at", tzinfo=timezone.get_current_timezone()))
+        .order_by()
+        .values("day", "status")
+        .annotate(
+            order_count=Count("id"),
+            revenue=Sum("total_price"),
+            paid_count=Count("id", filter=Q(paid_status=True)),
+            delivered_count=Count("id", filter=Q(is_delivered=True)),
+        )
+    )
+    rollups = SalesRollup.objects.bulk_create([SalesRollup(**row) for row in totals])
+    return len(rollups)
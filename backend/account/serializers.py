@@ -11,7 +11,7 @@ This module contains serializers for:
 from .models import StripeModel, BillingAddress, OrderModel
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from rest_framework_simplejwt.tokens import RefreshToken
+from .revocation import issue_refresh_token
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -59,7 +59,7 @@ class UserRegisterTokenSerializer(UserSerializer):
 
     def get_token(self, obj):
         """Generate JWT access token for the user."""
-        token = RefreshToken.for_user(obj)
+        token = issue_refresh_token(obj)
         return str(token.access_token)
 
 
@@ -0,0 +1,34 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .authentication import invalidate_user_snapshot
+from .availability import remember_user
+from .models import OrderModel, TokenCutoff
+from .rollups import record_order_deleted, record_order_saved
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, **kwargs):
+    remember_user(instance)
+    invalidate_user_snapshot(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    invalidate_user_snapshot(instance.pk)
+
+
+@receiver(post_save, sender=TokenCutoff)
+def token_cutoff_saved(sender, instance, **kwargs):
+    invalidate_user_snapshot(instance.user_id)
+
+
+@receiver(post_save, sender=OrderModel)
+def order_saved(sender, instance, created, **kwargs):
+    record_order_saved(instance, created)
+
+
+@receiver(post_delete, sender=OrderModel)
+def order_deleted(sender, instance, **kwargs):
+    record_order_deleted(instance)
@@ -1,14 +1,28 @@
+import csv
+import json
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.db import IntegrityError
 from account import views
 from django.http import response
-from django.test import TestCase, Client
+from django.db import connection
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from rest_framework.test import APITestCase
 from rest_framework.test import force_authenticate
 from rest_framework.test import APIRequestFactory
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
 from django.contrib.auth.models import User
 from rest_framework.test import force_authenticate
-from .models import BillingAddress, OrderModel, StripeModel
+from rest_framework_simplejwt.tokens import RefreshToken
+from decimal import Decimal
+from cart.models import Cart, CartItem
+from product.models import Product
+from .models import AccountDeletion, BillingAddress, OrderModel, SalesRollup, StripeModel
+from .views import duplicate_user_message, filter_orders
 from .views import CardsListView, ChangeOrderStatus, CreateUserAddressView, DeleteUserAddressView, OrdersListView, UpdateUserAddressView, UserAccountDeleteView, UserAccountDetailsView, UserAccountUpdateView, UserAddressDetailsView, UserAddressesListView
 
 
@@ -389,3 +403,577 @@ class AccountApisAuthTest(AccountApisSetUp):
     def test_fetching_of_user_stripe_card_when_logged_out(self):
         response = self.client.get('/account/stripe-cards/')
         self.assertEqual(response.status_code, 401) # Unauthorized
+
+
+class UserRegistrationTest(APITestCase):
+
+    def setUp(self):
+        self.register_url = reverse("register-page")
+        self.availability_url = reverse("check-availability")
+        User.objects.create_user(
+            username = "taken",
+            email = "Taken@gmail.com",
+            password = "taken1234"
+        )
+
+    def test_duplicate_username_is_rejected(self):
+        response = self.client.post(self.register_url, {
+            "username": "taken", "email": "new@gmail.com", "password": "new12345"
+        }, format="json")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data["detail"], "A user with that username already exist!")
+
+    def test_duplicate_email_is_rejected_case_insensitively(self):
+        response = self.client.post(self.register_url, {
+            "username": "someone", "email": "taken@GMAIL.com", "password": "new12345"
+        }, format="json")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data["detail"], "A user with that email address already exist!")
+        self.assertFalse(User.objects.filter(username="someone").exists())
+
+    def test_duplicate_username_quoting_email(self):
+        # PostgreSQL quotes the duplicate value in the error
+        error = IntegrityError(
+            'duplicate key value violates unique constraint "auth_user_username_key"\n'
+            'DETAIL:  Key (username)=(email_fan) already exists.'
+        )
+        self.assertEqual(duplicate_user_message(error), "A user with that username already exist!")
+
+    def test_availability_check(self):
+        response = self.client.get(self.availability_url, {"username": "taken", "email": "free@gmail.com"})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data["username"]["available"])
+        self.assertTrue(response.data["email"]["available"])
+
+        # newly registered users are added to the filter
+        self.client.post(self.register_url, {
+            "username": "fresh", "email": "free@gmail.com", "password": "fresh1234"
+        }, format="json")
+        response = self.client.get(self.availability_url, {"email": "FREE@gmail.com"})
+        self.assertFalse(response.data["email"]["available"])
+
+
+class UserLoginTest(APITestCase):
+
+    def setUp(self):
+        self.login_url = reverse("login-page")
+        self.user = User.objects.create_user(
+            username = "shopper",
+            email = "shopper@gmail.com",
+            password = "shopper1234"
+        )
+
+    def test_login_signs_tokens_once(self):
+        with mock.patch.object(RefreshToken, "for_user", wraps=RefreshToken.for_user) as for_user:
+            response = self.client.post(self.login_url, {
+                "username": "shopper", "password": "shopper1234"
+            }, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(for_user.call_count, 1)
+        self.assertEqual(response.data["token"], response.data["access"])
+        self.assertEqual(response.data["username"], "shopper")
+        self.assertFalse(response.data["admin"])
+
+    def test_password_hash_upgraded_to_configured_iterations(self):
+        with self.settings(PASSWORD_HASHER_ITERATIONS=1000):
+            response = self.client.post(self.login_url, {
+                "username": "shopper", "password": "shopper1234"
+            }, format="json")
+            self.assertEqual(response.status_code, 200)
+
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("pbkdf2_sha256$1000$"))
+
+
+class CachedJWTAuthenticationTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username = "shopper",
+            email = "shopper@gmail.com",
+            password = "shopper1234"
+        )
+        token = RefreshToken.for_user(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_authenticated_requests_skip_user_query(self):
+        response = self.client.get("/api/payments/check-token/")
+        self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/payments/check-token/")
+        self.assertEqual(response.data["user_id"], self.user.id)
+
+    def test_snapshot_invalidated_on_save(self):
+        self.client.get("/api/payments/check-token/")
+
+        self.user.is_active = False
+        self.user.save()
+
+        response = self.client.get("/api/payments/check-token/")
+        self.assertEqual(response.status_code, 401)
+
+    def test_snapshot_invalidated_on_delete(self):
+        self.client.get("/api/payments/check-token/")
+        self.user.delete()
+
+        response = self.client.get("/api/payments/check-token/")
+        self.assertEqual(response.status_code, 401)
+
+
+class TokenRevocationTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username = "shopper",
+            email = "shopper@gmail.com",
+            password = "shopper1234"
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.other_token = str(RefreshToken.for_user(self.user).access_token)
+
+    def check_token(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+        return self.client.get("/api/payments/check-token/")
+
+    def test_logout_revokes_only_current_token(self):
+        self.assertEqual(self.check_token(self.token).status_code, 200)
+
+        response = self.client.post(reverse("logout"))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.check_token(self.token).status_code, 401)
+        self.assertEqual(self.check_token(self.other_token).status_code, 200)
+
+    def test_logout_from_all_devices(self):
+        self.check_token(self.token)
+        self.client.post(reverse("logout"), {"all_devices": True}, format="json")
+
+        self.assertEqual(self.check_token(self.token).status_code, 401)
+        self.assertEqual(self.check_token(self.other_token).status_code, 401)
+
+    def test_password_reset_revokes_tokens(self):
+        reset = self.client.post(reverse("password-reset"), {"email": "shopper@gmail.com"}, format="json")
+        self.client.post(reverse("password-reset-confirm"), {
+            "uid": reset.data["uid"], "token": reset.data["token"], "new_password": "newpass1234"
+        }, format="json")
+
+        self.assertEqual(self.check_token(self.token).status_code, 401)
+
+        login = self.client.post(reverse("login-page"), {
+            "username": "shopper", "password": "newpass1234"
+        }, format="json")
+        self.assertEqual(self.check_token(login.data["access"]).status_code, 200)
+
+
+class OrdersListFilterTest(APITestCase):
+
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username = "admin",
+            email = "admin@gmail.com",
+            password = "admin1234"
+        )
+        self.normal_user = User.objects.create_user(
+            username = "testuser",
+            email = "testuser@gmail.com",
+            password = "testuser1234"
+        )
+
+        def order(user, name, item, status, paid, delivered):
+            return OrderModel.objects.create(
+                user = user,
+                name = name,
+                ordered_item = item,
+                address = "somewhere on earth",
+                total_price = "99.99",
+                status = status,
+                paid_status = paid,
+                is_delivered = delivered,
+            )
+
+        self.chair = order(self.normal_user, "testuser", "computer chair", "paid", True, False)
+        self.mouse = order(self.normal_user, "testuser", "gaming mouse", "delivered", True, True)
+        self.laptop = order(self.admin_user, "admin", "laptop", "pending", False, False)
+
+    def get_ids(self, as_user, **params):
+        self.client.force_authenticate(user=as_user)
+        response = self.client.get(reverse("all-orders-list"), params)
+        self.assertEqual(response.status_code, 200)
+        return sorted(order["id"] for order in response.data)
+
+    def test_filters(self):
+        self.assertEqual(self.get_ids(self.admin_user, status="paid"), [self.chair.id])
+        self.assertEqual(self.get_ids(self.admin_user, paid="true", delivered="false"), [self.chair.id])
+        self.assertEqual(self.get_ids(self.admin_user, user=self.admin_user.id), [self.laptop.id])
+        self.assertEqual(self.get_ids(self.admin_user, search="MOUSE"), [self.mouse.id])
+
+        today = timezone.localdate().isoformat()
+        self.assertEqual(len(self.get_ids(self.admin_user, date_from=today, date_to=today)), 3)
+        self.assertEqual(self.get_ids(self.admin_user, date_to="2000-01-01"), [])
+
+    def test_non_staff_only_sees_own_orders(self):
+        self.assertEqual(self.get_ids(self.normal_user, user=self.admin_user.id), [self.chair.id, self.mouse.id])
+
+    def test_invalid_filter(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse("all-orders-list"), {"status": "lost"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_filters_use_indexes(self):
+        for params in ({"user": str(self.normal_user.id)}, {"status": "paid"}, {"paid": "true", "delivered": "false"}):
+            plan = filter_orders(OrderModel.objects.all(), params, True).explain()
+            self.assertIn("USING INDEX", plan)
+            self.assertNotRegex(plan, r"SCAN (TABLE )?account_ordermodel")
+
+
+class OrdersExportTest(APITestCase):
+
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username = "admin",
+            email = "admin@gmail.com",
+            password = "admin1234"
+        )
+        self.normal_user = User.objects.create_user(
+            username = "testuser",
+            email = "testuser@gmail.com",
+            password = "testuser1234"
+        )
+        for item in ("computer chair", "gaming mouse"):
+            OrderModel.objects.create(
+                user = self.normal_user,
+                name = "testuser",
+                ordered_item = item,
+                address = "somewhere on earth",
+                total_price = "10.50",
+            )
+
+    def test_csv_export(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse("orders-export"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("id,user_id,name,ordered_item"))
+        self.assertIn("computer chair", lines[1])
+
+    def test_csv_export_does_not_emit_formulas(self):
+        OrderModel.objects.filter(ordered_item="gaming mouse").update(
+            name="=HYPERLINK(\"http://evil.example\")", address="@SUM(1+1)",
+        )
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse("orders-export"))
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        row = dict(zip(rows[0], rows[2]))
+        self.assertEqual(row["name"], "'=HYPERLINK(\"http://evil.example\")")
+        self.assertEqual(row["address"], "'@SUM(1+1)")
+        self.assertEqual(row["total_price"], "10.50")
+
+        # NDJSON consumers get the values as stored
+        response = self.client.get(reverse("orders-export"), {"output": "ndjson"})
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(rows[1]["address"], "@SUM(1+1)")
+
+    def test_ndjson_export_with_date_filter(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse("orders-export"), {"output": "ndjson", "date_to": "2000-01-01"})
+        self.assertEqual(b"".join(response.streaming_content), b"")
+
+        response = self.client.get(reverse("orders-export"), {"output": "ndjson"})
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([row["ordered_item"] for row in rows], ["computer chair", "gaming mouse"])
+        self.assertEqual(rows[0]["total_price"], "10.50")
+
+    def test_export_is_staff_only(self):
+        self.client.force_authenticate(user=self.normal_user)
+        response = self.client.get(reverse("orders-export"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_export_command(self):
+        out = StringIO()
+        call_command("export_orders", output="ndjson", stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+class SalesRollupTest(APITestCase):
+
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username = "admin",
+            email = "admin@gmail.com",
+            password = "admin1234"
+        )
+        self.today = timezone.localdate()
+
+    def create_order(self, price="100.00", **fields):
+        return OrderModel.objects.create(
+            user = self.admin_user,
+            name = "admin",
+            ordered_item = "laptop",
+            address = "somewhere on earth",
+            total_price = price,
+            **fields
+        )
+
+    def rollup(self, status):
+        return SalesRollup.objects.get(day=self.today, status=status)
+
+    def test_rollups_follow_order_changes(self):
+        order = self.create_order()
+        self.create_order(price="50.00")
+        self.assertEqual(self.rollup("pending").order_count, 2)
+        self.assertEqual(self.rollup("pending").revenue, Decimal("150.00"))
+
+        order = OrderModel.objects.get(id=order.id)
+        order.mark_as_paid()
+        self.assertEqual(self.rollup("pending").order_count, 1)
+        self.assertEqual(self.rollup("paid").paid_count, 1)
+
+        order.mark_as_delivered()
+        self.assertEqual(self.rollup("paid").order_count, 0)
+        self.assertEqual(self.rollup("delivered").delivered_count, 1)
+        self.assertEqual(self.rollup("delivered").revenue, Decimal("100.00"))
+
+        order.delete()
+        self.assertEqual(self.rollup("delivered").order_count, 0)
+
+    def test_rebuild_matches_incremental(self):
+        self.create_order(paid_status=True, status="paid")
+        self.create_order(price="20.00")
+        expected = list(SalesRollup.objects.filter(order_count__gt=0).values("day", "status", "order_count", "revenue", "paid_count"))
+
+        SalesRollup.objects.all().delete()
+        call_command("rebuild_sales_rollups", stdout=StringIO())
+        rebuilt = list(SalesRollup.objects.values("day", "status", "order_count", "revenue", "paid_count"))
+        self.assertEqual(rebuilt, expected)
+
+    def test_stats_endpoint(self):
+        self.create_order()
+        self.create_order(price="20.00", paid_status=True, status="paid")
+
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse("sales-stats"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["totals"]["order_count"], 2)
+        self.assertEqual(response.data["totals"]["revenue"], Decimal("120.00"))
+        self.assertEqual(response.data["by_status"]["paid"]["paid_count"], 1)
+        self.assertEqual(response.data["days"][0]["day"], self.today)
+
+    def test_stats_endpoint_rejects_invalid_dates(self):
+        self.client.force_authenticate(user=self.admin_user)
+        for params in ({"date_to": "garbage"}, {"date_to": "2024-02-30"}, {"date_from": "2024-13-01"}):
+            response = self.client.get(reverse("sales-stats"), params)
+            self.assertEqual(response.status_code, 400)
+
+
+class BulkOrderStatusTest(APITestCase):
+
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username = "admin",
+            email = "admin@gmail.com",
+            password = "admin1234"
+        )
+        self.orders = {
+            status: OrderModel.objects.create(
+                user = self.admin_user,
+                name = "admin",
+                ordered_item = "laptop",
+                address = "somewhere on earth",
+                total_price = "10.00",
+                status = status,
+            )
+            for status in ("pending", "paid", "shipped")
+        }
+        self.client.force_authenticate(user=self.admin_user)
+
+    def test_bulk_deliver_by_ids(self):
+        ids = [self.orders["paid"].id, self.orders["shipped"].id, self.orders["pending"].id, 999]
+        response = self.client.post(reverse("bulk-order-status"), {"ids": ids, "status": "delivered"}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["updated"], 2)
+        self.assertEqual([r["result"] for r in response.data["results"]], ["updated", "updated", "invalid_transition", "not_found"])
+
+        delivered = OrderModel.objects.get(id=self.orders["paid"].id)
+        self.assertTrue(delivered.is_delivered)
+        self.assertIsNotNone(delivered.delivered_at)
+        self.assertEqual(SalesRollup.objects.get(status="delivered").delivered_count, 2)
+        self.assertEqual(SalesRollup.objects.get(status="paid").order_count, 0)
+
+    def test_bulk_cancel_by_filter(self):
+        response = self.client.post(reverse("bulk-order-status"), {"filter": {"status": "pending"}, "status": "cancelled"}, format="json")
+        self.assertEqual(response.data["updated"], 1)
+        self.assertEqual(OrderModel.objects.get(id=self.orders["pending"].id).status, "cancelled")
+
+    def test_invalid_status(self):
+        response = self.client.post(reverse("bulk-order-status"), {"ids": [1], "status": "paid"}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_json_filter_values(self):
+        OrderModel.objects.filter(id=self.orders["paid"].id).update(paid_status=True)
+        response = self.client.post(reverse("bulk-order-status"), {"filter": {"paid": True, "user": self.admin_user.id}, "status": "cancelled"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["id"] for r in response.data["results"]], [self.orders["paid"].id])
+
+        response = self.client.post(reverse("bulk-order-status"), {"filter": {"search": ["laptop"]}, "status": "cancelled"}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_filter_must_narrow(self):
+        for filters in ({"stauts": "paid"}, {"status": ""}, {"search": "  "}):
+            response = self.client.post(reverse("bulk-order-status"), {"filter": filters, "status": "cancelled"}, format="json")
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(OrderModel.objects.filter(status="cancelled").exists())
+
+    @override_settings(BULK_ORDER_STATUS_MAX_ORDERS=2)
+    def test_number_of_orders_is_capped(self):
+        ids = [order.id for order in self.orders.values()]
+        response = self.client.post(reverse("bulk-order-status"), {"ids": ids, "status": "cancelled"}, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse("bulk-order-status"), {"filter": {"search": "laptop"}, "status": "cancelled"}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(OrderModel.objects.filter(status="cancelled").exists())
+
+    def ship_orders(self, count):
+        ids = [
+            OrderModel.objects.create(user=self.admin_user, name="admin", total_price="10.00", status="paid").id
+            for _ in range(count)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse("bulk-order-status"), {"ids": ids, "status": "shipped"}, format="json")
+        self.assertEqual(response.data["updated"], count)
+        return len(queries)
+
+    def test_queries_do_not_grow_with_orders(self):
+        self.assertEqual(self.ship_orders(6), self.ship_orders(3))
+
+
+class DirtyFieldsSaveTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="buyer", password="buyer1234")
+        OrderModel.objects.create(
+            user = self.user,
+            name = "buyer",
+            ordered_item = "laptop",
+            address = "somewhere on earth",
+            total_price = "10.00",
+            status = "paid",
+        )
+
+    def test_unchanged_save_skips_query(self):
+        order = OrderModel.objects.get()
+        order.total_price = "10.00"
+        with self.assertNumQueries(0):
+            order.save()
+
+    def test_save_writes_changed_columns_only(self):
+        order = OrderModel.objects.get()
+        order.is_delivered = "True"
+        # the order update, then the sales rollup update
+        with self.assertNumQueries(2) as queries:
+            order.save()
+        sql = queries.captured_queries[0]["sql"]
+        self.assertIn('"is_delivered"', sql)
+        self.assertIn('"updated_at"', sql)
+        self.assertNotIn('"address"', sql)
+        self.assertEqual(order.get_dirty_fields(), [])
+        self.assertTrue(OrderModel.objects.get().is_delivered)
+
+    def test_deferred_fields_are_tracked_once_loaded(self):
+        order = OrderModel.objects.only("id").get()
+        self.assertEqual(order.name, "buyer")
+        order.name = "someone else"
+        self.assertEqual(order.get_dirty_fields(), ["name"])
+
+
+@override_settings(BACKGROUND_JOBS_EAGER=True)
+class AccountDeletionTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="leaving", password="leaving1234")
+        for i in range(3):
+            OrderModel.objects.create(
+                user = self.user,
+                name = "leaving",
+                address = "somewhere on earth",
+                total_price = "10.00",
+                status = "paid",
+            )
+        BillingAddress.objects.create(
+            user = self.user,
+            name = "leaving",
+            phone_number = "9123456789",
+            pin_code = "110000",
+            house_no = "somewhere on earth",
+            landmark = "near shop",
+            city = "new delhi",
+            state = "delhi",
+        )
+        StripeModel.objects.create(
+            user = self.user,
+            email = "leaving@gmail.com",
+            name_on_card = "leaving",
+            customer_id = "cus_leaving",
+            card_number = "1234123412341234",
+            exp_month = "08",
+            exp_year = "2030",
+            card_id = "card_leaving",
+        )
+        product = Product.objects.create(name="Mouse", price=Decimal("10.00"))
+        CartItem.objects.create(cart=Cart.objects.create(user=self.user), product=product)
+        self.client.force_authenticate(user=self.user)
+
+    def assert_account_gone(self):
+        self.assertFalse(User.objects.filter(id=self.user.id).exists())
+        self.assertFalse(OrderModel.objects.exists())
+        self.assertFalse(BillingAddress.objects.exists())
+        self.assertFalse(StripeModel.objects.exists())
+        self.assertFalse(CartItem.objects.exists())
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(AccountDeletion.objects.exists())
+        self.assertEqual(SalesRollup.objects.get(status="paid").order_count, 0)
+
+    @mock.patch("account.deletion.stripe.Customer.delete")
+    def test_delete_runs_after_response(self, delete_customer):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("user-delete", args=[self.user.id]), {"password": "leaving1234"})
+            self.assertEqual(response.status_code, 204)
+            # disabled straight away, nothing deleted yet
+            self.assertFalse(User.objects.get(id=self.user.id).is_active)
+            self.assertEqual(OrderModel.objects.count(), 3)
+
+        self.assert_account_gone()
+        delete_customer.assert_called_once_with("cus_leaving")
+
+    @mock.patch("account.deletion.stripe.Customer.delete")
+    def test_command_finishes_pending_deletions(self, delete_customer):
+        response = self.client.post(reverse("user-delete", args=[self.user.id]), {"password": "leaving1234"})
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(AccountDeletion.objects.filter(user=self.user).exists())
+
+        out = StringIO()
+        call_command("process_account_deletions", "--min-age", "0", "--batch-size", "2", stdout=out)
+        self.assertIn("Deleted 1 account(s).", out.getvalue())
+        self.assert_account_gone()
+
+
+class CalibratePasswordHasherTest(TestCase):
+
+    def calibrate(self):
+        out = StringIO()
+        call_command("calibrate_password_hasher", "--target-ms", "1", "--sample-iterations", "1000", "--rounds", "1", stdout=out)
+        return out.getvalue()
+
+    def test_never_suggests_less_than_the_default(self):
+        output = self.calibrate()
+        self.assertIn(f"PASSWORD_HASHER_ITERATIONS={PBKDF2PasswordHasher.iterations}", output)
+        self.assertNotIn("below the current", output)
+
+    @override_settings(PASSWORD_HASHER_ITERATIONS=10 ** 7)
+    def test_warns_before_weakening_hashes(self):
+        self.assertIn("below the current 10000000 iterations", self.calibrate())
@@ -12,7 +12,9 @@ urlpatterns = [
 
     # user
     path('register/', views.UserRegisterView.as_view(), name="register-page"),
+    path('check-availability/', views.UserAvailabilityView.as_view(), name="check-availability"),
     path('login/', views.MyTokenObtainPairView.as_view(), name="login-page"),
+    path('logout/', views.LogoutView.as_view(), name="logout"),
     path('user/<int:pk>/', views.UserAccountDetailsView.as_view(), name="user-details"),
     path('user_update/<int:pk>/', views.UserAccountUpdateView.as_view(), name="user-update"),
     path('user_delete/<int:pk>/', views.UserAccountDeleteView.as_view(), name="user-delete"),
@@ -26,6 +28,9 @@ urlpatterns = [
 
     # order
     path('all-orders-list/', views.OrdersListView.as_view(), name="all-orders-list"),
+    path('orders-export/', views.OrdersExportView.as_view(), name="orders-export"),
+    path('bulk-order-status/', views.BulkOrderStatusView.as_view(), name="bulk-order-status"),
+    path('stats/', views.SalesStatsView.as_view(), name="sales-stats"),
     path('change-order-status/<int:pk>/', views.ChangeOrderStatus.as_view(), name="change-order-status"),
 
     # stripe
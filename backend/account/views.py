@@ -9,18 +9,33 @@ This module contains API views for:
 - Payment card management
 """
 
+from datetime import datetime, timedelta
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth.tokens import default_token_generator
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from rest_framework import status, permissions
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 
-from .models import StripeModel, BillingAddress, OrderModel
+from payments.customers import schedule_customer_provisioning
+
+from .availability import is_taken
+from .deletion import request_account_deletion
+from .exports import EXPORT_FORMATS, export_lines
+from .models import StripeModel, BillingAddress, OrderModel, SalesRollup
+from .revocation import issue_refresh_token, revoke_token, revoke_user_tokens
 from .serializers import (
     UserSerializer, 
     UserRegisterTokenSerializer, 
@@ -69,9 +84,28 @@ class PasswordResetConfirmView(APIView):
             return Response({'detail': 'Invalid or expired token.'}, status=status.HTTP_400_BAD_REQUEST)
         user.password = make_password(new_password)
         user.save()
+        # sessions opened with the old password must not survive the reset
+        revoke_user_tokens(user)
         return Response({'detail': 'Password has been reset successfully.'}, status=status.HTTP_200_OK)
 
 
+# user with the same username or email already exists
+USERNAME_TAKEN_MESSAGE = "A user with that username already exist!"
+EMAIL_TAKEN_MESSAGE = "A user with that email address already exist!"
+
+
+# unique index on LOWER(email), see migration 0026
+EMAIL_INDEX = "account_user_email_ci_uniq"
+
+
+def duplicate_user_message(error):
+    """Map a unique index violation on auth_user to the matching message."""
+    # the index name, not "email": the error may quote the duplicate username
+    if EMAIL_INDEX in str(error):
+        return EMAIL_TAKEN_MESSAGE
+    return USERNAME_TAKEN_MESSAGE
+
+
 # register user
 class UserRegisterView(APIView):
     """To Register the User"""
@@ -84,36 +118,60 @@ class UserRegisterView(APIView):
         if username == "" or email == "":
             return Response({"detial": "username or email cannot be empty"}, status=status.HTTP_400_BAD_REQUEST)
 
-        else:
-            check_username = User.objects.filter(username=username).count()
-            check_email =  User.objects.filter(email=email).count()
-
-            if check_username:
-                message = "A user with that username already exist!"
-                return Response({"detail": message}, status=status.HTTP_403_FORBIDDEN)
-            if check_email:
-                message = "A user with that email address already exist!"
-                return Response({"detail": message}, status=status.HTTP_403_FORBIDDEN)
-            else:
+        # a single insert, duplicates are rejected by the unique indexes on
+        # username and (case-insensitive) email
+        try:
+            with transaction.atomic():
                 user = User.objects.create(
                     username=username,
                     email=email,
                     password=make_password(data["password"]),
                 )
-                serializer = UserRegisterTokenSerializer(user, many=False)
-                return Response(serializer.data)
+        except IntegrityError as e:
+            return Response({"detail": duplicate_user_message(e)}, status=status.HTTP_403_FORBIDDEN)
+
+        # so the first checkout does not have to create it
+        schedule_customer_provisioning(user, search=False)
+
+        serializer = UserRegisterTokenSerializer(user, many=False)
+        return Response(serializer.data)
+
+
+# username / email availability (used while filling the register form)
+class UserAvailabilityView(APIView):
+
+    def get(self, request):
+        result = {}
+        for field in ("username", "email"):
+            value = request.query_params.get(field)
+            if value:
+                result[field] = {"value": value, "available": not is_taken(field, value)}
+
+        if not result:
+            return Response({"detail": "username or email is required"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_200_OK)
 
 # login user (customizing it so that we can see fields like username, email etc as a response 
 # from server, otherwise it will only provide access and refresh token)
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
+
+    @classmethod
+    def get_token(cls, user):
+        return issue_refresh_token(user)
     
     def validate(self, attrs):
         data = super().validate(attrs)
 
-        serializer = UserRegisterTokenSerializer(self.user).data
+        # users registered before customers were provisioned get theirs now
+        schedule_customer_provisioning(self.user)
+
+        # super() already signed a refresh/access pair, reuse its access token
+        # instead of signing another one through UserRegisterTokenSerializer
+        serializer = UserSerializer(self.user).data
 
         for k, v in serializer.items():
             data[k] = v
+        data["token"] = data["access"]
         
         return data
 
@@ -121,6 +179,28 @@ class MyTokenObtainPairView(TokenObtainPairView):
     serializer_class = MyTokenObtainPairSerializer
 
 
+# logout user (revokes the access token used for this request, and the
+# refresh token if one is sent; "all_devices" revokes every token of the user)
+class LogoutView(APIView):
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        if request.data.get("all_devices"):
+            revoke_user_tokens(request.user)
+        else:
+            revoke_token(request.auth, request.user)
+
+            refresh = request.data.get("refresh")
+            if refresh:
+                try:
+                    RefreshToken(refresh).blacklist()
+                except TokenError:
+                    pass
+
+        return Response({"details": "Successfully logged out."}, status=status.HTTP_200_OK)
+
+
 # list all the cards (of currently logged in user only)
 class CardsListView(APIView):
 
@@ -159,13 +239,24 @@ class UserAccountUpdateView(APIView):
 
         if user:
             if request.user.id == user.id:
+                # only write the columns that actually change
+                update_fields = [
+                    field for field in ("username", "email")
+                    if getattr(user, field) != data[field]
+                ]
                 user.username = data["username"]
                 user.email = data["email"]
 
                 if data["password"] != "":
                     user.password = make_password(data["password"])
-
-                user.save()
+                    update_fields.append("password")
+
+                try:
+                    if update_fields:
+                        with transaction.atomic():
+                            user.save(update_fields=update_fields)
+                except IntegrityError as e:
+                    return Response({"detail": duplicate_user_message(e)}, status=status.HTTP_403_FORBIDDEN)
                 serializer = UserSerializer(user, many=False)
                 message = {"details": "User Successfully Updated.", "user": serializer.data}
                 return Response(message, status=status.HTTP_200_OK)
@@ -188,7 +279,8 @@ class UserAccountDeleteView(APIView):
 
             if request.user.id == user.id:
                 if check_password(data["password"], user.password):
-                    user.delete()
+                    # the account is disabled now, its data is deleted in the background
+                    request_account_deletion(user)
                     return Response({"details": "User successfully deleted."}, status=status.HTTP_204_NO_CONTENT)
                 else:
                     return Response({"details": "Incorrect password."}, status=status.HTTP_401_UNAUTHORIZED)
@@ -308,6 +400,79 @@ class DeleteUserAddressView(APIView):
             return Response({"details": "Not found."}, status=status.HTTP_404_NOT_FOUND)
 
 
+def parse_bool(value):
+    """Parse a query string boolean ("true"/"false", "1"/"0"), None if invalid."""
+    value = value.lower()
+    if value in ("true", "1", "yes"):
+        return True
+    if value in ("false", "0", "no"):
+        return False
+    return None
+
+
+def parse_day(value, param):
+    """Parse a YYYY-MM-DD parameter; ValueError names `param` if invalid."""
+    try:
+        day = parse_date(value)
+    except ValueError:
+        # well formed but not a real date, e.g. 2024-02-30
+        day = None
+    if day is None:
+        raise ValueError(f"{param} must be a date (YYYY-MM-DD)")
+    return day
+
+
+# the parameters filter_orders understands
+ORDER_FILTER_PARAMS = ("user", "status", "paid", "delivered", "date_from", "date_to", "search")
+
+
+def filter_orders(orders, params, is_staff):
+    """
+    Apply the order list query parameters to `orders`.
+
+    Supported parameters: status, paid, delivered, date_from, date_to
+    (YYYY-MM-DD, on created_at), search (name, address or ordered item) and,
+    for staff, user (user id). The equality filters line up with the
+    OrderModel indexes; search only narrows the rows they select.
+
+    Raises:
+        ValueError: on an invalid parameter value
+    """
+    if params.get("user") and is_staff:
+        if not params["user"].isdigit():
+            raise ValueError("user must be a user id")
+        orders = orders.filter(user_id=int(params["user"]))
+
+    if params.get("status"):
+        if params["status"] not in dict(OrderModel.ORDER_STATUS_CHOICES):
+            raise ValueError("Unknown order status")
+        orders = orders.filter(status=params["status"])
+
+    for param, field in (("paid", "paid_status"), ("delivered", "is_delivered")):
+        if params.get(param):
+            value = parse_bool(params[param])
+            if value is None:
+                raise ValueError(f"{param} must be true or false")
+            # `__in` because a bare `= True` compiles to "WHERE field" on
+            # SQLite, which cannot use the (paid_status, is_delivered) index
+            orders = orders.filter(**{f"{field}__in": [value]})
+
+    # compare against datetimes, not created_at__date, so the indexes apply
+    for param, lookup, days in (("date_from", "created_at__gte", 0), ("date_to", "created_at__lt", 1)):
+        if params.get(param):
+            day = parse_day(params[param], param)
+            start = timezone.make_aware(datetime.combine(day, datetime.min.time()) + timedelta(days=days))
+            orders = orders.filter(**{lookup: start})
+
+    search = params.get("search", "").strip()
+    if search:
+        orders = orders.filter(
+            Q(name__icontains=search) | Q(ordered_item__icontains=search) | Q(address__icontains=search)
+        )
+
+    return orders
+
+
 # all orders list
 class OrdersListView(APIView):
 
@@ -318,13 +483,108 @@ class OrdersListView(APIView):
         user_staff_status = request.user.is_staff
         
         if user_staff_status:
-            all_users_orders = OrderModel.objects.all()
-            serializer = AllOrdersListSerializer(all_users_orders, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            orders = OrderModel.objects.all()
         else:
-            all_orders = OrderModel.objects.filter(user=request.user)
-            serializer = AllOrdersListSerializer(all_orders, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            orders = OrderModel.objects.filter(user=request.user)
+
+        try:
+            orders = filter_orders(orders, request.query_params, user_staff_status)
+        except ValueError as e:
+            return Response({"details": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = AllOrdersListSerializer(orders, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+# move many orders to shipped / delivered / cancelled at once (staff only);
+# orders are picked by "ids" or by "filter" (same keys as the orders list)
+class BulkOrderStatusView(APIView):
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def post(self, request):
+        data = request.data
+        new_status = data.get("status")
+        if new_status not in OrderModel.STATUS_TRANSITIONS:
+            allowed = ", ".join(OrderModel.STATUS_TRANSITIONS)
+            return Response({"details": f"status must be one of: {allowed}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        ids = data.get("ids")
+        filters = data.get("filter")
+        limit = settings.BULK_ORDER_STATUS_MAX_ORDERS
+        if ids:
+            if not isinstance(ids, list) or not all(str(order_id).isdigit() for order_id in ids):
+                return Response({"details": "ids must be a list of order ids"}, status=status.HTTP_400_BAD_REQUEST)
+            if len(ids) > limit:
+                return Response({"details": f"At most {limit} orders can be updated per request"}, status=status.HTTP_400_BAD_REQUEST)
+            ids = [int(order_id) for order_id in ids]
+            orders = OrderModel.objects.filter(id__in=ids)
+        elif isinstance(filters, dict) and filters:
+            unknown = sorted(set(filters) - set(ORDER_FILTER_PARAMS))
+            if unknown:
+                return Response({"details": f"Unknown filter: {', '.join(unknown)}"}, status=status.HTTP_400_BAD_REQUEST)
+            if not all(isinstance(value, (str, int, float)) for value in filters.values()):
+                return Response({"details": "filter values must be strings, numbers or booleans"}, status=status.HTTP_400_BAD_REQUEST)
+            # filter_orders takes query string values
+            filters = {
+                param: str(value).lower() if isinstance(value, bool) else str(value).strip()
+                for param, value in filters.items()
+            }
+            # filter_orders skips empty values, which would match every order
+            if not any(filters.values()):
+                return Response({"details": "filter needs at least one value"}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                matched = list(
+                    filter_orders(OrderModel.objects.all(), filters, True).values_list("id", flat=True)[:limit + 1]
+                )
+            except ValueError as e:
+                return Response({"details": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            if len(matched) > limit:
+                return Response({"details": f"filter matches more than {limit} orders, narrow it down"}, status=status.HTTP_400_BAD_REQUEST)
+            orders = OrderModel.objects.filter(id__in=matched)
+        else:
+            return Response({"details": "ids or filter is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        outcome = orders.transition(new_status)
+
+        results = []
+        for order_id in (ids or outcome):
+            if order_id not in outcome:
+                results.append({"id": order_id, "result": "not_found"})
+            elif outcome[order_id] is None:
+                results.append({"id": order_id, "result": "updated"})
+            else:
+                results.append({"id": order_id, "result": "invalid_transition", "from_status": outcome[order_id]})
+
+        return Response({
+            "status": new_status,
+            "updated": sum(1 for blocked in outcome.values() if blocked is None),
+            "results": results,
+        }, status=status.HTTP_200_OK)
+
+
+# export orders (staff only), streamed as csv or ndjson;
+# accepts the same filters as the orders list
+class OrdersExportView(APIView):
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        export_format = request.query_params.get("output", "csv")
+        if export_format not in EXPORT_FORMATS:
+            return Response({"details": "output must be csv or ndjson"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            orders = filter_orders(OrderModel.objects.all(), request.query_params, True)
+        except ValueError as e:
+            return Response({"details": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(
+            export_lines(orders, export_format),
+            content_type=EXPORT_FORMATS[export_format],
+        )
+        response["Content-Disposition"] = f'attachment; filename="orders.{export_format}"'
+        return response
+
 
 # change order delivered status
 class ChangeOrderStatus(APIView):
@@ -343,3 +603,41 @@ class ChangeOrderStatus(APIView):
         
         serializer = AllOrdersListSerializer(order, many=False)
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+
+# sales dashboard (staff only), read from the rollup tables
+class SalesStatsView(APIView):
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        params = request.query_params
+        try:
+            date_to = parse_day(params["date_to"], "date_to") if params.get("date_to") else timezone.localdate()
+            date_from = parse_day(params["date_from"], "date_from") if params.get("date_from") else date_to - timedelta(days=29)
+        except ValueError as e:
+            return Response({"details": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        rollups = SalesRollup.objects.filter(day__gte=date_from, day__lte=date_to)
+
+        counters = ("order_count", "revenue", "paid_count", "delivered_count")
+        days = {}
+        by_status = {}
+        totals = dict.fromkeys(counters, 0)
+        for rollup in rollups:
+            day = days.setdefault(rollup.day, dict.fromkeys(counters, 0))
+            state = by_status.setdefault(rollup.status, dict.fromkeys(counters, 0))
+            for counter in counters:
+                value = getattr(rollup, counter)
+                day[counter] += value
+                state[counter] += value
+                totals[counter] += value
+
+        return Response({
+            "date_from": date_from,
+            "date_to": date_to,
+            "totals": totals,
+            "by_status": by_status,
+            "days": [dict(day=day, **values) for day, values in sorted(days.items())],
+        }, status=status.HTTP_200_OK)
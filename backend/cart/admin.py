@@ -0,0 +1,8 @@
+from django.contrib import admin
+from .models import Promotion
+
+
+class PromotionAdmin(admin.ModelAdmin):
+    list_display = ("id", "name", "code", "kind", "value", "product", "min_unit_price", "min_subtotal", "is_active", "starts_at", "ends_at")
+
+admin.site.register(Promotion, PromotionAdmin)
@@ -0,0 +1,85 @@
+"""
+Delete carts that have not been touched for a while.
+
+Carts are removed oldest-first in small batches, each batch in its own
+transaction, so the cart tables are never locked for long. Meant to be run
+periodically (e.g. from cron):
+
+    python manage.py sweep_stale_carts --days 30
+"""
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from cart.models import Cart, CartItem
+
+
+def sweep_stale_carts(cutoff, batch_size, pause=0):
+    """
+    Delete carts last updated before `cutoff` in batches of `batch_size`.
+
+    Yields the number of carts deleted by each batch.
+    """
+    while True:
+        with transaction.atomic():
+            cart_ids = list(
+                Cart.objects.filter(updated_at__lt=cutoff)
+                .order_by("updated_at")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not cart_ids:
+                return
+
+            # the updated_at filter is repeated so a cart touched since the
+            # select above survives this batch
+            CartItem.objects.filter(
+                cart_id__in=cart_ids, cart__updated_at__lt=cutoff
+            ).delete()
+            deleted, _ = Cart.objects.filter(
+                id__in=cart_ids, updated_at__lt=cutoff
+            ).delete()
+
+        yield deleted
+
+        if pause:
+            time.sleep(pause)
+
+
+class Command(BaseCommand):
+    help = "Delete carts that have not been updated for the given number of days."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.CART_RETENTION_DAYS,
+            help="Delete carts untouched for this many days.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.CART_SWEEP_BATCH_SIZE,
+            help="Number of carts deleted per transaction.",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between batches.",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] < 1 or options["batch_size"] < 1:
+            raise CommandError("--days and --batch-size must be positive")
+
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        total = 0
+        for deleted in sweep_stale_carts(cutoff, options["batch_size"], options["pause"]):
+            total += deleted
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {total} stale cart(s)."))
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.4 on 2026-10-19 09:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.4 on 2026-10-19 09:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0010_alter_product_image'),
+        ('cart', '0002_cart_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='coupon_code',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.CreateModel(
+            name='Promotion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=120)),
+                ('code', models.CharField(blank=True, help_text='Coupon code, leave empty for an automatic promotion', max_length=40, null=True, unique=True)),
+                ('kind', models.CharField(choices=[('percentage', 'Percentage off'), ('fixed', 'Fixed amount off'), ('buy_x_get_y', 'Buy X get Y free')], default='percentage', max_length=20)),
+                ('value', models.DecimalField(decimal_places=2, default=0, help_text='Percent off, or amount off (per unit for product promotions)', max_digits=8)),
+                ('min_unit_price', models.DecimalField(blank=True, decimal_places=2, help_text='Only discount lines whose unit price is at least this', max_digits=8, null=True)),
+                ('min_subtotal', models.DecimalField(blank=True, decimal_places=2, help_text='Cart subtotal needed before the promotion applies', max_digits=10, null=True)),
+                ('buy_quantity', models.PositiveIntegerField(default=0)),
+                ('get_quantity', models.PositiveIntegerField(default=0)),
+                ('is_active', models.BooleanField(default=True)),
+                ('starts_at', models.DateTimeField(blank=True, null=True)),
+                ('ends_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(blank=True, help_text='Only discount lines of this product', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='promotions', to='product.product')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:40
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0003_promotion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='promotion',
+            name='value',
+            field=models.DecimalField(decimal_places=2, default=0, help_text='Percent off, or amount off (per unit for product promotions)', max_digits=8, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+    ]
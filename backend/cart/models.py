@@ -1,19 +1,113 @@
 from django.db import models
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
+from django.utils import timezone
+from my_project.mixins import DirtyFieldsMixin
 from product.models import Product
 
 class Cart(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='carts')
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    # indexed so the stale cart sweeper can walk carts oldest-first
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    coupon_code = models.CharField(max_length=40, blank=True, default="")
 
     def __str__(self):
         return f"Cart for {self.user.username}"
 
-class CartItem(models.Model):
+    def touch(self):
+        """Bump updated_at without rewriting the rest of the row."""
+        self.updated_at = timezone.now()
+        Cart.objects.filter(id=self.id).update(updated_at=self.updated_at)
+
+class CartItem(DirtyFieldsMixin, models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
     def __str__(self):
         return f"{self.quantity} of {self.product.name} in cart for {self.cart.user.username}"
+
+
+class Promotion(models.Model):
+    """
+    A discount rule evaluated by the cart pricing engine (see cart/pricing.py).
+
+    Promotions with a code are coupons and only apply when that code is on
+    the cart; promotions without a code apply automatically. A promotion is
+    priced per cart line when it targets a product, a minimum unit price or
+    is a buy-X-get-Y offer, and against the cart subtotal otherwise.
+    """
+
+    PERCENTAGE = 'percentage'
+    FIXED = 'fixed'
+    BUY_X_GET_Y = 'buy_x_get_y'
+
+    KIND_CHOICES = [
+        (PERCENTAGE, 'Percentage off'),
+        (FIXED, 'Fixed amount off'),
+        (BUY_X_GET_Y, 'Buy X get Y free'),
+    ]
+
+    name = models.CharField(max_length=120)
+    code = models.CharField(
+        max_length=40,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text="Coupon code, leave empty for an automatic promotion"
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default=PERCENTAGE)
+    value = models.DecimalField(
+        max_digits=8,
+        decimal_places=2,
+        default=0,
+        validators=[MinValueValidator(0)],
+        help_text="Percent off, or amount off (per unit for product promotions)"
+    )
+
+    # scope
+    product = models.ForeignKey(
+        Product,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name='promotions',
+        help_text="Only discount lines of this product"
+    )
+    min_unit_price = models.DecimalField(
+        max_digits=8,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        help_text="Only discount lines whose unit price is at least this"
+    )
+    min_subtotal = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        help_text="Cart subtotal needed before the promotion applies"
+    )
+
+    # buy X get Y
+    buy_quantity = models.PositiveIntegerField(default=0)
+    get_quantity = models.PositiveIntegerField(default=0)
+
+    is_active = models.BooleanField(default=True)
+    starts_at = models.DateTimeField(null=True, blank=True)
+    ends_at = models.DateTimeField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.name} ({self.get_kind_display()})"
+
+    def clean(self):
+        if self.kind == self.PERCENTAGE and self.value is not None and self.value > 100:
+            raise ValidationError({'value': "A percentage promotion takes at most 100 percent off."})
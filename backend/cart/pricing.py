@@ -0,0 +1,220 @@
+"""
+Server side cart pricing.
+
+Active promotions are compiled once into plain in-memory lookup tables and
+reused until a promotion changes (a version number kept in the Django cache
+is bumped from the Promotion signals) or until the next promotion starts or
+ends. Pricing a cart is then a single pass over its lines:
+
+- each line gets the best of the line promotions that match it
+  (product promotions, unit price thresholds, buy-X-get-Y)
+- the cart gets the best cart promotion whose subtotal threshold is met
+
+Promotions do not stack: the largest discount wins at each level. A coupon
+code only adds its promotion to the candidates.
+"""
+
+import threading
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Promotion
+
+RULES_VERSION_KEY = "cart:pricing:rules-version"
+
+CENT = Decimal("0.01")
+HUNDRED = Decimal("100")
+ZERO = Decimal("0.00")
+
+Quote = namedtuple("Quote", ["subtotal", "discount", "total", "promotions"])
+
+
+class Rule:
+    """A compiled promotion, stripped down to what pricing needs."""
+
+    __slots__ = (
+        "id", "name", "kind", "value", "product_id",
+        "min_unit_price", "min_subtotal", "buy", "get", "rate",
+    )
+
+    def __init__(self, promotion):
+        self.id = promotion.id
+        self.name = promotion.name
+        self.kind = promotion.kind
+        # promotions saved around the model validation never add to a price
+        self.value = max(promotion.value, ZERO)
+        self.product_id = promotion.product_id
+        self.min_unit_price = promotion.min_unit_price
+        self.min_subtotal = promotion.min_subtotal or ZERO
+        self.buy = promotion.buy_quantity
+        self.get = promotion.get_quantity
+        self.rate = min(self.value, HUNDRED) / HUNDRED
+
+    @property
+    def is_line_rule(self):
+        return (
+            self.kind == Promotion.BUY_X_GET_Y
+            or self.product_id is not None
+            or self.min_unit_price is not None
+        )
+
+    def line_discount(self, unit_price, quantity):
+        if self.min_unit_price is not None and unit_price < self.min_unit_price:
+            return ZERO
+        line_total = unit_price * quantity
+        if self.kind == Promotion.PERCENTAGE:
+            return line_total * self.rate
+        if self.kind == Promotion.FIXED:
+            return min(self.value * quantity, line_total)
+        group = self.buy + self.get
+        if not group or not self.get:
+            return ZERO
+        return (quantity // group) * self.get * unit_price
+
+    def cart_discount(self, subtotal):
+        if self.kind == Promotion.PERCENTAGE:
+            return subtotal * self.rate
+        return min(self.value, subtotal)
+
+
+class CompiledRules:
+    """
+    Lookup tables for one snapshot of the active promotions.
+
+    `product_rules` maps a product id to its line rules, `line_rules` holds
+    line rules that apply to every product, `cart_rules` holds cart rules
+    and `coupons` maps a coupon code to its rule.
+    """
+
+    def __init__(self, promotions, now):
+        self.product_rules = {}
+        self.line_rules = []
+        self.cart_rules = []
+        self.coupons = {}
+        self.expires_at = None
+
+        for promotion in promotions:
+            # the snapshot is only valid until the next promotion starts or ends
+            for boundary in (promotion.starts_at, promotion.ends_at):
+                if boundary and boundary > now and (self.expires_at is None or boundary < self.expires_at):
+                    self.expires_at = boundary
+            if (promotion.starts_at and promotion.starts_at > now) or (promotion.ends_at and promotion.ends_at <= now):
+                continue
+
+            rule = Rule(promotion)
+            if promotion.code:
+                self.coupons[promotion.code.upper()] = rule
+            elif not rule.is_line_rule:
+                self.cart_rules.append(rule)
+            elif rule.product_id is not None:
+                self.product_rules.setdefault(rule.product_id, []).append(rule)
+            else:
+                self.line_rules.append(rule)
+
+    def is_stale(self, now):
+        return self.expires_at is not None and now >= self.expires_at
+
+    def price(self, lines, coupon_code=""):
+        """
+        Price `lines`, an iterable of (product_id, unit_price, quantity).
+
+        Returns a Quote with the subtotal, the total discount, the amount to
+        charge and the names of the promotions that were applied.
+        """
+        coupon = self.coupons.get(coupon_code.upper()) if coupon_code else None
+        coupon_is_line_rule = coupon is not None and coupon.is_line_rule
+
+        subtotal = ZERO
+        line_discount = ZERO
+        applied = set()
+
+        for product_id, unit_price, quantity in lines:
+            subtotal += unit_price * quantity
+
+            best, best_rule = ZERO, None
+            for rule in self.product_rules.get(product_id, ()):
+                discount = rule.line_discount(unit_price, quantity)
+                if discount > best:
+                    best, best_rule = discount, rule
+            for rule in self.line_rules:
+                discount = rule.line_discount(unit_price, quantity)
+                if discount > best:
+                    best, best_rule = discount, rule
+            if coupon_is_line_rule and coupon.product_id in (None, product_id):
+                discount = coupon.line_discount(unit_price, quantity)
+                if discount > best:
+                    best, best_rule = discount, coupon
+
+            if best_rule is not None:
+                line_discount += best
+                applied.add(best_rule.name)
+
+        remaining = subtotal - line_discount
+        best, best_rule = ZERO, None
+        cart_rules = self.cart_rules
+        if coupon is not None and not coupon_is_line_rule:
+            cart_rules = cart_rules + [coupon]
+        for rule in cart_rules:
+            if subtotal >= rule.min_subtotal:
+                discount = rule.cart_discount(remaining)
+                if discount > best:
+                    best, best_rule = discount, rule
+        if best_rule is not None:
+            applied.add(best_rule.name)
+
+        discount = (line_discount + best).quantize(CENT, rounding=ROUND_HALF_UP)
+        subtotal = subtotal.quantize(CENT, rounding=ROUND_HALF_UP)
+        return Quote(subtotal, discount, subtotal - discount, sorted(applied))
+
+
+_compiled = None
+_compiled_version = None
+_lock = threading.Lock()
+
+
+def invalidate_rules():
+    """Force every process to recompile the promotions on next use."""
+    try:
+        cache.incr(RULES_VERSION_KEY)
+    except ValueError:
+        cache.set(RULES_VERSION_KEY, 1, None)
+
+
+def get_rules():
+    """Return the compiled promotions, recompiling them if they changed."""
+    global _compiled, _compiled_version
+
+    now = timezone.now()
+    version = cache.get(RULES_VERSION_KEY, 0)
+    rules = _compiled
+    if rules is not None and _compiled_version == version and not rules.is_stale(now):
+        return rules
+
+    with _lock:
+        if _compiled is None or _compiled_version != version or _compiled.is_stale(now):
+            promotions = Promotion.objects.filter(is_active=True).filter(
+                Q(ends_at__isnull=True) | Q(ends_at__gt=now)
+            )
+            _compiled = CompiledRules(promotions, now)
+            _compiled_version = version
+        return _compiled
+
+
+def coupon_exists(code):
+    """Whether `code` is a coupon that is currently active."""
+    return bool(code) and code.upper() in get_rules().coupons
+
+
+def price_lines(lines, coupon_code=""):
+    """Price (product_id, unit_price, quantity) lines."""
+    return get_rules().price(lines, coupon_code)
+
+
+def price_cart(cart):
+    """Price every item of `cart`, using the coupon stored on the cart."""
+    lines = cart.items.values_list("product_id", "product__price", "quantity")
+    return price_lines(lines, cart.coupon_code)
@@ -2,6 +2,7 @@ from rest_framework import serializers
 from .models import Cart, CartItem
 from product.serializers import ProductSerializer
 from product.models import Product
+from .pricing import price_cart
 
 class CartItemSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(read_only=True)
@@ -38,12 +39,30 @@ class CartItemSerializer(serializers.ModelSerializer):
 
 class CartSerializer(serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
+    subtotal = serializers.SerializerMethodField()
+    discount = serializers.SerializerMethodField()
+    promotions = serializers.SerializerMethodField()
     total_price = serializers.SerializerMethodField()
 
     class Meta:
         model = Cart
-        fields = ['id', 'user', 'items', 'created_at', 'updated_at', 'total_price']
-        read_only_fields = ['user', 'created_at', 'updated_at', 'total_price']
+        fields = ['id', 'user', 'items', 'created_at', 'updated_at', 'coupon_code', 'subtotal', 'discount', 'promotions', 'total_price']
+        read_only_fields = ['user', 'created_at', 'updated_at', 'coupon_code', 'subtotal', 'discount', 'promotions', 'total_price']
+
+    def get_quote(self, obj):
+        # priced once per cart and shared by the price fields below
+        if getattr(obj, '_quote', None) is None:
+            obj._quote = price_cart(obj)
+        return obj._quote
+
+    def get_subtotal(self, obj):
+        return self.get_quote(obj).subtotal
+
+    def get_discount(self, obj):
+        return self.get_quote(obj).discount
+
+    def get_promotions(self, obj):
+        return self.get_quote(obj).promotions
 
     def get_total_price(self, obj):
-        return sum(item.product.price * item.quantity for item in obj.items.all())
+        return self.get_quote(obj).total
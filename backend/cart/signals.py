@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Promotion
+from .pricing import invalidate_rules
+
+
+@receiver(post_save, sender=Promotion)
+@receiver(post_delete, sender=Promotion)
+def promotion_changed(sender, **kwargs):
+    invalidate_rules()
@@ -0,0 +1,217 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from product.models import Product
+from .models import Cart, CartItem, Promotion
+from .pricing import invalidate_rules, price_lines
+
+
+class StaleCartSweeperTest(TestCase):
+
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="keyboard",
+            description="mechanical keyboard",
+            price=49.99,
+            stock=True,
+        )
+
+        self.stale_carts = []
+        for i in range(5):
+            user = User.objects.create_user(username=f"stale{i}", password="stale1234")
+            cart = Cart.objects.create(user=user)
+            CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+            self.stale_carts.append(cart)
+
+        # updated_at is auto_now, so age the carts with a queryset update
+        Cart.objects.filter(id__in=[c.id for c in self.stale_carts]).update(
+            updated_at=timezone.now() - timedelta(days=40)
+        )
+
+        fresh_user = User.objects.create_user(username="fresh", password="fresh1234")
+        self.fresh_cart = Cart.objects.create(user=fresh_user)
+        CartItem.objects.create(cart=self.fresh_cart, product=self.product)
+
+    def test_sweeper_deletes_only_stale_carts(self):
+        out = StringIO()
+        call_command("sweep_stale_carts", days=30, batch_size=2, stdout=out)
+
+        self.assertIn("Deleted 5 stale cart(s).", out.getvalue())
+        self.assertEqual(list(Cart.objects.values_list("id", flat=True)), [self.fresh_cart.id])
+        self.assertEqual(CartItem.objects.count(), 1)
+
+    def test_touched_cart_is_kept(self):
+        self.stale_carts[0].touch()
+        call_command("sweep_stale_carts", days=30, stdout=StringIO())
+
+        self.assertTrue(Cart.objects.filter(id=self.stale_carts[0].id).exists())
+        self.assertEqual(Cart.objects.count(), 2)
+
+
+class PricingEngineTest(TestCase):
+
+    def setUp(self):
+        self.chair = Product.objects.create(name="chair", price=Decimal("100.00"), stock=True)
+        self.mouse = Product.objects.create(name="mouse", price=Decimal("10.00"), stock=True)
+        # rules compiled by another test may outlive its rolled back promotions
+        invalidate_rules()
+
+    def lines(self, chairs=1, mice=1):
+        return [
+            (self.chair.id, self.chair.price, chairs),
+            (self.mouse.id, self.mouse.price, mice),
+        ]
+
+    def test_no_promotions(self):
+        quote = price_lines(self.lines(chairs=2, mice=3))
+        self.assertEqual(quote.subtotal, Decimal("230.00"))
+        self.assertEqual(quote.discount, Decimal("0.00"))
+        self.assertEqual(quote.total, Decimal("230.00"))
+
+    def test_product_percentage_and_buy_x_get_y(self):
+        Promotion.objects.create(name="chairs 10% off", kind=Promotion.PERCENTAGE, value=10, product=self.chair)
+        Promotion.objects.create(name="mouse 2+1", kind=Promotion.BUY_X_GET_Y, buy_quantity=2, get_quantity=1, product=self.mouse)
+
+        quote = price_lines(self.lines(chairs=2, mice=7))
+        # 20 off the chairs, two free mice
+        self.assertEqual(quote.discount, Decimal("40.00"))
+        self.assertEqual(quote.promotions, ["chairs 10% off", "mouse 2+1"])
+
+    def test_best_line_promotion_wins(self):
+        Promotion.objects.create(name="5 off", kind=Promotion.FIXED, value=5, product=self.chair)
+        Promotion.objects.create(name="big ticket", kind=Promotion.PERCENTAGE, value=20, min_unit_price=50)
+
+        quote = price_lines(self.lines())
+        self.assertEqual(quote.discount, Decimal("20.00"))
+        self.assertEqual(quote.promotions, ["big ticket"])
+
+    def test_cart_threshold(self):
+        Promotion.objects.create(name="50 off 200", kind=Promotion.FIXED, value=50, min_subtotal=200)
+
+        self.assertEqual(price_lines(self.lines()).discount, Decimal("0.00"))
+        self.assertEqual(price_lines(self.lines(chairs=2)).discount, Decimal("50.00"))
+
+    def test_coupon_only_applies_with_code(self):
+        Promotion.objects.create(name="welcome", code="WELCOME", kind=Promotion.PERCENTAGE, value=50)
+
+        self.assertEqual(price_lines(self.lines()).discount, Decimal("0.00"))
+        self.assertEqual(price_lines(self.lines(), "welcome").discount, Decimal("55.00"))
+
+    def test_rules_recompiled_on_change(self):
+        promotion = Promotion.objects.create(name="sale", kind=Promotion.PERCENTAGE, value=10)
+        self.assertEqual(price_lines(self.lines()).discount, Decimal("11.00"))
+
+        promotion.is_active = False
+        promotion.save()
+        self.assertEqual(price_lines(self.lines()).discount, Decimal("0.00"))
+
+    def test_scheduled_promotion(self):
+        Promotion.objects.create(
+            name="later", kind=Promotion.PERCENTAGE, value=10,
+            starts_at=timezone.now() + timedelta(days=1),
+        )
+        self.assertEqual(price_lines(self.lines()).discount, Decimal("0.00"))
+
+    def test_discount_never_exceeds_the_price(self):
+        promotion = Promotion(name="typo", kind=Promotion.PERCENTAGE, value=150, product=self.chair)
+        with self.assertRaises(ValidationError):
+            promotion.full_clean()
+
+        # saved without validation, e.g. from a script
+        promotion.save()
+        Promotion.objects.create(name="refund", kind=Promotion.FIXED, value=-20)
+        quote = price_lines(self.lines())
+        self.assertEqual(quote.discount, Decimal("100.00"))
+        self.assertEqual(quote.total, Decimal("10.00"))
+
+
+class CartCouponApiTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="shopper", password="shopper1234")
+        self.product = Product.objects.create(name="lamp", price=Decimal("40.00"), stock=True)
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        Promotion.objects.create(name="quarter off", code="Q25", kind=Promotion.PERCENTAGE, value=25)
+        self.client.force_authenticate(user=self.user)
+
+    def test_apply_valid_coupon(self):
+        response = self.client.post("/api/cart/apply_coupon/", {"code": "Q25"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["subtotal"], Decimal("80.00"))
+        self.assertEqual(response.data["total_price"], Decimal("60.00"))
+
+    def test_apply_invalid_coupon(self):
+        response = self.client.post("/api/cart/apply_coupon/", {"code": "NOPE"}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class CartItemSaveTest(TestCase):
+
+    def test_quantity_change_only_writes_quantity(self):
+        user = User.objects.create_user(username="buyer", password="buyer1234")
+        product = Product.objects.create(name="Mouse", price=Decimal("10.00"))
+        CartItem.objects.create(cart=Cart.objects.create(user=user), product=product)
+
+        item = CartItem.objects.get()
+        item.quantity += 2
+        with self.assertNumQueries(1) as queries:
+            item.save()
+        self.assertNotIn('"product_id"', queries.captured_queries[0]["sql"])
+        self.assertEqual(CartItem.objects.get().quantity, 3)
+
+        with self.assertNumQueries(0):
+            item.save()
+
+
+class IdempotentAddItemTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="shopper", password="shopper1234")
+        self.product = Product.objects.create(name="lamp", price=Decimal("40.00"), stock=True)
+        self.client.force_authenticate(user=self.user)
+
+    def add_item(self, quantity, key="add-1"):
+        return self.client.post(
+            "/api/cart/add_item/",
+            {"product_id": self.product.id, "quantity": quantity},
+            format="json",
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_retry_is_replayed(self):
+        first = self.add_item(2)
+        retry = self.add_item(2)
+
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+        self.add_item(2, key="add-2")
+        self.assertEqual(CartItem.objects.get().quantity, 4)
+
+    def test_anonymous_callers_do_not_share_keys(self):
+        self.client.force_authenticate(user=None)
+        first = self.client.post("/api/cart/add_item/", {}, HTTP_IDEMPOTENCY_KEY="k", REMOTE_ADDR="10.0.0.1")
+        other = self.client.post("/api/cart/add_item/", {}, HTTP_IDEMPOTENCY_KEY="k", REMOTE_ADDR="10.0.0.2")
+        self.assertNotIn("Idempotent-Replayed", other)
+        retry = self.client.post("/api/cart/add_item/", {}, HTTP_IDEMPOTENCY_KEY="k", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.status_code, first.status_code)
+
+    def test_key_reused_for_another_request(self):
+        self.add_item(2)
+        response = self.add_item(3)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
@@ -5,6 +5,7 @@ from rest_framework.decorators import action
 from .models import Cart, CartItem
 from product.models import Product # Import Product model
 from .serializers import CartSerializer, CartItemSerializer
+from .pricing import coupon_exists
 
 class CartViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
@@ -30,6 +31,9 @@ class CartViewSet(viewsets.ViewSet):
             if not created:
                 cart_item.quantity += quantity
                 cart_item.save()
+
+            # keep the cart out of the stale cart sweeper
+            cart.touch()
             
             # Re-fetch the cart to ensure related items are fresh
             cart = Cart.objects.get(id=cart.id)
@@ -38,6 +42,21 @@ class CartViewSet(viewsets.ViewSet):
             return Response(cart_serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'])
+    def apply_coupon(self, request):
+        cart, created = Cart.objects.get_or_create(user=request.user)
+        code = request.data.get('code', '').strip()
+
+        # an empty code removes the coupon from the cart
+        if code and not coupon_exists(code):
+            return Response({"detail": "Invalid or expired coupon code."}, status=status.HTTP_400_BAD_REQUEST)
+
+        cart.coupon_code = code
+        cart.save()
+
+        serializer = CartSerializer(cart)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
 class CartItemDeleteView(generics.DestroyAPIView):
     permission_classes = [IsAuthenticated]
     queryset = CartItem.objects.all()
@@ -48,5 +67,6 @@ class CartItemDeleteView(generics.DestroyAPIView):
     def destroy(self, request, *args, **kwargs):
         super().destroy(request, *args, **kwargs)
         cart, created = Cart.objects.get_or_create(user=request.user)
+        cart.touch()
         serializer = CartSerializer(cart)
         return Response(serializer.data, status=status.HTTP_200_OK)
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""
+Fire-and-forget background jobs.
+
+A job runs on a small process-wide thread pool (BACKGROUND_JOB_WORKERS
+threads) once the current transaction commits, so it never sees data that
+is rolled back afterwards. Nothing is persisted here: a job that is lost
+to a restart has to be picked up again by its caller, which keeps the
+state it needs in the database along with a management command that
+re-runs unfinished work.
+
+With BACKGROUND_JOBS_EAGER set, jobs run inline after the commit instead
+(handy for tests and for management commands).
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the job pool, creating a new one after a fork."""
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        with _lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.BACKGROUND_JOB_WORKERS,
+                    thread_name_prefix="background-job",
+                )
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _run(func, args, kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        logger.exception("Background job %s failed", getattr(func, "__name__", func))
+    finally:
+        # the pool threads open their own connections, don't leak them
+        connections.close_all()
+
+
+def run_in_background(func, *args, **kwargs):
+    """Run `func(*args, **kwargs)` on the job pool after the transaction commits."""
+    if settings.BACKGROUND_JOBS_EAGER:
+        transaction.on_commit(lambda: func(*args, **kwargs))
+    else:
+        transaction.on_commit(lambda: get_executor().submit(_run, func, args, kwargs))
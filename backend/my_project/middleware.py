@@ -0,0 +1,97 @@
+"""
+Project middleware.
+
+IdempotencyMiddleware makes POST/PUT/PATCH/DELETE requests that carry an
+`Idempotency-Key` header safe to retry: the first request runs and its
+response is stored in the cache for IDEMPOTENCY_KEY_TTL seconds, a retry
+with the same key gets the stored response back (with an
+`Idempotent-Replayed: true` header) without running the view again. So a
+double-clicked checkout or a client retrying after a timeout charges once
+and creates one order, cart increment or address.
+
+Keys are scoped to the caller's credentials (the Authorization header, or
+the session, or for anonymous callers the client address) and tied to a
+fingerprint of the request: reusing a key for
+a different request is refused with 422, and a retry that arrives while
+the first request is still running gets 409 and should be retried later.
+Server errors and 409/429 responses are not stored, so those can be retried
+with the same key.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+
+IDEMPOTENT_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+# responses worth replaying; anything else may succeed on a retry
+NOT_STORED_STATUSES = (409, 429)
+
+
+class IdempotencyMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        key = request.headers.get("Idempotency-Key")
+        if request.method not in IDEMPOTENT_METHODS or not key:
+            return self.get_response(request)
+        if len(key) > 255:
+            return JsonResponse({"detail": "Idempotency-Key must be at most 255 characters."}, status=400)
+
+        cache_key = self.cache_key(request, key)
+        lock_key = cache_key + ":lock"
+        fingerprint = self.fingerprint(request)
+
+        stored = cache.get(cache_key)
+        if stored is None:
+            if not cache.add(lock_key, fingerprint, settings.IDEMPOTENCY_LOCK_TIMEOUT):
+                # a response may have been stored since
+                stored = cache.get(cache_key)
+                if stored is None:
+                    return JsonResponse(
+                        {"detail": "A request with this Idempotency-Key is still being processed."},
+                        status=409,
+                    )
+            else:
+                try:
+                    response = self.get_response(request)
+                    self.store(cache_key, fingerprint, response)
+                finally:
+                    cache.delete(lock_key)
+                return response
+
+        if stored["fingerprint"] != fingerprint:
+            return JsonResponse(
+                {"detail": "This Idempotency-Key was already used for a different request."},
+                status=422,
+            )
+        response = HttpResponse(stored["content"], status=stored["status"], content_type=stored["content_type"])
+        response["Idempotent-Replayed"] = "true"
+        return response
+
+    def cache_key(self, request, key):
+        owner = request.headers.get("Authorization") or (request.session.session_key if hasattr(request, "session") else "")
+        if not owner:
+            # anonymous callers must not share one key space
+            owner = f"address:{request.META.get('REMOTE_ADDR', '')}"
+        scope = hashlib.sha256(f"{owner}\n{key}".encode("utf-8")).hexdigest()
+        return f"idempotency:{scope}"
+
+    def fingerprint(self, request):
+        digest = hashlib.sha256(f"{request.method} {request.get_full_path()}\n".encode("utf-8"))
+        digest.update(request.body)
+        return digest.hexdigest()
+
+    def store(self, cache_key, fingerprint, response):
+        if response.streaming or response.status_code >= 500 or response.status_code in NOT_STORED_STATUSES:
+            return
+        cache.set(cache_key, {
+            "fingerprint": fingerprint,
+            "status": response.status_code,
+            "content": response.content,
+            "content_type": response.get("Content-Type", "application/json"),
+        }, settings.IDEMPOTENCY_KEY_TTL)
@@ -0,0 +1,108 @@
+"""
+Model mixins shared by the project apps.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db.models.fields.files import FieldFile
+
+
+def _comparable(field, value):
+    """
+    Normalise a field value so a value assigned from request data ("True",
+    "12.50") compares equal to the value the database returned.
+    """
+    try:
+        value = field.to_python(value)
+    except (ValidationError, TypeError, ValueError):
+        # left as is, it compares unequal and save() reports the bad value
+        return value
+    if isinstance(value, FieldFile):
+        return value.name
+    return value
+
+
+class DirtyFieldsMixin:
+    """
+    Track which fields changed since an instance was loaded, and make save()
+    write only those columns.
+
+    An instance loaded from the database saves with `update_fields` set to
+    its changed fields (plus its auto_now fields), and a save with nothing
+    changed skips the query altogether. New instances, and saves that pass
+    `update_fields`, `force_insert` or `force_update`, behave as usual.
+
+    Must come before models.Model in the bases.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_values()
+        return instance
+
+    def _remember_values(self, fields=None):
+        """Record the current values of `fields` (default: every loaded field) as clean."""
+        if fields is None:
+            self._loaded_values = {}
+        elif not hasattr(self, "_loaded_values"):
+            return
+
+        for field in self._meta.concrete_fields:
+            if fields is not None and field.name not in fields and field.attname not in fields:
+                continue
+            # deferred fields are not in __dict__ until they are loaded
+            if field.attname in self.__dict__:
+                self._loaded_values[field.attname] = _comparable(field, self.__dict__[field.attname])
+
+    def get_dirty_fields(self):
+        """
+        Names of the fields changed since the instance was loaded or last
+        saved, or None if the instance is not being tracked.
+        """
+        loaded = getattr(self, "_loaded_values", None)
+        if loaded is None:
+            return None
+        return [
+            field.name
+            for field in self._meta.concrete_fields
+            if not field.primary_key
+            and field.attname in self.__dict__
+            and (
+                field.attname not in loaded
+                or _comparable(field, self.__dict__[field.attname]) != loaded[field.attname]
+            )
+        ]
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        # also covers deferred fields, which load through refresh_from_db
+        self._remember_values(fields)
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        dirty = None
+        loaded = getattr(self, "_loaded_values", None)
+        if (
+            loaded is not None
+            and not self._state.adding
+            and not force_insert
+            and not force_update
+            and update_fields is None
+            and using in (None, self._state.db)
+            and self.pk == loaded.get(self._meta.pk.attname)
+        ):
+            dirty = self.get_dirty_fields()
+            if not dirty:
+                return
+            update_fields = dirty + [
+                field.name
+                for field in self._meta.concrete_fields
+                if getattr(field, "auto_now", False) and field.name not in dirty
+            ]
+
+        super().save(
+            force_insert=force_insert,
+            force_update=force_update,
+            using=using,
+            update_fields=update_fields,
+        )
+        self._remember_values(None if update_fields is None or dirty is not None else update_fields)
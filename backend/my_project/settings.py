@@ -10,10 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import json
 import os
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
+from corsheaders.defaults import default_headers
 load_dotenv()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +45,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
 
     'rest_framework',
+    'rest_framework_simplejwt.token_blacklist',
     'corsheaders',
 
     'product',
@@ -58,6 +61,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'my_project.middleware.IdempotencyMiddleware',                # Idempotency-Key replays
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -94,6 +98,19 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# use a shared backend (e.g. memcached) in production so cache invalidation
+# reaches every worker process
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -113,6 +130,22 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Password hashing
+# https://docs.djangoproject.com/en/3.2/topics/auth/passwords/
+
+PASSWORD_HASHERS = [
+    'account.hashers.PooledPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
+# pick with `python manage.py calibrate_password_hasher` on the production hardware
+PASSWORD_HASHER_ITERATIONS = int(os.getenv("PASSWORD_HASHER_ITERATIONS", 260000))
+# threads hashing passwords at the same time (per process)
+PASSWORD_HASHING_WORKERS = int(os.getenv("PASSWORD_HASHING_WORKERS", os.cpu_count() or 2))
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
 
@@ -157,7 +190,7 @@ SIMPLE_JWT = {
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'account.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_THROTTLE_CLASSES': [
         'rest_framework.throttling.AnonRateThrottle',
@@ -170,8 +203,114 @@ REST_FRAMEWORK = {
 }
 
 
+# BACKGROUND JOBS (see my_project/background.py)
+# threads per process running jobs off the request thread
+BACKGROUND_JOB_WORKERS = int(os.getenv("BACKGROUND_JOB_WORKERS", 4))
+# run jobs inline after commit instead of on the thread pool
+BACKGROUND_JOBS_EAGER = os.getenv("BACKGROUND_JOBS_EAGER", "0") == "1"
+
+# IDEMPOTENCY KEYS (see my_project/middleware.py)
+# seconds a response is replayed for retries with the same Idempotency-Key;
+# needs a cache shared by all workers (CACHES above) to work across processes
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", 24 * 60 * 60))
+# seconds a key stays locked while its first request runs (the lock is
+# released when it ends). Must outlast the slowest request: a checkout's
+# gateway calls may each take (STRIPE_CONNECT_TIMEOUT + STRIPE_READ_TIMEOUT)
+# x (STRIPE_MAX_NETWORK_RETRIES + 1), ~100s with the defaults, and a retry
+# running once the lock expired would charge again
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", 600))
+
+# ACCOUNT
+# in-memory Bloom filter of taken usernames/emails used by the availability check
+REGISTRATION_BLOOM_FILTER = True
+REGISTRATION_BLOOM_FILTER_ERROR_RATE = 0.01
+# seconds before the filter is rebuilt to pick up users from other processes
+REGISTRATION_BLOOM_FILTER_TTL = 300
+
+# seconds the authenticated user snapshot is cached for JWT requests
+USER_SNAPSHOT_CACHE_TTL = 60
+
+# seconds between reloads of the revoked token filter from the database,
+# i.e. how long a token revoked by another process may still be accepted
+TOKEN_REVOCATION_FILTER_REFRESH = 30
+
+# rows fetched per database round trip by the order exports
+ORDER_EXPORT_CHUNK_SIZE = 2000
+
+# orders one bulk order status request may move (they are locked together)
+BULK_ORDER_STATUS_MAX_ORDERS = 500
+
+# rows deleted per transaction when a deleted account's data is removed
+ACCOUNT_DELETION_BATCH_SIZE = int(os.getenv("ACCOUNT_DELETION_BATCH_SIZE", 500))
+
+# CART
+# carts untouched for this many days are removed by `manage.py sweep_stale_carts`
+CART_RETENTION_DAYS = int(os.getenv("CART_RETENTION_DAYS", 30))
+# rows deleted per transaction, keeps lock time on the cart tables short
+CART_SWEEP_BATCH_SIZE = int(os.getenv("CART_SWEEP_BATCH_SIZE", 500))
+
 # STRIPE
 STRIPE_TEST_SECRET_KEY = os.getenv("STRIPE_TEST_SECRET_KEY")
+# signing secret of the webhook endpoint (/api/payments/webhook/)
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
+# webhook events applied per batch, and seconds before an event claimed by
+# a worker that died is picked up again (see payments/webhooks.py)
+WEBHOOK_BATCH_SIZE = 200
+WEBHOOK_CLAIM_TIMEOUT = 300
+# gateway implementation used by the payments app (see payments/gateway.py),
+# payments.gateway.FakeGateway runs checkout in-process for load tests
+PAYMENT_GATEWAY = os.getenv("PAYMENT_GATEWAY", "payments.gateway.StripeGateway")
+PAYMENT_GATEWAY_OPTIONS = json.loads(os.getenv("PAYMENT_GATEWAY_OPTIONS", "{}"))
+# guards around the gateway calls (see payments/resilience.py): consecutive
+# failures that open an operation's circuit, and seconds it stays open
+GATEWAY_BREAKER_FAILURES = int(os.getenv("GATEWAY_BREAKER_FAILURES", 5))
+GATEWAY_BREAKER_RESET = float(os.getenv("GATEWAY_BREAKER_RESET", 30))
+# gateway calls in flight per process, and seconds to wait for a free slot
+GATEWAY_BULKHEAD_SIZE = int(os.getenv("GATEWAY_BULKHEAD_SIZE", 10))
+GATEWAY_BULKHEAD_TIMEOUT = float(os.getenv("GATEWAY_BULKHEAD_TIMEOUT", 0.5))
+# outbound gateway requests per second per process, burst size, and seconds
+# a call may wait for its turn
+GATEWAY_RATE_LIMIT = float(os.getenv("GATEWAY_RATE_LIMIT", 25))
+GATEWAY_RATE_BURST = int(os.getenv("GATEWAY_RATE_BURST", 25))
+GATEWAY_RATE_LIMIT_WAIT = float(os.getenv("GATEWAY_RATE_LIMIT_WAIT", 1))
+# threads per process running a request's gateway calls concurrently
+GATEWAY_CALL_WORKERS = int(os.getenv("GATEWAY_CALL_WORKERS", 8))
+# seconds to open a connection to, and to wait for a response from, Stripe
+STRIPE_CONNECT_TIMEOUT = float(os.getenv("STRIPE_CONNECT_TIMEOUT", 3.05))
+STRIPE_READ_TIMEOUT = float(os.getenv("STRIPE_READ_TIMEOUT", 30))
+# keep-alive connections to Stripe per process
+STRIPE_HTTP_POOL_SIZE = int(os.getenv("STRIPE_HTTP_POOL_SIZE", 10))
+# retries (jittered exponential backoff) of Stripe calls that failed to connect
+# or got a 409/5xx; POSTs carry an Idempotency-Key so retries are safe
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", 2))
+# seconds a user's Stripe customer id is cached (see payments/customers.py);
+# the cache is per process, so other workers keep serving a deleted customer
+# until their entry expires
+STRIPE_CUSTOMER_CACHE_TTL = int(os.getenv("STRIPE_CUSTOMER_CACHE_TTL", 60))
+# create the Stripe customer in the background at registration (and at the
+# next login for older users) instead of at the first checkout, and seconds
+# before a provisioning job that got lost may be scheduled again
+PROVISION_STRIPE_CUSTOMERS = os.getenv("PROVISION_STRIPE_CUSTOMERS", "1") == "1"
+STRIPE_CUSTOMER_PROVISION_TIMEOUT = 300
+# seconds a saved card's details are cached (see payments/cards.py)
+CARD_DETAILS_CACHE_TTL = 300
+# bulk refunds (see payments/refunds.py): gateway refunds in flight at once,
+# orders updated per transaction, and order ids accepted per API request
+REFUND_CONCURRENCY = int(os.getenv("REFUND_CONCURRENCY", 8))
+REFUND_CHUNK_SIZE = 100
+REFUND_MAX_ORDERS = 500
+# charge every checkout in the background (clients can also ask per request
+# with a `Prefer: respond-async` header), see payments/charges.py
+CHECKOUT_ASYNC = os.getenv("CHECKOUT_ASYNC", "0") == "1"
+# minutes before `manage.py process_pending_charges` picks up a charge that is
+# still queued or processing
+CHARGE_RECOVERY_AFTER = 10
+# charges hitting transient gateway errors are retried after
+# CHARGE_RETRY_BASE_DELAY seconds, doubling up to CHARGE_RETRY_MAX_DELAY,
+# and the order is cancelled after CHARGE_MAX_ATTEMPTS attempts
+CHARGE_MAX_ATTEMPTS = int(os.getenv("CHARGE_MAX_ATTEMPTS", 6))
+CHARGE_RETRY_BASE_DELAY = 30
+CHARGE_RETRY_MAX_DELAY = 3600
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.2/howto/static-files/
@@ -194,3 +333,8 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # cors origin
 CORS_ALLOW_ALL_ORIGINS = True
+CORS_ALLOW_HEADERS = list(default_headers) + [
+    'idempotency-key',
+    'prefer',
+]
+CORS_EXPOSE_HEADERS = ['idempotent-replayed']
@@ -1,3 +1,14 @@
 from django.contrib import admin
+from .models import CardReconciliation, StripeCustomer
 
-# Register your models here.
+
+class StripeCustomerAdmin(admin.ModelAdmin):
+    list_display = ("id", "user", "customer_id", "email", "created_at")
+
+admin.site.register(StripeCustomer, StripeCustomerAdmin)
+
+
+class CardReconciliationAdmin(admin.ModelAdmin):
+    list_display = ("id", "started_at", "finished_at", "customers", "cards", "created", "updated", "deleted", "skipped")
+
+admin.site.register(CardReconciliation, CardReconciliationAdmin)
@@ -0,0 +1,60 @@
+"""
+Local card details.
+
+RetrieveCardView used to fetch the card from Stripe
+(`Customer.retrieve_source`) on every view of the card details page,
+although StripeModel already stores everything the page shows. Card
+details are now built from StripeModel and read through the Django cache;
+the cache entry is dropped whenever the card row is saved or deleted (see
+signals.py) and expires after CARD_DETAILS_CACHE_TTL seconds in any case,
+so reading card details never calls the gateway.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from account.models import StripeModel
+
+CACHE_KEY = "payments:card:{}:{}"
+
+# stored for cards that are not saved locally, so misses are cached too
+MISSING = "missing"
+
+
+def invalidate_card(user_id, card_id):
+    cache.delete(CACHE_KEY.format(user_id, card_id))
+
+
+def card_id_of(payment_method):
+    """The card id StripeModel stores for a gateway payment method."""
+    return payment_method.card.get("id") or payment_method.id
+
+
+def card_details(card):
+    """A StripeModel card in the shape of a Stripe card source."""
+    return {
+        "id": card.card_id,
+        "object": "card",
+        "customer": card.customer_id,
+        "name": card.name_on_card,
+        "last4": card.card_number[-4:],
+        "exp_month": int(card.exp_month),
+        "exp_year": int(card.exp_year),
+        "address_city": card.address_city,
+        "address_country": card.address_country,
+        "address_state": card.address_state,
+        "address_zip": card.address_zip,
+    }
+
+
+def get_card_details(user_id, customer_id, card_id):
+    """Details of a card saved by `user_id`, or None."""
+    key = CACHE_KEY.format(user_id, card_id)
+    details = cache.get(key)
+    if details is None:
+        card = StripeModel.objects.filter(user_id=user_id, card_id=card_id).first()
+        details = card_details(card) if card is not None else MISSING
+        cache.set(key, details, settings.CARD_DETAILS_CACHE_TTL)
+    if details == MISSING or details["customer"] != customer_id:
+        return None
+    return details
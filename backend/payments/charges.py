@@ -0,0 +1,187 @@
+"""
+Charging orders off the request thread.
+
+An async checkout (see ChargeCustomerView) stores the order as `pending`
+together with a queued Charge and returns right away; `process_charge`
+then creates the PaymentIntent on the background job pool and marks the
+order paid (or cancelled) when the gateway answers. Clients poll
+ChargeStatusView for the outcome.
+
+Transient gateway errors (connection errors, rate limits, an open
+circuit) do not fail the order: the charge is queued again for
+`next_attempt_at`, with exponential backoff and jitter, and never before
+the circuit breaker lets calls through again. Only after
+CHARGE_MAX_ATTEMPTS attempts that reached the gateway is the order
+cancelled. A synchronous checkout answers these errors right away, its
+client expects the order to be paid on a 2xx.
+
+Due retries and charges lost to a restart are picked up by `manage.py
+process_pending_charges` (the retry scheduler, run it every minute or with
+--interval). Every PaymentIntent is created with the charge's idempotency
+key, so re-running a charge that did reach the gateway returns the
+original PaymentIntent instead of charging again.
+"""
+
+import logging
+import random
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from account.models import OrderModel
+from my_project.background import run_in_background
+
+from .gateway import get_gateway
+from .models import Charge
+from .resilience import ClientRateLimited, GatewayUnavailable
+
+logger = logging.getLogger(__name__)
+
+# Stripe honours idempotency keys for 24 hours, charges are not retried
+# (or re-run) after that
+IDEMPOTENCY_WINDOW = timedelta(hours=23)
+
+# errors worth retrying later
+TRANSIENT_ERRORS = (
+    stripe.error.APIConnectionError,
+    stripe.error.RateLimitError,
+    GatewayUnavailable,
+)
+
+
+def reached_gateway(error):
+    """Whether a failed attempt was sent to the gateway at all."""
+    return not isinstance(error, (GatewayUnavailable, ClientRateLimited))
+
+
+def retry_delay(attempts):
+    """Seconds to wait after `attempts` failed attempts: exponential, with jitter."""
+    backoff = min(
+        settings.CHARGE_RETRY_MAX_DELAY,
+        settings.CHARGE_RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0),
+    )
+    # spread the retries of charges that failed together
+    return random.uniform(backoff / 2, backoff)
+
+
+def next_attempt(attempts, error):
+    delay = retry_delay(attempts)
+    if isinstance(error, GatewayUnavailable):
+        # no point before the circuit lets calls through again
+        delay = max(delay, error.retry_after)
+    return timezone.now() + timedelta(seconds=delay)
+
+
+def payment_intent_params(amount, customer_id, payment_method, description, metadata):
+    """Arguments of the off-session PaymentIntent that charges an order."""
+    return dict(
+        amount=int(amount * 100),  # Convert to cents
+        currency="inr",
+        customer=customer_id,
+        payment_method=payment_method,
+        off_session=True,
+        confirm=True,
+        description=description,
+        metadata=metadata,
+    )
+
+
+def queue_charge(order, customer_id, payment_method, description):
+    """Record a charge for `order` and run it after the transaction commits."""
+    charge = Charge.objects.create(
+        order=order,
+        user_id=order.user_id,
+        customer_id=customer_id,
+        payment_method=payment_method,
+        amount=order.total_price,
+        description=description,
+    )
+    run_in_background(process_charge, charge.id)
+    return charge
+
+
+def settle_order(order, new_status):
+    """
+    Move a charged order to `new_status` unless a webhook got there first;
+    `order` was loaded before the gateway call and may be stale.
+    """
+    OrderModel.objects.filter(id=order.id).transition(new_status, OrderModel.PAYMENT_TRANSITIONS)
+
+
+def fail_charge(charge, order, error):
+    with transaction.atomic():
+        charge.status = Charge.FAILED
+        charge.error = str(error)
+        charge.save(update_fields=["status", "error", "updated_at"])
+        settle_order(order, 'cancelled')
+
+
+def process_charge(charge_id):
+    """
+    Charge a queued charge and settle its order.
+
+    Returns False if the charge was not queued or not due yet (e.g. another
+    worker took it), or was queued again for a retry.
+    """
+    now = timezone.now()
+    claimed = Charge.objects.filter(id=charge_id, status=Charge.QUEUED).filter(
+        Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+    ).update(
+        status=Charge.PROCESSING, attempts=F("attempts") + 1, next_attempt_at=None, updated_at=now
+    )
+    if not claimed:
+        return False
+
+    charge = Charge.objects.select_related("order").get(id=charge_id)
+    order = charge.order
+    metadata = {
+        'user_id': str(charge.user_id),
+        'order_id': str(order.id),
+        'order_item': order.ordered_item,
+    }
+    if charge.payment_key:
+        # a retried checkout, the parameters must match its first attempt
+        del metadata['order_id']
+    params = payment_intent_params(
+        charge.amount,
+        charge.customer_id,
+        charge.payment_method,
+        charge.description,
+        metadata,
+    )
+
+    try:
+        payment_intent = get_gateway().create_payment_intent(idempotency_key=charge.idempotency_key, **params)
+    except TRANSIENT_ERRORS as e:
+        if not reached_gateway(e):
+            charge.attempts -= 1
+        if charge.attempts < settings.CHARGE_MAX_ATTEMPTS and now - charge.created_at < IDEMPOTENCY_WINDOW:
+            logger.warning(f"Charge {charge.id} of order {order.id} will be retried: {str(e)}")
+            Charge.objects.filter(id=charge.id).update(
+                status=Charge.QUEUED,
+                attempts=charge.attempts,
+                next_attempt_at=next_attempt(charge.attempts, e),
+                error=str(e),
+                updated_at=timezone.now(),
+            )
+            return False
+        logger.error(f"Charge {charge.id} of order {order.id} failed after {charge.attempts} attempt(s): {str(e)}")
+        fail_charge(charge, order, e)
+        return True
+    except stripe.error.StripeError as e:
+        logger.error(f"Charge {charge.id} of order {order.id} failed: {str(e)}")
+        fail_charge(charge, order, e)
+        return True
+
+    with transaction.atomic():
+        charge.status = Charge.SUCCEEDED
+        charge.payment_intent_id = payment_intent.id
+        charge.error = ""
+        charge.save(update_fields=["status", "payment_intent_id", "error", "updated_at"])
+        settle_order(order, 'paid')
+    logger.info(f"Order {order.id} paid by charge {charge.id}")
+    return True
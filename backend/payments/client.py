@@ -0,0 +1,75 @@
+"""
+HTTP client used by the stripe library.
+
+By default stripe opens a `requests.Session` per thread with an 80 second
+timeout and no retries. `configure_stripe()` (run from PaymentsConfig.ready)
+installs a client instead that:
+
+- shares one keep-alive connection pool per process, so checkouts reuse
+  open TLS connections to the gateway (a new pool is created after a fork,
+  worker processes never share sockets)
+- applies separate connect and read timeouts to every call
+- retries connection errors, 409s and 5xx responses with jittered
+  exponential backoff. stripe sends an Idempotency-Key with every POST,
+  so a retried charge is never applied twice.
+"""
+
+import os
+import threading
+
+import requests
+import stripe
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+class PooledRequestsClient(stripe.http_client.RequestsClient):
+    """stripe's requests client with a per-process pool and (connect, read) timeouts."""
+
+    def __init__(self, connect_timeout, read_timeout, pool_size, max_retries, **kwargs):
+        super().__init__(timeout=(connect_timeout, read_timeout), **kwargs)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self._pool_session = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def get_session(self):
+        """Return the process-wide session, creating a new one after a fork."""
+        if self._pool_session is None or self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool_session is None or self._pool_pid != os.getpid():
+                    session = requests.Session()
+                    # block instead of opening throwaway connections past the pool size
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._pool_session = session
+                    self._pool_pid = os.getpid()
+        return self._pool_session
+
+    def _request_internal(self, method, url, headers, post_data, is_streaming):
+        # the parent picks up the session from its thread local
+        self._thread_local.session = self.get_session()
+        return super()._request_internal(method, url, headers, post_data, is_streaming)
+
+    def _max_network_retries(self):
+        return self.max_retries
+
+    def close(self):
+        if self._pool_session is not None:
+            self._pool_session.close()
+            self._pool_session = None
+
+
+def configure_stripe():
+    """Point the stripe library at our key and the pooled client."""
+    stripe.api_key = getattr(settings, "STRIPE_TEST_SECRET_KEY", "")
+    stripe.default_http_client = PooledRequestsClient(
+        connect_timeout=settings.STRIPE_CONNECT_TIMEOUT,
+        read_timeout=settings.STRIPE_READ_TIMEOUT,
+        pool_size=settings.STRIPE_HTTP_POOL_SIZE,
+        max_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+        verify_ssl_certs=stripe.verify_ssl_certs,
+        proxy=stripe.proxy,
+    )
@@ -0,0 +1,178 @@
+"""
+Local user -> Stripe customer mapping.
+
+Checkout used to search the Stripe customers by email (`Customer.list`) on
+every request, a slow remote search that gets slower as the account grows.
+The customer id of each user is now kept in StripeCustomer and read through
+the Django cache, so a user with a known customer costs no Stripe call to
+look up. Users created before the mapping existed are found by email once
+and remembered (or backfilled with `manage.py backfill_stripe_customers`).
+
+The customer is provisioned in the background, off the checkout path:
+right after registration (the customer is simply created), and for users
+registered before that at their next login (searched by email first).
+"""
+
+import logging
+
+import stripe
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+
+from my_project.background import run_in_background
+
+from .gateway import get_gateway
+from .models import StripeCustomer
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = "payments:customer:{}"
+PROVISION_KEY = "payments:customer:provision:{}"
+
+
+def invalidate_customer(user_id):
+    cache.delete(CACHE_KEY.format(user_id))
+
+
+def get_customer_id(user_id):
+    """The Stripe customer id stored for `user_id`, or None."""
+    key = CACHE_KEY.format(user_id)
+    customer_id = cache.get(key)
+    if customer_id is None:
+        customer_id = (
+            StripeCustomer.objects.filter(user_id=user_id)
+            .values_list("customer_id", flat=True)
+            .first()
+        )
+        if customer_id is not None:
+            cache.set(key, customer_id, settings.STRIPE_CUSTOMER_CACHE_TTL)
+    return customer_id
+
+
+def remember_customer(user, customer_id, email=""):
+    """
+    Store `customer_id` as the Stripe customer of `user`.
+
+    A customer already stored for the user wins; returns the id that is
+    stored.
+    """
+    try:
+        with transaction.atomic():
+            mapping, created = StripeCustomer.objects.get_or_create(
+                user=user,
+                defaults={"customer_id": customer_id, "email": email or ""},
+            )
+    except IntegrityError:
+        # another request stored one in the meantime
+        mapping = StripeCustomer.objects.get(user=user)
+    return mapping.customer_id
+
+
+def forget_customer(customer_id):
+    """Drop the mapping to a Stripe customer that was deleted."""
+    StripeCustomer.objects.filter(customer_id=customer_id).delete()
+
+
+def is_missing_customer(error, customer_id):
+    """Whether gateway `error` says that Stripe customer `customer_id` does not exist."""
+    return (
+        isinstance(error, stripe.error.InvalidRequestError)
+        and f"No such customer: '{customer_id}'" in str(error)
+    )
+
+
+def replace_missing_customer(user, email, customer_id):
+    """
+    The Stripe customer of `user`, after Stripe said `customer_id` does not exist.
+
+    The id usually comes from the cache of a worker other than the one that
+    deleted the customer, so the database decides: a newer mapping is used
+    as is, a mapping to the missing customer is dropped. A new customer is
+    then provisioned for `email`; without an email, returns None.
+    """
+    invalidate_customer(user.id)
+    stored_id = get_customer_id(user.id)
+    if stored_id is not None and stored_id != customer_id:
+        return stored_id
+    if stored_id is not None:
+        logger.warning(f"Stripe customer {customer_id} of user {user.id} no longer exists")
+        forget_customer(customer_id)
+    if not email:
+        return None
+    return get_or_create_customer_id(user, email)
+
+
+def find_customer_id(user, email):
+    """
+    The Stripe customer of `user`, or None if they do not have one yet.
+
+    Falls back to searching Stripe by `email` for users that are not mapped
+    yet, and remembers what it finds.
+    """
+    customer_id = get_customer_id(user.id)
+    if customer_id is not None:
+        return customer_id
+
+    customer = get_gateway().find_customer(email)
+    if customer is None:
+        return None
+    logger.info(f"Mapped existing Stripe customer {customer['id']} to user {user.id}")
+    return remember_customer(user, customer["id"], email)
+
+
+def create_customer_id(user, email):
+    """Create a Stripe customer for `user` and store it; returns the stored id."""
+    gateway = get_gateway()
+    customer = gateway.create_customer(email, f"Customer for {user.username}")
+    logger.info(f"Created new customer: {customer['id']}")
+
+    customer_id = remember_customer(user, customer["id"], email)
+    if customer_id != customer["id"]:
+        # lost a race with a concurrent request, keep the stored customer
+        try:
+            gateway.delete_customer(customer["id"])
+        except stripe.error.StripeError as e:
+            logger.warning(f"Could not delete duplicate customer {customer['id']}: {str(e)}")
+    return customer_id
+
+
+def get_or_create_customer_id(user, email):
+    """The Stripe customer of `user`, created on Stripe if they have none."""
+    customer_id = find_customer_id(user, email)
+    if customer_id is not None:
+        return customer_id
+    return create_customer_id(user, email)
+
+
+def provision_customer(user_id, search=True):
+    """
+    Make sure `user_id` has a Stripe customer (background job).
+
+    New users have none to search for (`search=False`). Failures are only
+    logged, the customer is then provisioned at checkout as before.
+    """
+    try:
+        if get_customer_id(user_id) is not None:
+            return
+        user = User.objects.filter(id=user_id, is_active=True).first()
+        if user is None or not user.email:
+            return
+        if search:
+            get_or_create_customer_id(user, user.email)
+        else:
+            create_customer_id(user, user.email)
+    except stripe.error.StripeError as e:
+        logger.warning(f"Could not provision a Stripe customer for user {user_id}: {str(e)}")
+    finally:
+        cache.delete(PROVISION_KEY.format(user_id))
+
+
+def schedule_customer_provisioning(user, search=True):
+    """Provision the Stripe customer of `user` in the background, unless they have one."""
+    if not settings.PROVISION_STRIPE_CUSTOMERS or get_customer_id(user.id) is not None:
+        return
+    # one job per user at a time
+    if cache.add(PROVISION_KEY.format(user.id), 1, settings.STRIPE_CUSTOMER_PROVISION_TIMEOUT):
+        run_in_background(provision_customer, user.id, search)
@@ -0,0 +1,461 @@
+"""
+Payment gateway interface.
+
+Views and jobs talk to the payment gateway through `get_gateway()` instead
+of calling the stripe module directly. The implementation is picked with
+the PAYMENT_GATEWAY setting (a dotted path) and built with
+PAYMENT_GATEWAY_OPTIONS as keyword arguments:
+
+- StripeGateway: the real thing (default)
+- FakeGateway: an in-process, in-memory gateway with configurable latency
+  and injected failures, for load testing and profiling checkout without
+  the network, e.g.
+
+      PAYMENT_GATEWAY=payments.gateway.FakeGateway
+      PAYMENT_GATEWAY_OPTIONS='{"latency": 0.3, "error_rates": {"card_declined": 0.02}}'
+
+Method and parameter names follow the Stripe API, results are StripeObjects
+(attribute and key access) and failures are raised as the stripe library's
+exception classes (stripe.error.CardError, RateLimitError, ...) whatever
+the implementation, so callers handle errors the same way for both.
+
+Whatever the implementation, calls go through the circuit breakers,
+bulkhead and rate limiter of resilience.py.
+"""
+
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .resilience import GuardedGateway
+
+
+class PaymentGateway:
+    """The gateway operations the shop uses."""
+
+    # listings are fetched a page at a time (list_*); the iter_* helpers page
+    # through them with whatever `self` is, so behind GuardedGateway every
+    # page fetch is guarded. The first page is fetched by the iter_* call.
+    PAGE_SIZE = 100
+
+    def _iter_pages(self, list_page, starting_after=None, **params):
+        page = list_page(starting_after=starting_after, limit=self.PAGE_SIZE, **params)
+
+        def items(page):
+            while True:
+                yield from page.data
+                if not page.has_more or not page.data:
+                    return
+                page = list_page(starting_after=page.data[-1].id, limit=self.PAGE_SIZE, **params)
+
+        return items(page)
+
+    # customers
+    def find_customer(self, email):
+        """The newest customer with `email`, or None."""
+        raise NotImplementedError
+
+    def list_customers(self, starting_after=None, limit=100):
+        """A page of customers (after customer `starting_after`), newest first."""
+        raise NotImplementedError
+
+    def iter_customers(self, starting_after=None):
+        """Every customer (after customer `starting_after`), newest first."""
+        return self._iter_pages(self.list_customers, starting_after)
+
+    def create_customer(self, email, description=""):
+        raise NotImplementedError
+
+    def delete_customer(self, customer_id):
+        raise NotImplementedError
+
+    def set_default_payment_method(self, customer_id, payment_method_id):
+        raise NotImplementedError
+
+    # payment methods
+    def attach_payment_method(self, payment_method_id, customer_id):
+        raise NotImplementedError
+
+    def retrieve_payment_method(self, payment_method_id):
+        raise NotImplementedError
+
+    def list_payment_methods(self, customer_id, starting_after=None, limit=100):
+        """A page of the card payment methods of a customer."""
+        raise NotImplementedError
+
+    def iter_payment_methods(self, customer_id):
+        """Every card payment method of a customer."""
+        return self._iter_pages(self.list_payment_methods, customer_id=customer_id)
+
+    # payment intents
+    def create_payment_intent(self, idempotency_key=None, **params):
+        raise NotImplementedError
+
+    # card sources
+    def retrieve_source(self, customer_id, card_id):
+        raise NotImplementedError
+
+    def modify_source(self, customer_id, card_id, **fields):
+        raise NotImplementedError
+
+    def delete_source(self, customer_id, card_id):
+        raise NotImplementedError
+
+    # refunds
+    def create_refund(self, payment_intent_id, amount=None, idempotency_key=None):
+        """Refund `amount` (smallest currency unit, default everything) of a payment."""
+        raise NotImplementedError
+
+    # webhooks
+    def parse_webhook(self, payload, signature):
+        """
+        Verify and decode a webhook delivery.
+
+        Raises ValueError for a malformed payload,
+        stripe.error.SignatureVerificationError for a bad signature and
+        ImproperlyConfigured when signatures cannot be verified at all.
+        """
+        raise NotImplementedError
+
+
+def _idempotency(idempotency_key):
+    return {"idempotency_key": idempotency_key} if idempotency_key else {}
+
+
+class StripeGateway(PaymentGateway):
+    """Calls Stripe through the stripe library (and its pooled client, see client.py)."""
+
+    def find_customer(self, email):
+        customers = stripe.Customer.list(email=email, limit=1).data
+        return customers[0] if customers else None
+
+    def list_customers(self, starting_after=None, limit=100):
+        params = {"starting_after": starting_after} if starting_after else {}
+        return stripe.Customer.list(limit=limit, **params)
+
+    def create_customer(self, email, description=""):
+        return stripe.Customer.create(email=email, description=description)
+
+    def delete_customer(self, customer_id):
+        return stripe.Customer.delete(customer_id)
+
+    def set_default_payment_method(self, customer_id, payment_method_id):
+        return stripe.Customer.modify(
+            customer_id,
+            invoice_settings={"default_payment_method": payment_method_id},
+        )
+
+    def attach_payment_method(self, payment_method_id, customer_id):
+        return stripe.PaymentMethod.attach(payment_method_id, customer=customer_id)
+
+    def retrieve_payment_method(self, payment_method_id):
+        return stripe.PaymentMethod.retrieve(payment_method_id)
+
+    def list_payment_methods(self, customer_id, starting_after=None, limit=100):
+        params = {"starting_after": starting_after} if starting_after else {}
+        return stripe.PaymentMethod.list(customer=customer_id, type="card", limit=limit, **params)
+
+    def create_payment_intent(self, idempotency_key=None, **params):
+        return stripe.PaymentIntent.create(**params, **_idempotency(idempotency_key))
+
+    def retrieve_source(self, customer_id, card_id):
+        return stripe.Customer.retrieve_source(customer_id, card_id)
+
+    def modify_source(self, customer_id, card_id, **fields):
+        return stripe.Customer.modify_source(customer_id, card_id, **fields)
+
+    def delete_source(self, customer_id, card_id):
+        return stripe.Customer.delete_source(customer_id, card_id)
+
+    def create_refund(self, payment_intent_id, amount=None, idempotency_key=None):
+        params = {"payment_intent": payment_intent_id}
+        if amount is not None:
+            params["amount"] = amount
+        return stripe.Refund.create(**params, **_idempotency(idempotency_key))
+
+    def parse_webhook(self, payload, signature):
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            # an empty secret verifies signatures anyone can make
+            raise ImproperlyConfigured("STRIPE_WEBHOOK_SECRET is not set, webhooks cannot be verified")
+        return stripe.Webhook.construct_event(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+
+
+class FakeGateway(PaymentGateway):
+    """
+    In-memory gateway for load tests.
+
+    Every call sleeps `latency` seconds (plus up to `jitter` more) and may
+    fail with the probabilities in `error_rates`:
+
+    - "card_declined": creating a payment intent raises CardError
+    - "rate_limit": any call raises RateLimitError
+    - "connection_error": any call raises APIConnectionError
+
+    The payment method "pm_card_chargeDeclined" is always declined, like in
+    Stripe's test mode. Idempotency keys are honoured. State lives in the
+    process and is lost on restart.
+    """
+
+    DECLINED_PAYMENT_METHOD = "pm_card_chargeDeclined"
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rates=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rates = dict(error_rates or {})
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.customers = {}
+        self.payment_methods = {}
+        self.sources = {}
+        self.intents = {}
+        self.refunds = {}
+        self.replies = {}
+
+    def _object(self, data):
+        return stripe.util.convert_to_stripe_object(data)
+
+    def _new_id(self, prefix):
+        return f"{prefix}_fake_{next(self.ids)}"
+
+    def _fails(self, kind):
+        rate = self.error_rates.get(kind, 0)
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def _call(self):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if self._fails("connection_error"):
+            raise stripe.error.APIConnectionError("Could not connect to the payment gateway (injected).")
+        if self._fails("rate_limit"):
+            raise stripe.error.RateLimitError("Too many requests (injected).", http_status=429)
+
+    def _missing(self, kind, object_id):
+        return stripe.error.InvalidRequestError(f"No such {kind}: '{object_id}'", kind, http_status=404)
+
+    def _replay(self, idempotency_key, create):
+        if not idempotency_key:
+            return create()
+        with self.lock:
+            if idempotency_key in self.replies:
+                return self.replies[idempotency_key]
+        reply = create()
+        with self.lock:
+            return self.replies.setdefault(idempotency_key, reply)
+
+    def find_customer(self, email):
+        self._call()
+        matches = [c for c in self.customers.values() if c["email"] == email]
+        return matches[-1] if matches else None
+
+    def _page(self, objects, kind, starting_after, limit):
+        if starting_after is not None:
+            ids = [obj.id for obj in objects]
+            if starting_after not in ids:
+                raise self._missing(kind, starting_after)
+            objects = objects[ids.index(starting_after) + 1:]
+        return self._object({"object": "list", "data": objects[:limit], "has_more": len(objects) > limit})
+
+    def list_customers(self, starting_after=None, limit=100):
+        self._call()
+        with self.lock:
+            customers = list(reversed(list(self.customers.values())))
+        return self._page(customers, "customer", starting_after, limit)
+
+    def create_customer(self, email, description=""):
+        self._call()
+        customer = self._object({
+            "id": self._new_id("cus"), "object": "customer", "email": email,
+            "description": description, "invoice_settings": {"default_payment_method": None},
+        })
+        with self.lock:
+            self.customers[customer.id] = customer
+        return customer
+
+    def delete_customer(self, customer_id):
+        self._call()
+        with self.lock:
+            if self.customers.pop(customer_id, None) is None:
+                raise self._missing("customer", customer_id)
+        return self._object({"id": customer_id, "object": "customer", "deleted": True})
+
+    def set_default_payment_method(self, customer_id, payment_method_id):
+        self._call()
+        customer = self.customers.get(customer_id)
+        if customer is None:
+            raise self._missing("customer", customer_id)
+        customer.invoice_settings["default_payment_method"] = payment_method_id
+        return customer
+
+    def _payment_method(self, payment_method_id):
+        with self.lock:
+            if payment_method_id not in self.payment_methods:
+                number = "4000000000000002" if payment_method_id == self.DECLINED_PAYMENT_METHOD else "4242424242424242"
+                self.payment_methods[payment_method_id] = self._object({
+                    "id": payment_method_id, "object": "payment_method", "customer": None,
+                    "card": {
+                        "id": payment_method_id.replace("pm_", "card_", 1), "brand": "visa",
+                        "number": number, "last4": number[-4:], "exp_month": 12, "exp_year": 2034,
+                    },
+                })
+            return self.payment_methods[payment_method_id]
+
+    def attach_payment_method(self, payment_method_id, customer_id):
+        self._call()
+        if customer_id not in self.customers:
+            raise self._missing("customer", customer_id)
+        payment_method = self._payment_method(payment_method_id)
+        payment_method.customer = customer_id
+        card = payment_method.card
+        with self.lock:
+            self.sources[(customer_id, card.id)] = self._object({
+                "id": card.id, "object": "card", "customer": customer_id, "brand": card.brand,
+                "last4": card.last4, "exp_month": card.exp_month, "exp_year": card.exp_year, "name": None,
+                "address_city": None, "address_country": None, "address_state": None, "address_zip": None,
+            })
+        return payment_method
+
+    def retrieve_payment_method(self, payment_method_id):
+        self._call()
+        return self._payment_method(payment_method_id)
+
+    def list_payment_methods(self, customer_id, starting_after=None, limit=100):
+        self._call()
+        with self.lock:
+            payment_methods = [pm for pm in self.payment_methods.values() if pm.customer == customer_id]
+        return self._page(payment_methods, "payment_method", starting_after, limit)
+
+    def create_payment_intent(self, idempotency_key=None, **params):
+        self._call()
+
+        def create():
+            if params.get("confirm") and (
+                params.get("payment_method") == self.DECLINED_PAYMENT_METHOD or self._fails("card_declined")
+            ):
+                raise stripe.error.CardError("Your card was declined.", "payment_method", "card_declined", http_status=402)
+            intent = self._object({
+                "id": self._new_id("pi"), "object": "payment_intent",
+                "status": "succeeded" if params.get("confirm") else "requires_confirmation",
+                "amount_received": params["amount"] if params.get("confirm") else 0,
+                **params,
+            })
+            with self.lock:
+                self.intents[intent.id] = intent
+            return intent
+
+        return self._replay(idempotency_key, create)
+
+    def retrieve_source(self, customer_id, card_id):
+        self._call()
+        source = self.sources.get((customer_id, card_id))
+        if source is None:
+            raise self._missing("source", card_id)
+        return source
+
+    def modify_source(self, customer_id, card_id, **fields):
+        source = self.retrieve_source(customer_id, card_id)
+        source.update(fields)
+        return source
+
+    def delete_source(self, customer_id, card_id):
+        self._call()
+        with self.lock:
+            if self.sources.pop((customer_id, card_id), None) is None:
+                raise self._missing("source", card_id)
+        return self._object({"id": card_id, "object": "card", "deleted": True})
+
+    def create_refund(self, payment_intent_id, amount=None, idempotency_key=None):
+        self._call()
+
+        def create():
+            intent = self.intents.get(payment_intent_id)
+            if intent is None:
+                raise self._missing("payment_intent", payment_intent_id)
+            refund = self._object({
+                "id": self._new_id("re"), "object": "refund", "payment_intent": payment_intent_id,
+                "amount": intent.amount_received if amount is None else amount, "status": "succeeded",
+            })
+            with self.lock:
+                self.refunds[refund.id] = refund
+            return refund
+
+        return self._replay(idempotency_key, create)
+
+    def parse_webhook(self, payload, signature):
+        # nothing to verify, the events come from the load test itself
+        return self._object(json.loads(payload))
+
+
+_gateway = None
+_gateway_config = None
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def submit_call(func, *args, **kwargs):
+    """
+    Start a gateway call on a thread and return its Future.
+
+    Lets a request make independent gateway calls concurrently, or do its
+    own database work while one is in flight. The pool
+    (GATEWAY_CALL_WORKERS threads per process) is meant for gateway calls
+    only: the threads have no database connection of their own.
+    """
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        with _lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.GATEWAY_CALL_WORKERS,
+                    thread_name_prefix="gateway-call",
+                )
+                _executor_pid = os.getpid()
+    return _executor.submit(func, *args, **kwargs)
+
+
+def get_gateway():
+    """The configured gateway, shared by the whole process."""
+    global _gateway, _gateway_config
+
+    config = (
+        os.getpid(),  # a forked worker gets fresh breakers and limits
+        settings.PAYMENT_GATEWAY,
+        repr(settings.PAYMENT_GATEWAY_OPTIONS),
+        settings.GATEWAY_BREAKER_FAILURES,
+        settings.GATEWAY_BREAKER_RESET,
+        settings.GATEWAY_BULKHEAD_SIZE,
+        settings.GATEWAY_BULKHEAD_TIMEOUT,
+        settings.GATEWAY_RATE_LIMIT,
+        settings.GATEWAY_RATE_BURST,
+        settings.GATEWAY_RATE_LIMIT_WAIT,
+    )
+    if _gateway is None or _gateway_config != config:
+        with _lock:
+            if _gateway is None or _gateway_config != config:
+                _gateway = GuardedGateway(
+                    import_string(settings.PAYMENT_GATEWAY)(**settings.PAYMENT_GATEWAY_OPTIONS),
+                    failure_threshold=settings.GATEWAY_BREAKER_FAILURES,
+                    reset_timeout=settings.GATEWAY_BREAKER_RESET,
+                    bulkhead_size=settings.GATEWAY_BULKHEAD_SIZE,
+                    bulkhead_timeout=settings.GATEWAY_BULKHEAD_TIMEOUT,
+                    rate=settings.GATEWAY_RATE_LIMIT,
+                    burst=settings.GATEWAY_RATE_BURST,
+                    rate_wait=settings.GATEWAY_RATE_LIMIT_WAIT,
+                )
+                _gateway_config = config
+    return _gateway
@@ -0,0 +1,71 @@
+"""
+Fill the user -> Stripe customer table for users who are not mapped yet.
+
+Customer ids are taken from the users' saved cards first; the rest are
+matched by email against one paged listing of the Stripe customers (the
+newest customer wins, like the old per-request email search did):
+
+    python manage.py backfill_stripe_customers
+    python manage.py backfill_stripe_customers --cards-only
+"""
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from account.deletion import NO_CUSTOMER_ID
+from account.models import StripeModel
+from payments.gateway import get_gateway
+from payments.models import StripeCustomer
+
+
+class Command(BaseCommand):
+    help = "Map users to their existing Stripe customers."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--cards-only",
+            action="store_true",
+            help="Only use the customer ids of saved cards, do not list the Stripe customers.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500, help="Rows inserted per query.")
+
+    def store(self, mappings, batch_size):
+        StripeCustomer.objects.bulk_create(mappings, batch_size=batch_size, ignore_conflicts=True)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        before = StripeCustomer.objects.count()
+
+        # newest card first, the first customer seen per user wins
+        mapped = set(StripeCustomer.objects.values_list("user_id", flat=True))
+        mappings = []
+        cards = (
+            StripeModel.objects.exclude(customer_id=NO_CUSTOMER_ID)
+            .order_by("-created_at")
+            .values_list("user_id", "customer_id", "email")
+        )
+        for user_id, customer_id, email in cards.iterator():
+            if user_id not in mapped:
+                mapped.add(user_id)
+                mappings.append(StripeCustomer(user_id=user_id, customer_id=customer_id, email=email))
+        self.store(mappings, batch_size)
+
+        if not options["cards_only"]:
+            unmapped = {}
+            users = User.objects.filter(stripe_customer__isnull=True).exclude(email="")
+            for user_id, email in users.values_list("id", "email").iterator():
+                unmapped.setdefault(email.lower(), user_id)
+
+            # Stripe lists customers newest first
+            mappings = []
+            for customer in get_gateway().iter_customers():
+                email = (customer.get("email") or "").lower()
+                user_id = unmapped.pop(email, None)
+                if user_id is not None:
+                    mappings.append(StripeCustomer(user_id=user_id, customer_id=customer["id"], email=email))
+                if not unmapped:
+                    break
+            self.store(mappings, batch_size)
+
+        added = StripeCustomer.objects.count() - before
+        self.stdout.write(self.style.SUCCESS(f"Mapped {added} user(s) to Stripe customers."))
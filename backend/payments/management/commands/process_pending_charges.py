@@ -0,0 +1,84 @@
+"""
+Run async checkout charges that are due: retries of charges that hit a
+transient gateway error, and charges that did not complete in the
+background.
+
+Charges normally run right after checkout; this is the retry scheduler and
+picks up the ones lost to a restart or a crash. Run it every minute (e.g.
+from cron), or keep it running:
+
+    python manage.py process_pending_charges
+    python manage.py process_pending_charges --interval 15
+
+A charge that was already sent to Stripe is re-sent with the same
+idempotency key, which Stripe honours for 24 hours; charges stuck for
+longer than that are marked failed for manual review instead. While the
+gateway's circuit breaker is open no charge is attempted.
+"""
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from payments.charges import IDEMPOTENCY_WINDOW, process_charge
+from payments.gateway import get_gateway
+from payments.models import Charge
+
+
+class Command(BaseCommand):
+    help = "Charge due retries and queued or interrupted async checkout charges."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=settings.CHARGE_RECOVERY_AFTER,
+            help="Only pick up charges untouched for at least this many minutes (retries run when due).",
+        )
+        parser.add_argument(
+            "--interval",
+            type=int,
+            help="Keep running, looking for due charges every this many seconds.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.process(options["min_age"])
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
+
+    def process(self, min_age):
+        now = timezone.now()
+        cutoff = now - timedelta(minutes=min_age)
+
+        stuck = Charge.objects.filter(status=Charge.PROCESSING, updated_at__lte=cutoff)
+        expired = stuck.filter(created_at__lte=now - IDEMPOTENCY_WINDOW).update(
+            status=Charge.FAILED, error="Interrupted, check the payment in Stripe", updated_at=now
+        )
+        interrupted = list(stuck.values_list("id", flat=True))
+        Charge.objects.filter(id__in=interrupted).update(status=Charge.QUEUED)
+
+        queued = Charge.objects.filter(status=Charge.QUEUED).filter(
+            Q(next_attempt_at__isnull=True, updated_at__lte=cutoff) | Q(next_attempt_at__lte=now)
+        )
+        charge_ids = interrupted + list(queued.exclude(id__in=interrupted).order_by("updated_at").values_list("id", flat=True))
+
+        gateway = get_gateway()
+        processed = 0
+        paused = ""
+        for charge_id in charge_ids:
+            if not gateway.available("create_payment_intent"):
+                paused = " Paused, the payment gateway's circuit is open."
+                break
+            if process_charge(charge_id):
+                processed += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {processed} charge(s), {len(interrupted)} of them interrupted; "
+            f"{expired} too old to retry.{paused}"
+        ))
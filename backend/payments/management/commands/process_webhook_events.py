@@ -0,0 +1,24 @@
+"""
+Apply stored webhook events.
+
+Events are normally applied in the background right after they arrive;
+this drains whatever is left (e.g. after a restart, or events whose worker
+died). Run it periodically (e.g. from cron):
+
+    python manage.py process_webhook_events
+"""
+
+from django.core.management.base import BaseCommand
+
+from payments.webhooks import process_pending_events
+
+
+class Command(BaseCommand):
+    help = "Apply pending gateway webhook events to the orders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Events applied per batch.")
+
+    def handle(self, *args, **options):
+        applied = process_pending_events(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Applied {applied} webhook event(s)."))
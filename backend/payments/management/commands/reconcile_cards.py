@@ -0,0 +1,35 @@
+"""
+Bring the saved cards in line with the gateway.
+
+Continues the current reconciliation pass (or starts one) and prints how
+far the saved cards had drifted. Run it periodically (e.g. from cron),
+optionally a slice at a time:
+
+    python manage.py reconcile_cards
+    python manage.py reconcile_cards --max-customers 1000
+"""
+
+from django.core.management.base import BaseCommand
+
+from payments.reconciliation import reconcile_cards
+
+
+class Command(BaseCommand):
+    help = "Reconcile the saved cards with the gateway customers' payment methods."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-customers", type=int, help="Stop after this many customers, resume next run.")
+        parser.add_argument("--page-size", type=int, default=100, help="Customers reconciled per transaction.")
+        parser.add_argument("--restart", action="store_true", help="Abandon the unfinished pass and start over.")
+
+    def handle(self, *args, **options):
+        run = reconcile_cards(options["max_customers"], options["page_size"], options["restart"])
+        if run is None:
+            self.stdout.write(self.style.WARNING("A reconciliation is already running."))
+            return
+
+        state = "finished" if run.finished_at else f"paused after {run.cursor}"
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciliation {run.id} {state}: {run.customers} customer(s), {run.cards} card(s); "
+            f"drift: {run.created} added, {run.updated} updated, {run.deleted} deleted, {run.skipped} skipped."
+        ))
@@ -0,0 +1,43 @@
+"""
+Refund many orders at once.
+
+Takes order ids on the command line or from a file (one id per line) and
+prints a result per order:
+
+    python manage.py refund_orders 12 13 14
+    python manage.py refund_orders --ids-file cancelled.txt --concurrency 16
+
+Running it again for the same orders is safe, refunds are idempotent.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.refunds import refund_orders
+
+
+class Command(BaseCommand):
+    help = "Refund the payments of the given orders and mark them refunded."
+
+    def add_arguments(self, parser):
+        parser.add_argument("order_ids", nargs="*", type=int, help="Ids of the orders to refund.")
+        parser.add_argument("--ids-file", help="File with one order id per line.")
+        parser.add_argument("--concurrency", type=int, help="Gateway refunds in flight at once.")
+
+    def handle(self, *args, **options):
+        order_ids = list(options["order_ids"])
+        if options["ids_file"]:
+            with open(options["ids_file"]) as f:
+                try:
+                    order_ids += [int(line) for line in f if line.strip()]
+                except ValueError as e:
+                    raise CommandError(f"Invalid order id in {options['ids_file']}: {e}")
+        if not order_ids:
+            raise CommandError("Give order ids or --ids-file.")
+
+        results = refund_orders(order_ids, options["concurrency"])
+        for result in results:
+            details = result.get("error") or result.get("refund_id") or result.get("from_status") or ""
+            self.stdout.write(f"{result['id']}\t{result['result']}\t{details}".rstrip())
+
+        refunded = sum(1 for result in results if result["result"] == "refunded")
+        self.stdout.write(self.style.SUCCESS(f"Refunded {refunded} of {len(results)} order(s)."))
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeCustomer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer_id', models.CharField(help_text='Stripe customer ID', max_length=200, unique=True)),
+                ('email', models.EmailField(blank=True, help_text='Email the Stripe customer was created with', max_length=254)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.OneToOneField(help_text='User this Stripe customer belongs to', on_delete=django.db.models.deletion.CASCADE, related_name='stripe_customer', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Stripe Customer',
+                'verbose_name_plural': 'Stripe Customers',
+            },
+        ),
+    ]
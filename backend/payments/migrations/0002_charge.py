@@ -0,0 +1,43 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0030_account_deletion'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('payments', '0001_stripe_customer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Charge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer_id', models.CharField(help_text='Stripe customer ID', max_length=200)),
+                ('payment_method', models.CharField(help_text='Stripe payment method ID', max_length=200)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('payment_intent_id', models.CharField(blank=True, max_length=200)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order', models.OneToOneField(help_text='Order paid by this charge', on_delete=django.db.models.deletion.CASCADE, related_name='charge', to='account.ordermodel')),
+                ('user', models.ForeignKey(help_text='User being charged', on_delete=django.db.models.deletion.CASCADE, related_name='charges', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Charge',
+                'verbose_name_plural': 'Charges',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['status', 'updated_at'], name='charge_status_updated_idx'),
+        ),
+    ]
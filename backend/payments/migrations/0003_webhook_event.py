@@ -0,0 +1,41 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_charge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('type', models.CharField(max_length=100)),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('claimed_by', models.CharField(blank=True, max_length=64)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name': 'Webhook Event',
+                'verbose_name_plural': 'Webhook Events',
+            },
+        ),
+        migrations.AlterField(
+            model_name='charge',
+            name='payment_intent_id',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(fields=['processed_at', 'received_at'], name='webhook_pending_idx'),
+        ),
+    ]
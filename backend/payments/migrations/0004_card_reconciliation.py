@@ -0,0 +1,34 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0003_webhook_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardReconciliation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('cursor', models.CharField(blank=True, help_text='Last gateway customer reconciled', max_length=200)),
+                ('customers', models.PositiveIntegerField(default=0, help_text='Gateway customers compared')),
+                ('cards', models.PositiveIntegerField(default=0, help_text='Gateway cards compared')),
+                ('created', models.PositiveIntegerField(default=0, help_text='Cards missing locally, added')),
+                ('updated', models.PositiveIntegerField(default=0, help_text='Saved cards that differed, updated')),
+                ('deleted', models.PositiveIntegerField(default=0, help_text='Saved cards gone from the gateway, deleted')),
+                ('skipped', models.PositiveIntegerField(default=0, help_text='Cards missing locally that could not be added (unknown user or card number)')),
+            ],
+            options={
+                'verbose_name': 'Card Reconciliation',
+                'verbose_name_plural': 'Card Reconciliations',
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
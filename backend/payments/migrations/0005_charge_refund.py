@@ -0,0 +1,23 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_card_reconciliation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charge',
+            name='refund_id',
+            field=models.CharField(blank=True, help_text='Stripe refund ID (see payments/refunds.py)', max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='charge',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('succeeded', 'Succeeded'), ('failed', 'Failed'), ('refunded', 'Refunded')], default='queued', max_length=20),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0005_charge_refund'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charge',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, help_text='When a charge queued for a retry is due', null=True),
+        ),
+        migrations.AddField(
+            model_name='charge',
+            name='payment_key',
+            field=models.CharField(blank=True, help_text="Idempotency key of a checkout's first PaymentIntent attempt, reused by its retries", max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='charge_status_next_idx'),
+        ),
+    ]
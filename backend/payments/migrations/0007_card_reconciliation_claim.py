@@ -0,0 +1,23 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_charge_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cardreconciliation',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cardreconciliation',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -1,3 +1,205 @@
+"""
+Payment models.
+
+- StripeCustomer: The Stripe customer of each user
+- Charge: The gateway payment of an order
+- WebhookEvent: Gateway events waiting to be applied
+- CardReconciliation: A pass comparing the saved cards with the gateway
+"""
+
+from django.contrib.auth.models import User
 from django.db import models
 
-# Create your models here.
+from account.models import OrderModel
+
+
+class StripeCustomer(models.Model):
+    """
+    The Stripe customer a user's cards and charges belong to.
+
+    Looked up through payments/customers.py (cached) instead of searching
+    Stripe customers by email on every checkout. Filled in when the customer
+    is created and backfilled with `manage.py backfill_stripe_customers`.
+    """
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name="stripe_customer",
+        help_text="User this Stripe customer belongs to"
+    )
+    customer_id = models.CharField(
+        max_length=200,
+        unique=True,
+        help_text="Stripe customer ID"
+    )
+    email = models.EmailField(
+        blank=True,
+        help_text="Email the Stripe customer was created with"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Stripe Customer"
+        verbose_name_plural = "Stripe Customers"
+
+    def __str__(self):
+        return f"{self.user} - {self.customer_id}"
+
+
+class Charge(models.Model):
+    """
+    The gateway payment of an order.
+
+    Holds everything needed to create the PaymentIntent, so an async
+    checkout can be charged (and re-run) by a worker after the request
+    has returned; see payments/charges.py. The PaymentIntent is created
+    with an idempotency key derived from the charge id, so running a
+    charge twice never charges the card twice. Synchronous checkouts
+    record their (succeeded) charge too, so webhooks and refunds can find
+    the order of a PaymentIntent. Charges that hit a transient gateway
+    error are queued again for `next_attempt_at`.
+    """
+
+    QUEUED = 'queued'
+    PROCESSING = 'processing'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    REFUNDED = 'refunded'
+
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (PROCESSING, 'Processing'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+        (REFUNDED, 'Refunded'),
+    ]
+
+    order = models.OneToOneField(
+        OrderModel,
+        on_delete=models.CASCADE,
+        related_name="charge",
+        help_text="Order paid by this charge"
+    )
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="charges",
+        help_text="User being charged"
+    )
+    customer_id = models.CharField(max_length=200, help_text="Stripe customer ID")
+    payment_method = models.CharField(max_length=200, help_text="Stripe payment method ID")
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    description = models.CharField(max_length=255, blank=True)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    payment_intent_id = models.CharField(max_length=200, blank=True, db_index=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When a charge queued for a retry is due"
+    )
+    payment_key = models.CharField(
+        max_length=100,
+        blank=True,
+        help_text="Idempotency key of a checkout's first PaymentIntent attempt, reused by its retries"
+    )
+    refund_id = models.CharField(max_length=200, blank=True, help_text="Stripe refund ID (see payments/refunds.py)")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Charge"
+        verbose_name_plural = "Charges"
+        # unfinished charges are picked up oldest first by process_pending_charges
+        indexes = [
+            models.Index(fields=['status', 'updated_at'], name='charge_status_updated_idx'),
+            # and retries once they are due
+            models.Index(fields=['status', 'next_attempt_at'], name='charge_status_next_idx'),
+        ]
+
+    def __str__(self):
+        return f"Charge of order #{self.order_id} ({self.status})"
+
+    @property
+    def idempotency_key(self):
+        return self.payment_key or f"order-charge-{self.id}"
+
+    @property
+    def refund_idempotency_key(self):
+        return f"order-refund-{self.id}"
+
+
+class WebhookEvent(models.Model):
+    """
+    A gateway webhook event, stored as received and applied later in
+    batches (see payments/webhooks.py). The unique event id drops
+    deliveries the gateway repeats.
+    """
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    # set while a worker is applying the event, cleared again if it fails
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = "Webhook Event"
+        verbose_name_plural = "Webhook Events"
+        # the worker reads unprocessed events oldest first
+        indexes = [
+            models.Index(fields=['processed_at', 'received_at'], name='webhook_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.type} {self.event_id}"
+
+
+class CardReconciliation(models.Model):
+    """
+    A pass over the gateway customers comparing their cards with StripeModel
+    (see payments/reconciliation.py).
+
+    A pass is done in slices: `cursor` is the last customer reconciled, so
+    the next slice (or a run after a crash) resumes where it stopped. The
+    counters say how far the saved cards had drifted from the gateway.
+    `claimed_by` is the worker working on the pass right now.
+    """
+
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    cursor = models.CharField(max_length=200, blank=True, help_text="Last gateway customer reconciled")
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    customers = models.PositiveIntegerField(default=0, help_text="Gateway customers compared")
+    cards = models.PositiveIntegerField(default=0, help_text="Gateway cards compared")
+    created = models.PositiveIntegerField(default=0, help_text="Cards missing locally, added")
+    updated = models.PositiveIntegerField(default=0, help_text="Saved cards that differed, updated")
+    deleted = models.PositiveIntegerField(default=0, help_text="Saved cards gone from the gateway, deleted")
+    skipped = models.PositiveIntegerField(
+        default=0, help_text="Cards missing locally that could not be added (unknown user or card number)"
+    )
+
+    class Meta:
+        verbose_name = "Card Reconciliation"
+        verbose_name_plural = "Card Reconciliations"
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"Card reconciliation {self.started_at:%Y-%m-%d %H:%M}"
+
+    @property
+    def drift(self):
+        """Saved cards that did not match the gateway."""
+        return self.created + self.updated + self.deleted + self.skipped
@@ -0,0 +1,253 @@
+"""
+Reconciliation of the saved cards (StripeModel) with the gateway.
+
+Saved cards drift from the gateway: saving a new card is best effort in
+CreateCardTokenView, cards change or disappear on the gateway side, and
+so on. Instead of calling the gateway live to be safe, `reconcile_cards`
+(run from cron with `manage.py reconcile_cards`) pages through the gateway
+customers and their card payment methods and brings StripeModel in line
+with a few bulk queries per page of customers:
+
+- cards missing locally are added, when the customer belongs to a known
+  user and the gateway gives the card number;
+- saved cards whose expiry, name or billing address differ are updated
+  (fields the gateway has no value for are left alone);
+- saved cards the gateway no longer has are deleted, including, at the end
+  of a pass, the cards of customers the gateway no longer lists at all.
+
+A pass is recorded in a CardReconciliation row holding the drift counters
+and a cursor (the last customer done), so it can be spread over several
+runs with `max_customers` and resumes after a crash.
+
+Only one worker at a time works on a pass, on any host: a run claims the
+row with a conditional UPDATE (like the webhook events, see webhooks.py)
+and renews the claim with every page. A claim left by a worker that died
+expires after CLAIM_TIMEOUT seconds.
+"""
+
+import logging
+import uuid
+from datetime import timedelta
+from itertools import islice
+
+import stripe
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from account.deletion import NO_CUSTOMER_ID
+from account.models import StripeModel
+
+from .cards import card_id_of, invalidate_card
+from .gateway import get_gateway
+from .models import CardReconciliation, StripeCustomer
+
+logger = logging.getLogger(__name__)
+
+# seconds without a page done after which a pass can be claimed again
+CLAIM_TIMEOUT = 3600
+
+RUN_FIELDS = (
+    "cursor", "customers", "cards", "created", "updated", "deleted", "skipped",
+    "finished_at", "claimed_by", "claimed_at", "updated_at",
+)
+
+
+class RunTakenOver(Exception):
+    """The claim on a pass expired and another worker holds it now."""
+
+
+def remote_card(payment_method):
+    """StripeModel field values of a gateway card payment method."""
+    card = payment_method.card
+    billing = payment_method.get("billing_details") or {}
+    address = billing.get("address") or {}
+    return {
+        "exp_month": f"{int(card.exp_month):02d}",
+        "exp_year": str(card.exp_year),
+        "name_on_card": billing.get("name") or "",
+        "address_city": address.get("city") or "",
+        "address_country": address.get("country") or "",
+        "address_state": address.get("state") or "",
+        "address_zip": address.get("postal_code") or "",
+    }
+
+
+def unfinished_run():
+    return CardReconciliation.objects.filter(finished_at__isnull=True).order_by("id").first()
+
+
+def claim_run(restart=False):
+    """
+    Claim the unfinished pass to continue, or a new one. None if another
+    worker holds the unfinished pass.
+    """
+    run = unfinished_run()
+    if run is None:
+        created = CardReconciliation.objects.create()
+        # workers starting a pass at the same time all go for the oldest one
+        run = unfinished_run()
+        if run.id != created.id:
+            created.delete()
+
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    stale = now - timedelta(seconds=CLAIM_TIMEOUT)
+    claimed = CardReconciliation.objects.filter(id=run.id, finished_at__isnull=True).filter(
+        Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale)
+    ).update(claimed_by=token, claimed_at=now)
+    if not claimed:
+        return None
+    run.refresh_from_db()
+
+    if restart:
+        run = restart_run(run)
+    return run
+
+
+def restart_run(run):
+    """Close a claimed pass unfinished and claim a new one in its place."""
+    run.finished_at = timezone.now()
+    save_run(run)
+    return CardReconciliation.objects.create(claimed_by=run.claimed_by, claimed_at=run.finished_at)
+
+
+def save_run(run):
+    """Save a claimed pass and renew the claim."""
+    now = timezone.now()
+    run.claimed_at = now
+    run.updated_at = now
+    saved = CardReconciliation.objects.filter(id=run.id, claimed_by=run.claimed_by).update(
+        **{field: getattr(run, field) for field in RUN_FIELDS}
+    )
+    if not saved:
+        raise RunTakenOver(f"Card reconciliation {run.id} was taken over by another worker")
+
+
+def release_run(run):
+    CardReconciliation.objects.filter(id=run.id, claimed_by=run.claimed_by).update(claimed_by="", claimed_at=None)
+
+
+def reconcile_page(run, customers):
+    """Reconcile the saved cards of a page of gateway customers."""
+    gateway = get_gateway()
+    now = timezone.now()
+    customer_ids = [customer.id for customer in customers]
+
+    users = dict(StripeCustomer.objects.filter(customer_id__in=customer_ids).values_list("customer_id", "user_id"))
+    local = {}
+    for card in StripeModel.objects.filter(customer_id__in=customer_ids):
+        local[(card.customer_id, card.card_id)] = card
+        users.setdefault(card.customer_id, card.user_id)
+
+    remote = {}
+    for customer in customers:
+        for payment_method in gateway.iter_payment_methods(customer.id):
+            remote[(customer.id, card_id_of(payment_method))] = (customer, payment_method)
+
+    created, updated, fields, skipped = [], [], set(), 0
+    for (customer_id, card_id), (customer, payment_method) in remote.items():
+        values = remote_card(payment_method)
+        card = local.pop((customer_id, card_id), None)
+        if card is None:
+            user_id = users.get(customer_id)
+            number = payment_method.card.get("number")
+            if user_id is None or not number:
+                skipped += 1
+                continue
+            created.append(StripeModel(
+                user_id=user_id,
+                email=customer.get("email") or "",
+                customer_id=customer_id,
+                card_id=card_id,
+                card_number=number,
+                reconciled_at=now,
+                **values,
+            ))
+            continue
+
+        changed = [field for field, value in values.items() if value and getattr(card, field) != value]
+        if changed:
+            for field in changed:
+                setattr(card, field, values[field])
+            card.updated_at = now
+            updated.append(card)
+            fields.update(changed)
+
+    with transaction.atomic():
+        # a card number saved for another customer stays where it is
+        StripeModel.objects.bulk_create(created, ignore_conflicts=True)
+        if updated:
+            StripeModel.objects.bulk_update(updated, sorted(fields) + ["updated_at"])
+        deleted = list(local.values())
+        if deleted:
+            StripeModel.objects.filter(id__in=[card.id for card in deleted]).delete()
+        StripeModel.objects.filter(customer_id__in=customer_ids).update(reconciled_at=now)
+
+        run.cursor = customer_ids[-1]
+        run.customers += len(customers)
+        run.cards += len(remote)
+        run.created += len(created)
+        run.updated += len(updated)
+        run.deleted += len(deleted)
+        run.skipped += skipped
+        # rolls the page back if the pass is not ours any more
+        save_run(run)
+
+    # bulk queries send no signals, drop the cached details here
+    for card in created + updated:
+        invalidate_card(card.user_id, card.card_id)
+
+
+def finish_run(run):
+    """Delete the cards of customers the pass did not meet, and close it."""
+    orphans = StripeModel.objects.filter(created_at__lt=run.started_at).exclude(customer_id=NO_CUSTOMER_ID).filter(
+        Q(reconciled_at__isnull=True) | Q(reconciled_at__lt=run.started_at)
+    )
+    with transaction.atomic():
+        deleted, _ = orphans.delete()
+        run.deleted += deleted
+        run.finished_at = timezone.now()
+        save_run(run)
+
+
+def reconcile_cards(max_customers=None, page_size=100, restart=False):
+    """
+    Continue (or start) a reconciliation pass.
+
+    Stops after `max_customers` customers, the next call carries on from
+    there. Returns the CardReconciliation, or None if another worker is
+    on the pass right now.
+    """
+    run = claim_run(restart)
+    if run is None:
+        return None
+    try:
+        try:
+            customers = get_gateway().iter_customers(starting_after=run.cursor or None)
+        except stripe.error.InvalidRequestError:
+            # the customer the pass stopped at is gone, start over
+            logger.warning(f"Cannot resume card reconciliation {run.id} after {run.cursor}, restarting")
+            run = restart_run(run)
+            customers = get_gateway().iter_customers()
+
+        done = 0
+        while max_customers is None or done < max_customers:
+            size = page_size if max_customers is None else min(page_size, max_customers - done)
+            page = list(islice(customers, size))
+            if page:
+                reconcile_page(run, page)
+                done += len(page)
+            if len(page) < size:
+                finish_run(run)
+                logger.info(
+                    f"Card reconciliation {run.id} finished: {run.customers} customers, {run.cards} cards, "
+                    f"{run.created} added, {run.updated} updated, {run.deleted} deleted, {run.skipped} skipped"
+                )
+                break
+        return run
+    except RunTakenOver as e:
+        logger.warning(str(e))
+        return None
+    finally:
+        release_run(run)
@@ -0,0 +1,232 @@
+"""
+Guards around the payment gateway calls.
+
+`get_gateway()` wraps the configured gateway in a GuardedGateway, so every
+call goes through, in this order:
+
+- a circuit breaker per operation (create_payment_intent, retrieve_source,
+  ...): after GATEWAY_BREAKER_FAILURES consecutive connection errors,
+  timeouts, rate limits or gateway 5xx, calls fail fast for
+  GATEWAY_BREAKER_RESET seconds, then a single trial call decides whether
+  the circuit closes again;
+- a bulkhead: at most GATEWAY_BULKHEAD_SIZE calls in flight per process, so
+  a slow gateway ties up that many workers and no more, and browsing
+  endpoints keep being served;
+- a token bucket keeping the outbound request rate under
+  GATEWAY_RATE_LIMIT per second (bursts of GATEWAY_RATE_BURST), waiting at
+  most GATEWAY_RATE_LIMIT_WAIT seconds for a token.
+
+An open circuit or a full bulkhead raises GatewayUnavailable (a
+StripeError, so existing handlers keep working); views answer it with 503
+and a Retry-After header. Running out of rate budget raises
+ClientRateLimited, a RateLimitError like the one the gateway itself would
+send, without the round trip; views answer it the same way. The state
+lives in the process, like the HTTP pool (see client.py).
+"""
+
+import logging
+import math
+import threading
+import time
+
+import stripe
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayUnavailable(stripe.error.StripeError):
+    """The gateway is not called: its circuit is open or too many calls are in flight."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message, http_status=503)
+        self.retry_after = max(1, int(round(retry_after)))
+
+
+class ClientRateLimited(stripe.error.RateLimitError):
+    """Our own outbound rate limit was hit, the gateway was not called."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message, http_status=429)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+# failures that say the gateway is in trouble, rather than the request
+# (declined cards and invalid requests do not count)
+BREAKER_ERRORS = (
+    stripe.error.APIConnectionError,
+    stripe.error.RateLimitError,
+    stripe.error.APIError,
+)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self):
+        """Raise GatewayUnavailable unless a call may go through now."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self.opened_at + self.reset_timeout - self.clock()
+            if self.state == self.OPEN and remaining <= 0:
+                # let one trial call through
+                self.state = self.HALF_OPEN
+                return
+            raise GatewayUnavailable(
+                f"Payment gateway unavailable ({self.name}), please try again later.",
+                retry_after=max(remaining, 1),
+            )
+
+    def allows_calls(self):
+        """Whether a call would go through now (without taking the trial call)."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            return self.state == self.OPEN and self.opened_at + self.reset_timeout <= self.clock()
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit {self.name} closed")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit {self.name} opened after {self.failures} failure(s)")
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+    def release(self):
+        """The call ended without telling anything about the gateway's health."""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                # give the next caller the trial
+                self.state = self.OPEN
+                self.opened_at = self.clock() - self.reset_timeout
+
+
+class Bulkhead:
+    """Bounds the number of gateway calls in flight."""
+
+    def __init__(self, size, timeout):
+        self.timeout = timeout
+        self.semaphore = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        if not self.semaphore.acquire(timeout=self.timeout):
+            raise GatewayUnavailable("Payment gateway is busy, please try again later.")
+
+    def release(self):
+        self.semaphore.release()
+
+
+class TokenBucket:
+    """`rate` calls per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst, max_wait, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.updated_at = clock()
+
+    def acquire(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if wait > self.max_wait:
+                raise ClientRateLimited("Too many payment gateway requests, please try again later.", retry_after=wait)
+            # reserve the token now, callers queue up behind each other
+            self.tokens -= 1
+        if wait:
+            self.sleep(wait)
+
+
+class GuardedGateway:
+    """Runs the calls of `gateway` through the breakers, the bulkhead and the rate limiter."""
+
+    # operations that never leave the process
+    UNGUARDED = {"parse_webhook"}
+
+    def __init__(self, gateway, failure_threshold, reset_timeout, bulkhead_size, bulkhead_timeout,
+                 rate, burst, rate_wait):
+        self.gateway = gateway
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.bulkhead = Bulkhead(bulkhead_size, bulkhead_timeout)
+        self.limiter = TokenBucket(rate, burst, rate_wait)
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, operation):
+        with self.lock:
+            if operation not in self.breakers:
+                self.breakers[operation] = CircuitBreaker(operation, self.failure_threshold, self.reset_timeout)
+            return self.breakers[operation]
+
+    def available(self, operation):
+        """Whether the circuit of `operation` lets calls through right now."""
+        return self.breaker(operation).allows_calls()
+
+    def call(self, operation, *args, **kwargs):
+        breaker = self.breaker(operation)
+        breaker.before_call()
+        try:
+            # wait for a token before taking a slot: a caller sleeping on the
+            # rate limit must not hold a slot
+            self.limiter.acquire()
+            self.bulkhead.acquire()
+            try:
+                result = getattr(self.gateway, operation)(*args, **kwargs)
+            finally:
+                self.bulkhead.release()
+        except (GatewayUnavailable, ClientRateLimited):
+            # never reached the gateway
+            breaker.release()
+            raise
+        except BREAKER_ERRORS:
+            breaker.record_failure()
+            raise
+        except stripe.error.StripeError:
+            # declined, invalid, not found, ...: the gateway did answer
+            breaker.record_success()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self.gateway, name)
+        if name.startswith("iter_"):
+            # paging helpers run against the guard, so each page fetch is guarded
+            return getattr(type(self.gateway), name).__get__(self)
+        if name.startswith("_") or name in self.UNGUARDED or not callable(attr):
+            return attr
+
+        def guarded(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        return guarded
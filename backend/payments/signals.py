@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from account.models import StripeModel
+
+from .cards import invalidate_card
+from .customers import invalidate_customer
+from .models import StripeCustomer
+
+
+@receiver(post_save, sender=StripeCustomer)
+@receiver(post_delete, sender=StripeCustomer)
+def stripe_customer_changed(sender, instance, **kwargs):
+    invalidate_customer(instance.user_id)
+
+
+@receiver(post_save, sender=StripeModel)
+@receiver(post_delete, sender=StripeModel)
+def card_changed(sender, instance, **kwargs):
+    invalidate_card(instance.user_id, instance.card_id)
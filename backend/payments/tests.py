@@ -1,3 +1,928 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from threading import Thread, current_thread
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+import stripe
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from account.models import OrderModel, SalesRollup, StripeModel
+from product.models import Product
+from .charges import process_charge, retry_delay
+from .client import PooledRequestsClient
+from .customers import CACHE_KEY, get_customer_id
+from .gateway import FakeGateway, get_gateway
+from .models import CardReconciliation, Charge, StripeCustomer, WebhookEvent
+from .reconciliation import reconcile_cards
+from .refunds import refund_orders
+from .resilience import Bulkhead, CircuitBreaker, ClientRateLimited, GatewayUnavailable, GuardedGateway, TokenBucket
+
+
+class FreshGatewayMixin:
+    """A fresh in-memory gateway (and cache) for every test."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        patcher = mock.patch("payments.gateway._gateway", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class StripeCustomerMappingTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        self.product = Product.objects.create(name="Mouse", price=Decimal("10.00"))
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch("payments.views.stripe.Customer.modify")
+    @mock.patch("payments.views.stripe.PaymentMethod.attach")
+    @mock.patch("payments.customers.stripe.Customer.create", return_value={"id": "cus_new"})
+    @mock.patch("payments.customers.stripe.Customer.list", return_value=SimpleNamespace(data=[]))
+    def test_customer_created_once_and_stored(self, list_customers, create_customer, attach, modify):
+        data = {"email": "buyer@gmail.com", "payment_method_id": "pm_card_visa"}
+        for _ in range(2):
+            response = self.client.post("/api/payments/create-card/", data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data["customer_id"], "cus_new")
+
+        self.assertEqual(list_customers.call_count, 1)
+        self.assertEqual(create_customer.call_count, 1)
+        self.assertEqual(StripeCustomer.objects.get(user=self.user).customer_id, "cus_new")
+
+    @mock.patch("payments.views.stripe.PaymentIntent.create", return_value=SimpleNamespace(id="pi_1"))
+    @mock.patch("payments.customers.stripe.Customer.list")
+    def test_charge_does_not_search_customers(self, list_customers, create_intent):
+        StripeCustomer.objects.create(user=self.user, customer_id="cus_known")
+        data = {
+            "email": "buyer@gmail.com",
+            "payment_method": "pm_card_visa",
+            "name": "buyer",
+            "address": "somewhere on earth",
+            "product_id": self.product.id,
+        }
+        response = self.client.post("/api/payments/charge-customer/", data)
+
+        self.assertEqual(response.status_code, 200)
+        list_customers.assert_not_called()
+        self.assertEqual(create_intent.call_args.kwargs["customer"], "cus_known")
+        self.assertTrue(OrderModel.objects.filter(user=self.user, paid_status=True).exists())
+
+    def test_cached_mapping_invalidated_on_delete(self):
+        mapping = StripeCustomer.objects.create(user=self.user, customer_id="cus_known")
+        self.assertEqual(get_customer_id(self.user.id), "cus_known")
+        mapping.delete()
+        self.assertIsNone(get_customer_id(self.user.id))
+
+
+class BackfillStripeCustomersTest(TestCase):
+
+    def setUp(self):
+        self.carded = User.objects.create_user(username="carded", email="carded@gmail.com")
+        self.listed = User.objects.create_user(username="listed", email="Listed@gmail.com")
+        StripeModel.objects.create(
+            user = self.carded,
+            email = "carded@gmail.com",
+            name_on_card = "carded",
+            customer_id = "cus_card",
+            card_number = "1234123412341234",
+            exp_month = "08",
+            exp_year = "2030",
+            card_id = "card_1",
+        )
+
+    @mock.patch("payments.gateway.stripe.Customer.list")
+    def test_backfill_from_cards_and_stripe(self, list_customers):
+        list_customers.side_effect = [
+            stripe.util.convert_to_stripe_object({"object": "list", "has_more": True, "data": [
+                {"id": "cus_other", "email": "other@gmail.com"},
+            ]}),
+            stripe.util.convert_to_stripe_object({"object": "list", "has_more": True, "data": [
+                {"id": "cus_newest", "email": "listed@gmail.com"},
+                {"id": "cus_older", "email": "listed@gmail.com"},
+            ]}),
+        ]
+        out = StringIO()
+        call_command("backfill_stripe_customers", stdout=out)
+
+        self.assertIn("Mapped 2 user(s)", out.getvalue())
+        self.assertEqual(StripeCustomer.objects.get(user=self.carded).customer_id, "cus_card")
+        self.assertEqual(StripeCustomer.objects.get(user=self.listed).customer_id, "cus_newest")
+        # paged explicitly, and not past the last unmapped user
+        self.assertEqual(list_customers.call_args_list, [
+            mock.call(limit=100), mock.call(limit=100, starting_after="cus_other"),
+        ])
+
+
+class PooledRequestsClientTest(TestCase):
+
+    def test_configured_as_stripe_client(self):
+        self.assertIsInstance(stripe.default_http_client, PooledRequestsClient)
+
+    @mock.patch.object(requests.Session, "request")
+    def test_one_session_per_process_with_timeouts(self, request):
+        request.return_value = mock.Mock(content=b"{}", status_code=200, headers={})
+        client = PooledRequestsClient(connect_timeout=1, read_timeout=5, pool_size=2, max_retries=0)
+
+        sessions = []
+        def call():
+            client.request("get", "https://api.stripe.com/v1/customers", {})
+            sessions.append(client._thread_local.session)
+        threads = [Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len({id(session) for session in sessions}), 1)
+        self.assertEqual(request.call_args.kwargs["timeout"], (1, 5))
+
+        # a forked worker gets its own pool
+        with mock.patch("payments.client.os.getpid", return_value=-1):
+            self.assertIsNot(client.get_session(), sessions[0])
+
+
+@override_settings(BACKGROUND_JOBS_EAGER=True)
+class AsyncCheckoutTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        StripeCustomer.objects.create(user=self.user, customer_id="cus_known")
+        self.product = Product.objects.create(name="Mouse", price=Decimal("10.00"))
+        self.client.force_authenticate(user=self.user)
+        self.data = {
+            "email": "buyer@gmail.com",
+            "payment_method": "pm_card_visa",
+            "name": "buyer",
+            "address": "somewhere on earth",
+            "product_id": self.product.id,
+        }
+
+    def checkout(self):
+        return self.client.post("/api/payments/charge-customer/", self.data, HTTP_PREFER="respond-async")
+
+    @mock.patch("payments.charges.stripe.PaymentIntent.create", return_value=SimpleNamespace(id="pi_1"))
+    def test_order_accepted_then_paid(self, create_intent):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.checkout()
+            self.assertEqual(response.status_code, 202)
+            order_id = response.data["data"]["order_id"]
+            self.assertEqual(OrderModel.objects.get(id=order_id).status, "pending")
+            create_intent.assert_not_called()
+
+        charge = Charge.objects.get(order_id=order_id)
+        self.assertEqual(create_intent.call_args.kwargs["idempotency_key"], charge.idempotency_key)
+        self.assertEqual(create_intent.call_args.kwargs["amount"], 1000)
+
+        response = self.client.get(f"/api/payments/charge-status/{order_id}/")
+        self.assertEqual(response.data["status"], "paid")
+        self.assertEqual(response.data["charge_status"], Charge.SUCCEEDED)
+        self.assertEqual(response.data["payment_intent_id"], "pi_1")
+
+    @mock.patch("payments.charges.stripe.PaymentIntent.create")
+    def test_declined_charge_cancels_order(self, create_intent):
+        create_intent.side_effect = stripe.error.CardError("Your card was declined.", None, "card_declined")
+        with self.captureOnCommitCallbacks(execute=True):
+            order_id = self.checkout().data["data"]["order_id"]
+
+        order = OrderModel.objects.get(id=order_id)
+        self.assertEqual(order.status, "cancelled")
+        self.assertFalse(order.paid_status)
+        self.assertEqual(Charge.objects.get(order=order).status, Charge.FAILED)
+
+    @mock.patch("payments.charges.stripe.PaymentIntent.create", return_value=SimpleNamespace(id="pi_1"))
+    def test_lost_charges_are_recovered(self, create_intent):
+        # the background job never ran
+        order_id = self.checkout().data["data"]["order_id"]
+        Charge.objects.filter(order_id=order_id).update(status=Charge.PROCESSING)
+
+        out = StringIO()
+        call_command("process_pending_charges", "--min-age", "0", stdout=out)
+        self.assertIn("Processed 1 charge(s), 1 of them interrupted", out.getvalue())
+        self.assertTrue(OrderModel.objects.get(id=order_id).paid_status)
+
+    @mock.patch("payments.charges.stripe.PaymentIntent.create")
+    def test_webhook_applied_first(self, create_intent):
+        order_id = self.checkout().data["data"]["order_id"]
+
+        def webhook_then_answer(**params):
+            # the payment_intent.succeeded webhook beat the gateway's answer
+            OrderModel.objects.filter(id=order_id).transition("paid", OrderModel.PAYMENT_TRANSITIONS)
+            return SimpleNamespace(id="pi_1")
+
+        create_intent.side_effect = webhook_then_answer
+        process_charge(Charge.objects.get(order_id=order_id).id)
+        rollups = dict(SalesRollup.objects.values_list("status", "order_count"))
+        self.assertEqual((rollups["pending"], rollups["paid"]), (0, 1))
+
+
+class IdempotentChargeTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        StripeCustomer.objects.create(user=self.user, customer_id="cus_known")
+        self.product = Product.objects.create(name="Mouse", price=Decimal("10.00"))
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch("payments.views.stripe.PaymentIntent.create", return_value=SimpleNamespace(id="pi_1"))
+    def test_double_submit_charges_once(self, create_intent):
+        data = {
+            "email": "buyer@gmail.com",
+            "payment_method": "pm_card_visa",
+            "name": "buyer",
+            "address": "somewhere on earth",
+            "product_id": self.product.id,
+        }
+        for _ in range(2):
+            response = self.client.post("/api/payments/charge-customer/", data, HTTP_IDEMPOTENCY_KEY="checkout-1")
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(create_intent.call_count, 1)
+        self.assertEqual(OrderModel.objects.filter(user=self.user).count(), 1)
+
+
+@override_settings(PAYMENT_GATEWAY="payments.gateway.FakeGateway", PAYMENT_GATEWAY_OPTIONS={})
+class FakeGatewayCheckoutTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        self.product = Product.objects.create(name="Mouse", price=Decimal("10.00"))
+        self.client.force_authenticate(user=self.user)
+
+    def checkout(self, payment_method):
+        self.client.post("/api/payments/create-card/", {"email": "buyer@gmail.com", "payment_method_id": payment_method})
+        return self.client.post("/api/payments/charge-customer/", {
+            "email": "buyer@gmail.com",
+            "payment_method": payment_method,
+            "name": "buyer",
+            "address": "somewhere on earth",
+            "product_id": self.product.id,
+        })
+
+    def test_checkout_without_network(self):
+        response = self.checkout("pm_card_visa")
+        self.assertEqual(response.status_code, 200)
+        payment_intent = get_gateway().intents[response.data["data"]["payment_intent_id"]]
+        self.assertEqual(payment_intent.amount, 1000)
+        self.assertEqual(payment_intent.customer, StripeCustomer.objects.get(user=self.user).customer_id)
+
+    def test_declined_card(self):
+        response = self.checkout(FakeGateway.DECLINED_PAYMENT_METHOD)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(OrderModel.objects.exists())
+
+    def test_injected_rate_limit(self):
+        with self.settings(PAYMENT_GATEWAY_OPTIONS={"error_rates": {"rate_limit": 1}}):
+            response = self.checkout("pm_card_visa")
+        self.assertEqual(response.status_code, 429)
+
+    def test_idempotency_keys_are_honoured(self):
+        gateway = FakeGateway()
+        customer = gateway.create_customer("buyer@gmail.com")
+        params = dict(amount=1000, currency="inr", customer=customer.id, payment_method="pm_card_visa", confirm=True)
+        first = gateway.create_payment_intent(idempotency_key="k1", **params)
+        self.assertEqual(gateway.create_payment_intent(idempotency_key="k1", **params).id, first.id)
+        self.assertNotEqual(gateway.create_payment_intent(**params).id, first.id)
+        self.assertEqual(gateway.create_refund(first.id, idempotency_key="r1").amount, 1000)
+
+
+@override_settings(
+    PAYMENT_GATEWAY="payments.gateway.FakeGateway", PAYMENT_GATEWAY_OPTIONS={}, BACKGROUND_JOBS_EAGER=True
+)
+class StripeWebhookTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        self.orders = [
+            OrderModel.objects.create(user=self.user, name="buyer", total_price=Decimal("10.00"), status=status)
+            for status in ("pending", "pending", "paid")
+        ]
+        Charge.objects.create(
+            order=self.orders[2], user=self.user, customer_id="cus_1", payment_method="pm_card_visa",
+            amount=Decimal("10.00"), status=Charge.SUCCEEDED, payment_intent_id="pi_paid",
+        )
+
+    def event(self, event_id, event_type, obj):
+        return {"id": event_id, "type": event_type, "data": {"object": obj}}
+
+    def deliver(self, event):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post("/api/payments/webhook/", event, format="json")
+
+    def test_events_update_orders(self):
+        pending, failed, paid = self.orders
+        events = [
+            self.event("evt_1", "payment_intent.succeeded", {"id": "pi_a", "metadata": {"order_id": str(pending.id)}}),
+            self.event("evt_2", "payment_intent.payment_failed", {"id": "pi_b", "metadata": {"order_id": str(failed.id)}}),
+            self.event("evt_3", "charge.refunded", {"id": "ch_1", "payment_intent": "pi_paid", "refunded": True}),
+            self.event("evt_4", "customer.created", {"id": "cus_2"}),
+        ]
+        for event in events:
+            self.assertEqual(self.deliver(event).status_code, 200)
+
+        for order in self.orders:
+            order.refresh_from_db()
+        self.assertEqual(pending.status, "paid")
+        self.assertTrue(pending.paid_status)
+        self.assertEqual(failed.status, "cancelled")
+        self.assertEqual(paid.status, "refunded")
+        self.assertFalse(WebhookEvent.objects.filter(processed_at__isnull=True).exists())
+
+    def test_duplicate_deliveries_are_stored_once(self):
+        event = self.event("evt_1", "charge.dispute.created", {"id": "dp_1", "payment_intent": "pi_paid"})
+        self.deliver(event)
+        self.deliver(event)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.assertEqual(OrderModel.objects.get(id=self.orders[2].id).status, "disputed")
+
+    def store_succeeded_events(self, count):
+        for _ in range(count):
+            order = OrderModel.objects.create(user=self.user, name="buyer", total_price=Decimal("10.00"), status="pending")
+            event_id = f"evt_order_{order.id}"
+            WebhookEvent.objects.create(
+                event_id=event_id, type="payment_intent.succeeded",
+                payload=self.event(event_id, "payment_intent.succeeded", {"id": f"pi_{order.id}", "metadata": {"order_id": str(order.id)}}),
+            )
+
+    def test_events_are_applied_in_batches(self):
+        # the background job never ran
+        self.store_succeeded_events(2)
+        out = StringIO()
+        with CaptureQueriesContext(connection) as small_batch:
+            call_command("process_webhook_events", "--batch-size", "50", stdout=out)
+        self.assertIn("Applied 2 webhook event(s).", out.getvalue())
+
+        # the same queries however many events are in the batch
+        self.store_succeeded_events(4)
+        with CaptureQueriesContext(connection) as large_batch:
+            call_command("process_webhook_events", "--batch-size", "50", stdout=StringIO())
+        self.assertEqual(len(large_batch), len(small_batch))
+        self.assertEqual(OrderModel.objects.filter(status="paid").count(), 7)
+
+    def test_bad_event_does_not_block_its_batch(self):
+        pending = self.orders[0]
+        self.deliver(self.event("evt_1", "payment_intent.succeeded", {"id": "pi_x", "metadata": {"order_id": "ORD-7"}}))
+        self.deliver(self.event("evt_2", "charge.dispute.created", "not an object"))
+        self.deliver(self.event("evt_3", "payment_intent.succeeded", {"id": "pi_a", "metadata": {"order_id": str(pending.id)}}))
+
+        self.assertEqual(OrderModel.objects.get(id=pending.id).status, "paid")
+        self.assertFalse(WebhookEvent.objects.filter(processed_at__isnull=True).exists())
+        self.assertIn("ORD-7", WebhookEvent.objects.get(event_id="evt_1").error)
+        self.assertTrue(WebhookEvent.objects.get(event_id="evt_2").error.startswith("Skipped"))
+        self.assertEqual(WebhookEvent.objects.get(event_id="evt_3").error, "")
+
+    def test_payload_that_is_not_an_event_is_rejected(self):
+        for payload in ([1, 2], {"type": "customer.created"}, {"id": 5, "type": "customer.created"}, "evt"):
+            response = self.client.post("/api/payments/webhook/", payload, format="json")
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_bad_signature_is_rejected(self):
+        with self.settings(PAYMENT_GATEWAY="payments.gateway.StripeGateway", STRIPE_WEBHOOK_SECRET="whsec_test"):
+            response = self.client.post(
+                "/api/payments/webhook/", self.event("evt_1", "customer.created", {}),
+                format="json", HTTP_STRIPE_SIGNATURE="t=1,v1=forged",
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_empty_secret_refuses_webhooks(self):
+        payload = json.dumps(self.event("evt_1", "payment_intent.succeeded", {
+            "id": "pi_a", "metadata": {"order_id": str(self.orders[0].id)},
+        }))
+        timestamp = int(time.time())
+        # a valid signature for an empty secret
+        signature = hmac.new(b"", f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+        with self.settings(PAYMENT_GATEWAY="payments.gateway.StripeGateway", STRIPE_WEBHOOK_SECRET=""):
+            response = self.client.post(
+                "/api/payments/webhook/", payload, content_type="application/json",
+                HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}",
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(WebhookEvent.objects.exists())
+        self.assertEqual(OrderModel.objects.get(id=self.orders[0].id).status, "pending")
+
+
+class GatewayGuardTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        self.client.force_authenticate(user=self.user)
+
+    def test_breaker_opens_and_recovers(self):
+        now = [0.0]
+        breaker = CircuitBreaker("create_payment_intent", failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+        for _ in range(2):
+            breaker.before_call()
+            breaker.record_failure()
+        with self.assertRaises(GatewayUnavailable) as raised:
+            breaker.before_call()
+        self.assertEqual(raised.exception.retry_after, 30)
+
+        # one trial call after the timeout, the others still fail fast
+        now[0] = 31
+        breaker.before_call()
+        with self.assertRaises(GatewayUnavailable):
+            breaker.before_call()
+        breaker.record_success()
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_rate_limiter_waits_then_gives_up(self):
+        now, slept = [0.0], []
+        bucket = TokenBucket(rate=10, burst=2, max_wait=0.15, clock=lambda: now[0], sleep=slept.append)
+        bucket.acquire()
+        bucket.acquire()
+        bucket.acquire()
+        self.assertAlmostEqual(slept[-1], 0.1)
+        with self.assertRaises(ClientRateLimited):
+            bucket.acquire()
+
+    @override_settings(GATEWAY_RATE_LIMIT=0.1, GATEWAY_RATE_BURST=1, GATEWAY_RATE_LIMIT_WAIT=0)
+    @mock.patch("payments.views.stripe.Customer.modify_source", return_value={"id": "card_1"})
+    def test_rate_limited_card_update_returns_503(self, modify_source):
+        data = {"customer_id": "cus_1", "card_id": "card_1", "name_on_card": "buyer"}
+        self.assertEqual(self.client.post("/api/payments/update-card/", data).status_code, 200)
+
+        response = self.client.post("/api/payments/update-card/", data)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "10")
+        self.assertEqual(modify_source.call_count, 1)
+
+    def test_full_bulkhead_fails_fast(self):
+        bulkhead = Bulkhead(size=1, timeout=0)
+        bulkhead.acquire()
+        with self.assertRaises(GatewayUnavailable):
+            bulkhead.acquire()
+        bulkhead.release()
+        bulkhead.acquire()
+
+    def test_every_page_of_a_listing_is_guarded(self):
+        gateway = GuardedGateway(FakeGateway(), failure_threshold=5, reset_timeout=30, bulkhead_size=1,
+                                 bulkhead_timeout=0, rate=100, burst=100, rate_wait=0)
+        for number in range(5):
+            gateway.gateway.create_customer(f"buyer{number}@gmail.com")
+        with mock.patch.object(FakeGateway, "PAGE_SIZE", 2), \
+                mock.patch.object(gateway, "call", wraps=gateway.call) as call:
+            customers = list(gateway.iter_customers())
+        self.assertEqual(len(customers), 5)
+        self.assertEqual(len({customer.id for customer in customers}), 5)
+        self.assertEqual([c.args[0] for c in call.call_args_list], ["list_customers"] * 3)
+
+    def test_rate_limit_wait_does_not_hold_a_bulkhead_slot(self):
+        gateway = GuardedGateway(FakeGateway(), failure_threshold=5, reset_timeout=30, bulkhead_size=1,
+                                 bulkhead_timeout=0, rate=100, burst=100, rate_wait=0)
+        slot_free = []
+
+        def acquire():
+            slot_free.append(gateway.bulkhead.semaphore.acquire(blocking=False))
+            gateway.bulkhead.semaphore.release()
+
+        with mock.patch.object(gateway.limiter, "acquire", side_effect=acquire):
+            gateway.find_customer("buyer@gmail.com")
+        self.assertEqual(slot_free, [True])
+
+    @override_settings(GATEWAY_BREAKER_FAILURES=2)
+    @mock.patch("payments.views.stripe.Customer.modify_source")
+    def test_open_circuit_returns_503(self, modify_source):
+        modify_source.side_effect = stripe.error.APIConnectionError("Connection reset")
+        data = {"customer_id": "cus_1", "card_id": "card_1", "name_on_card": "buyer"}
+        for _ in range(2):
+            self.assertEqual(self.client.post("/api/payments/update-card/", data).status_code, 400)
+
+        response = self.client.post("/api/payments/update-card/", data)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(modify_source.call_count, 2)
+
+        # other operations have their own circuit
+        with mock.patch("payments.views.stripe.Customer.delete_source", return_value={"id": "card_1"}):
+            self.assertTrue(get_gateway().delete_source("cus_1", "card_1"))
+
+
+class CardDetailsTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        self.card = StripeModel.objects.create(
+            user=self.user, email="buyer@gmail.com", customer_id="cus_1", name_on_card="buyer",
+            card_number="4242424242424242", exp_month="12", exp_year="2034", card_id="card_1",
+            address_city="Pune", address_country="India", address_state="MH", address_zip="411001",
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def details(self, customer_id="cus_1", card_id="card_1"):
+        return self.client.get("/api/payments/card-details/", HTTP_CUSTOMER_ID=customer_id, HTTP_CARD_ID=card_id)
+
+    @mock.patch("payments.views.stripe.Customer.retrieve_source")
+    def test_details_are_served_locally(self, retrieve_source):
+        response = self.details()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["last4"], "4242")
+        self.assertEqual(response.data["exp_year"], 2034)
+        self.assertEqual(response.data["address_city"], "Pune")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.details().status_code, 200)
+        retrieve_source.assert_not_called()
+
+    def test_other_users_cards_are_not_found(self):
+        self.assertEqual(self.details(customer_id="cus_2").status_code, 404)
+        other = User.objects.create_user(username="other", email="other@gmail.com", password="other1234")
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.details().status_code, 404)
+
+    @mock.patch("payments.views.stripe.Customer.modify_source", return_value={"id": "card_1"})
+    def test_update_refreshes_details(self, modify_source):
+        self.details()
+        response = self.client.post("/api/payments/update-card/", {
+            "customer_id": "cus_1", "card_id": "card_1", "exp_year": "2035", "address_city": "Mumbai",
+        })
+        self.assertEqual(response.status_code, 200)
+
+        response = self.details()
+        self.assertEqual(response.data["exp_year"], 2035)
+        self.assertEqual(response.data["address_city"], "Mumbai")
+
+    @mock.patch("payments.views.stripe.Customer.delete")
+    @mock.patch("payments.views.stripe.Customer.delete_source")
+    def test_delete_drops_details(self, delete_source, delete_customer):
+        self.details()
+        response = self.client.post("/api/payments/delete-card/", {"card_number": "4242424242424242"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.details().status_code, 404)
+
+
+@override_settings(PAYMENT_GATEWAY="payments.gateway.FakeGateway", PAYMENT_GATEWAY_OPTIONS={"seed": 46})
+class CardReconciliationTest(FreshGatewayMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        gateway = get_gateway()
+        self.alice = User.objects.create_user(username="alice", email="alice@gmail.com")
+        self.bob = User.objects.create_user(username="bob", email="bob@gmail.com")
+
+        alice_customer = gateway.create_customer("alice@gmail.com").id
+        StripeCustomer.objects.create(user=self.alice, customer_id=alice_customer)
+        gateway.attach_payment_method("pm_alice", alice_customer)
+
+        bob_customer = gateway.create_customer("bob@gmail.com").id
+        gateway.attach_payment_method("pm_bob", bob_customer)
+        self.stale = self.card(self.bob, bob_customer, "card_bob", "4000056655665556", exp_month="01")
+        self.gone = self.card(self.bob, bob_customer, "card_gone", "5555555555554444")
+        self.orphan = self.card(self.alice, "cus_deleted", "card_orphan", "6011111111111117")
+
+    def card(self, user, customer_id, card_id, number, exp_month="12"):
+        return StripeModel.objects.create(
+            user=user, email=user.email, customer_id=customer_id, name_on_card=user.username,
+            card_number=number, exp_month=exp_month, exp_year="2034", card_id=card_id,
+        )
+
+    def test_drift_is_repaired_over_resumed_runs(self):
+        out = StringIO()
+        call_command("reconcile_cards", "--max-customers", "1", stdout=out)
+        self.assertIn("paused", out.getvalue())
+        self.assertEqual(StripeModel.objects.get(id=self.stale.id).exp_month, "12")
+        self.assertFalse(StripeModel.objects.filter(id=self.gone.id).exists())
+        self.assertTrue(StripeModel.objects.filter(id=self.orphan.id).exists())
+
+        out = StringIO()
+        call_command("reconcile_cards", stdout=out)
+        self.assertIn("finished", out.getvalue())
+        run = CardReconciliation.objects.get()
+        self.assertEqual((run.customers, run.cards), (2, 2))
+        self.assertEqual((run.created, run.updated, run.deleted, run.skipped), (1, 1, 2, 0))
+        self.assertEqual(run.drift, 4)
+
+        added = StripeModel.objects.get(user=self.alice)
+        self.assertEqual((added.card_id, added.card_number[-4:]), ("card_alice", "4242"))
+        self.assertFalse(StripeModel.objects.filter(id=self.orphan.id).exists())
+
+        # nothing left to repair
+        call_command("reconcile_cards", stdout=StringIO())
+        self.assertEqual(CardReconciliation.objects.first().drift, 0)
+
+    def test_one_worker_per_pass(self):
+        run = CardReconciliation.objects.create(claimed_by="other", claimed_at=timezone.now())
+        self.assertIsNone(reconcile_cards())
+        self.assertEqual(CardReconciliation.objects.get().customers, 0)
+
+        # the other worker died
+        CardReconciliation.objects.filter(id=run.id).update(claimed_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(reconcile_cards().id, run.id)
+        run.refresh_from_db()
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual(run.claimed_by, "")
+
+    def test_unknown_customers_are_skipped(self):
+        get_gateway().attach_payment_method("pm_stranger", get_gateway().create_customer("x@gmail.com").id)
+        run = reconcile_cards()
+        self.assertEqual(run.skipped, 1)
+        self.assertEqual(StripeModel.objects.filter(card_id="card_stranger").count(), 0)
+
+
+@override_settings(PAYMENT_GATEWAY="payments.gateway.FakeGateway", PAYMENT_GATEWAY_OPTIONS={"latency": 0.05})
+class CreateCardTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        StripeCustomer.objects.create(user=self.user, customer_id=get_gateway().create_customer("buyer@gmail.com").id)
+        self.client.force_authenticate(user=self.user)
+
+    def create_card(self, payment_method="pm_card_visa"):
+        return self.client.post("/api/payments/create-card/", {
+            "email": "buyer@gmail.com", "payment_method_id": payment_method, "save_card": True,
+        })
+
+    def test_default_is_set_while_the_card_is_saved(self):
+        gateway = get_gateway().gateway
+        threads = []
+        set_default = gateway.set_default_payment_method
+
+        def record_thread(*args):
+            threads.append(current_thread().name)
+            return set_default(*args)
+
+        with mock.patch.object(gateway, "set_default_payment_method", side_effect=record_thread), \
+                mock.patch.object(gateway, "retrieve_payment_method") as retrieve:
+            response = self.create_card()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(threads[0].startswith("gateway-call"))
+        retrieve.assert_not_called()
+        card = StripeModel.objects.get(user=self.user)
+        self.assertEqual((card.card_id, card.card_number[-4:]), ("card_card_visa", "4242"))
+
+    def test_saved_card_is_rolled_back_if_the_default_fails(self):
+        gateway = get_gateway().gateway
+        with mock.patch.object(
+            gateway, "set_default_payment_method", side_effect=stripe.error.InvalidRequestError("No such customer", None)
+        ):
+            response = self.create_card()
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeModel.objects.exists())
+
+    def test_customer_deleted_by_another_worker_is_replaced(self):
+        stale_id = get_customer_id(self.user.id)
+        # another worker deleted the customer, this one still has it cached
+        get_gateway().delete_customer(stale_id)
+        StripeCustomer.objects.filter(user=self.user).delete()
+        cache.set(CACHE_KEY.format(self.user.id), stale_id)
+
+        response = self.create_card()
+        self.assertEqual(response.status_code, 200)
+        customer_id = StripeCustomer.objects.get(user=self.user).customer_id
+        self.assertNotEqual(customer_id, stale_id)
+        self.assertEqual(response.data["customer_id"], customer_id)
+        self.assertEqual(StripeModel.objects.get(user=self.user).customer_id, customer_id)
+
+    def test_customer_missing_on_stripe_is_forgotten(self):
+        stale_id = get_customer_id(self.user.id)
+        get_gateway().delete_customer(stale_id)
+
+        response = self.create_card()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.data["customer_id"], stale_id)
+        self.assertFalse(StripeCustomer.objects.filter(customer_id=stale_id).exists())
+
+
+@override_settings(PAYMENT_GATEWAY="payments.gateway.FakeGateway", PAYMENT_GATEWAY_OPTIONS={"seed": 48})
+class RefundOrdersTest(FreshGatewayMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.staff = User.objects.create_user(username="staff", password="staff1234", is_staff=True)
+        self.buyer = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        self.customer_id = get_gateway().create_customer("buyer@gmail.com").id
+        self.client.force_authenticate(user=self.staff)
+
+    def order(self, status, paid=True, payment_intent_id=None):
+        order = OrderModel.objects.create(user=self.buyer, name="buyer", total_price=Decimal("10.00"), status=status)
+        if paid:
+            payment_intent_id = payment_intent_id or get_gateway().create_payment_intent(
+                amount=1000, currency="inr", customer=self.customer_id, payment_method="pm_card_visa", confirm=True
+            ).id
+            Charge.objects.create(
+                order=order, user=self.buyer, customer_id=self.customer_id, payment_method="pm_card_visa",
+                amount=order.total_price, status=Charge.SUCCEEDED, payment_intent_id=payment_intent_id,
+            )
+        return order
+
+    def test_results_per_order(self):
+        paid, cancelled = self.order("paid"), self.order("cancelled")
+        pending, unpaid = self.order("pending", paid=False), self.order("cancelled", paid=False)
+        broken = self.order("paid", payment_intent_id="pi_unknown")
+        ids = [paid.id, cancelled.id, pending.id, unpaid.id, broken.id, 999]
+
+        response = self.client.post("/api/payments/refund-orders/", {"ids": ids}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["refunded"], 2)
+        results = [(result["id"], result["result"]) for result in response.data["results"]]
+        self.assertEqual(results, [
+            (paid.id, "refunded"), (cancelled.id, "refunded"), (pending.id, "invalid_status"),
+            (unpaid.id, "no_payment"), (broken.id, "failed"), (999, "not_found"),
+        ])
+
+        self.assertEqual(OrderModel.objects.filter(status="refunded").count(), 2)
+        charge = Charge.objects.get(order=paid)
+        self.assertEqual(charge.status, Charge.REFUNDED)
+        self.assertEqual(get_gateway().refunds[charge.refund_id].payment_intent, charge.payment_intent_id)
+        self.assertEqual(OrderModel.objects.get(id=broken.id).status, "paid")
+
+    def test_order_moved_during_the_refund(self):
+        order = self.order("paid")
+        bulk_update = Charge.objects.bulk_update
+
+        def reopen_then_update(*args, **kwargs):
+            # e.g. staff reset the order while its payment was being refunded
+            OrderModel.objects.filter(id=order.id).update(status="pending")
+            return bulk_update(*args, **kwargs)
+
+        with mock.patch.object(Charge.objects, "bulk_update", side_effect=reopen_then_update):
+            result = refund_orders([order.id])[0]
+        self.assertEqual(result["result"], "refunded_status_blocked")
+        self.assertEqual(result["from_status"], "pending")
+        self.assertEqual(OrderModel.objects.get(id=order.id).status, "pending")
+
+    def test_rerun_does_not_refund_twice(self):
+        order = self.order("paid")
+        first = refund_orders([order.id])[0]["refund_id"]
+
+        # the order update was lost, the batch is run again
+        OrderModel.objects.filter(id=order.id).update(status="paid")
+        Charge.objects.filter(order=order).update(status=Charge.SUCCEEDED)
+        out = StringIO()
+        call_command("refund_orders", str(order.id), stdout=out)
+
+        self.assertIn(f"{order.id}\trefunded\t{first}", out.getvalue())
+        self.assertEqual(len(get_gateway().refunds), 1)
+
+    def test_staff_only(self):
+        self.client.force_authenticate(user=self.buyer)
+        response = self.client.post("/api/payments/refund-orders/", {"ids": [1]}, format="json")
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(
+    PAYMENT_GATEWAY="payments.gateway.FakeGateway", PAYMENT_GATEWAY_OPTIONS={"seed": 49}, BACKGROUND_JOBS_EAGER=True
+)
+class CustomerProvisioningTest(FreshGatewayMixin, APITestCase):
+
+    def test_customer_created_at_registration(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/account/register/", {
+                "username": "buyer", "email": "buyer@gmail.com", "password": "buyer1234",
+            }, format="json")
+        self.assertEqual(response.status_code, 200)
+        user = User.objects.get(username="buyer")
+        customer_id = StripeCustomer.objects.get(user=user).customer_id
+        self.assertEqual(get_gateway().customers[customer_id].email, "buyer@gmail.com")
+
+        # the first card needs no customer lookup or creation
+        gateway = get_gateway().gateway
+        self.client.force_authenticate(user=user)
+        with mock.patch.object(gateway, "find_customer") as find, mock.patch.object(gateway, "create_customer") as create:
+            response = self.client.post("/api/payments/create-card/", {
+                "email": "buyer@gmail.com", "payment_method_id": "pm_card_visa",
+            })
+        self.assertEqual(response.data["customer_id"], customer_id)
+        find.assert_not_called()
+        create.assert_not_called()
+
+    def test_existing_users_are_provisioned_at_login(self):
+        user = User.objects.create_user(username="old", email="old@gmail.com", password="old12345")
+        existing = get_gateway().create_customer("old@gmail.com").id
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/account/login/", {"username": "old", "password": "old12345"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StripeCustomer.objects.get(user=user).customer_id, existing)
+
+    def test_gateway_errors_leave_it_to_checkout(self):
+        with self.settings(PAYMENT_GATEWAY_OPTIONS={"error_rates": {"connection_error": 1}}):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post("/api/account/register/", {
+                    "username": "buyer", "email": "buyer@gmail.com", "password": "buyer1234",
+                }, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(StripeCustomer.objects.exists())
+
+
+@override_settings(BACKGROUND_JOBS_EAGER=True)
+class ChargeRetryTest(FreshGatewayMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username="buyer", email="buyer@gmail.com", password="buyer1234")
+        StripeCustomer.objects.create(user=self.user, customer_id="cus_known")
+        self.product = Product.objects.create(name="Mouse", price=Decimal("10.00"))
+        self.client.force_authenticate(user=self.user)
+
+    def checkout(self, **headers):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post("/api/payments/charge-customer/", {
+                "email": "buyer@gmail.com",
+                "payment_method": "pm_card_visa",
+                "name": "buyer",
+                "address": "somewhere on earth",
+                "product_id": self.product.id,
+            }, **headers)
+
+    def run_scheduler(self):
+        out = StringIO()
+        call_command("process_pending_charges", stdout=out)
+        return out.getvalue()
+
+    @mock.patch("payments.charges.stripe.PaymentIntent.create")
+    def test_transient_error_is_retried(self, create_intent):
+        create_intent.side_effect = stripe.error.APIConnectionError("Connection reset")
+        response = self.checkout(HTTP_PREFER="respond-async")
+        self.assertEqual(response.status_code, 202)
+        order = OrderModel.objects.get(id=response.data["data"]["order_id"])
+        self.assertEqual(order.status, "pending")
+        charge = Charge.objects.get(order=order)
+        self.assertEqual((charge.status, charge.attempts), (Charge.QUEUED, 1))
+        self.assertGreater(charge.next_attempt_at, timezone.now())
+        first_call = create_intent.call_args.kwargs
+
+        # not due yet
+        create_intent.side_effect = None
+        create_intent.return_value = SimpleNamespace(id="pi_1")
+        self.run_scheduler()
+        self.assertEqual(create_intent.call_count, 1)
+
+        Charge.objects.filter(id=charge.id).update(next_attempt_at=timezone.now())
+        self.run_scheduler()
+        # the retry is the very same request, the gateway dedupes it
+        self.assertEqual(create_intent.call_args.kwargs, first_call)
+        self.assertTrue(OrderModel.objects.get(id=order.id).paid_status)
+        self.assertEqual(Charge.objects.get(id=charge.id).status, Charge.SUCCEEDED)
+
+    @mock.patch("payments.charges.stripe.PaymentIntent.create")
+    def test_synchronous_checkout_is_not_retried(self, create_intent):
+        # its client takes any 2xx for a paid order
+        create_intent.side_effect = stripe.error.APIConnectionError("Connection reset")
+        response = self.checkout()
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(OrderModel.objects.exists())
+
+    @override_settings(CHARGE_MAX_ATTEMPTS=2)
+    @mock.patch("payments.charges.stripe.PaymentIntent.create")
+    def test_order_cancelled_after_the_last_attempt(self, create_intent):
+        create_intent.side_effect = stripe.error.RateLimitError("Too many requests")
+        response = self.checkout(HTTP_PREFER="respond-async")
+        order_id = response.data["data"]["order_id"]
+        self.assertEqual(Charge.objects.get(order_id=order_id).status, Charge.QUEUED)
+
+        Charge.objects.filter(order_id=order_id).update(next_attempt_at=timezone.now())
+        self.run_scheduler()
+        self.assertEqual(Charge.objects.get(order_id=order_id).status, Charge.FAILED)
+        self.assertEqual(OrderModel.objects.get(id=order_id).status, "cancelled")
+
+    @override_settings(GATEWAY_BREAKER_FAILURES=1)
+    @mock.patch("payments.charges.stripe.PaymentIntent.create")
+    def test_scheduler_waits_for_the_circuit(self, create_intent):
+        create_intent.side_effect = stripe.error.APIConnectionError("Connection reset")
+        self.checkout(HTTP_PREFER="respond-async")
+
+        # the circuit is open now: the next checkout does not reach the
+        # gateway and is not retried before the circuit may close
+        order_id = self.checkout(HTTP_PREFER="respond-async").data["data"]["order_id"]
+        charge = Charge.objects.get(order_id=order_id)
+        self.assertEqual(charge.attempts, 0)
+        self.assertGreater(charge.next_attempt_at, timezone.now() + timedelta(seconds=25))
+
+        Charge.objects.filter(id=charge.id).update(next_attempt_at=timezone.now())
+        self.assertIn("Paused", self.run_scheduler())
+        self.assertEqual(create_intent.call_count, 1)
+        self.assertEqual(Charge.objects.get(id=charge.id).status, Charge.QUEUED)
+
+    def test_backoff_grows_with_jitter(self):
+        for attempts, backoff in ((1, 30), (2, 60), (4, 240), (20, 3600)):
+            delays = [retry_delay(attempts) for _ in range(20)]
+            self.assertTrue(all(backoff / 2 <= delay <= backoff for delay in delays))
+            self.assertGreater(len(set(delays)), 1)
@@ -6,8 +6,11 @@ urlpatterns = [
     path('test-payment/', views.TestStripeImplementation.as_view()),
     path('create-card/', views.CreateCardTokenView.as_view()),
     path('charge-customer/', views.ChargeCustomerView.as_view()),
+    path('charge-status/<int:order_id>/', views.ChargeStatusView.as_view()),
     path('update-card/', views.CardUpdateView.as_view()),    
     path('delete-card/', views.DeleteCardView.as_view()),    
     path('card-details/', views.RetrieveCardView.as_view()),
     path('check-token/', views.CheckTokenValidation.as_view()),
+    path('webhook/', views.StripeWebhookView.as_view()),
+    path('refund-orders/', views.RefundOrdersView.as_view()),
 ]
\ No newline at end of file
@@ -10,20 +10,47 @@ This module handles:
 
 import stripe
 import logging
+import uuid
 from datetime import datetime
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.utils import timezone
 from rest_framework import status, permissions
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
 from account.models import StripeModel, OrderModel
+from cart.models import Cart
+from cart.pricing import price_cart, price_lines
+from product.models import Product
+
+from .cards import card_id_of, get_card_details
+from .charges import payment_intent_params, queue_charge
+from .customers import (
+    find_customer_id, forget_customer, get_or_create_customer_id, is_missing_customer, replace_missing_customer,
+)
+from .gateway import get_gateway, submit_call
+from .models import Charge
+from .refunds import refund_orders
+from .resilience import ClientRateLimited, GatewayUnavailable
+from .webhooks import is_valid_event, receive_event
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-# Initialize Stripe with secret key
-stripe.api_key = getattr(settings, "STRIPE_TEST_SECRET_KEY", "")
+# Stripe's key and HTTP client are set up in PaymentsConfig.ready (see client.py)
+
+
+def gateway_unavailable_response(error):
+    """503 for a gateway call that was not made (open circuit, full bulkhead, rate limit)."""
+    logger.warning(f"Payment gateway unavailable: {str(error)}")
+    response = Response(
+        {"detail": "Payment service is temporarily unavailable. Please try again later."}, 
+        status=status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+    response["Retry-After"] = str(error.retry_after)
+    return response
 
 
 def save_card_in_db(card_data, email, card_id, customer_id, user):
@@ -57,6 +84,59 @@ def save_card_in_db(card_data, email, card_id, customer_id, user):
         raise
 
 
+def wants_async_checkout(request):
+    """Whether to charge the checkout in the background (RFC 7240 respond-async)."""
+    prefer = request.headers.get("Prefer", "")
+    return settings.CHECKOUT_ASYNC or "respond-async" in prefer.lower()
+
+
+def price_checkout(user, data):
+    """
+    Price a checkout on the server instead of trusting the client amount.
+
+    A single product checkout sends `product_id` (and optionally
+    `coupon_code`), otherwise the user's cart is priced with its coupon.
+
+    Returns:
+        Quote or None when there is nothing to charge
+    """
+    product_id = data.get("product_id")
+    if product_id:
+        product = Product.objects.get(id=product_id)
+        return price_lines([(product.id, product.price, 1)], data.get("coupon_code", ""))
+
+    cart = Cart.objects.filter(user=user).first()
+    if cart is None or not cart.items.exists():
+        return None
+    return price_cart(cart)
+
+
+def create_pending_order(user, data, amount):
+    """Store a checkout's order before it is paid."""
+    return OrderModel.objects.create(
+        name=data["name"],
+        card_number=data.get("card_number", ""),
+        address=data["address"],
+        ordered_item=data.get("ordered_item", "Not specified"),
+        total_price=amount,
+        user=user,
+        status='pending'
+    )
+
+
+def pending_checkout_response(order, customer_id, message):
+    """202 for a checkout whose payment completes later (poll ChargeStatusView)."""
+    return Response({
+        "data": {
+            "order_id": order.id,
+            "customer_id": customer_id,
+            "amount": order.total_price,
+            "status": order.status,
+            "message": message
+        }
+    }, status=status.HTTP_202_ACCEPTED)
+
+
 class TestStripeImplementation(APIView):
     """
     Test view for Stripe payment processing.
@@ -73,7 +153,7 @@ class TestStripeImplementation(APIView):
             Response with test payment intent data
         """
         try:
-            test_payment_process = stripe.PaymentIntent.create(
+            test_payment_process = get_gateway().create_payment_intent(
                 amount=120,
                 currency='inr',
                 payment_method_types=['card'],
@@ -152,40 +232,34 @@ class CreateCardTokenView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Get or create Stripe customer
-            customers = stripe.Customer.list(email=email).data
-            if customers:
-                customer = customers[0]
-                logger.info(f"Using existing customer: {customer['id']}")
-            else:
-                customer = stripe.Customer.create(
-                    email=email, 
-                    description=f"Customer for {request.user.username}"
-                )
-                logger.info(f"Created new customer: {customer['id']}")
+            # Get or create Stripe customer (stored locally, see customers.py)
+            customer = {"id": get_or_create_customer_id(request.user, email)}
 
-            # Attach payment method to customer
-            stripe.PaymentMethod.attach(
-                payment_method_id,
-                customer=customer["id"],
-            )
-            
-            # Set as default payment method
-            stripe.Customer.modify(
-                customer["id"],
-                invoice_settings={"default_payment_method": payment_method_id},
-            )
+            gateway = get_gateway()
 
+            # Attach payment method to customer, the card details come back
+            # with it so they need no separate retrieve
+            try:
+                payment_method = gateway.attach_payment_method(payment_method_id, customer["id"])
+            except stripe.error.InvalidRequestError as e:
+                if not is_missing_customer(e, customer["id"]):
+                    raise
+                # a cached id of a customer deleted meanwhile
+                customer = {"id": replace_missing_customer(request.user, email, customer["id"])}
+                payment_method = gateway.attach_payment_method(payment_method_id, customer["id"])
+
+            # Set as default payment method, saving the card meanwhile; no
+            # transaction is held open across the gateway call, the saved
+            # card is deleted again if this fails
+            set_default = submit_call(gateway.set_default_payment_method, customer["id"], payment_method_id)
+            saved_card = None
             # Optionally save card in database
             if save_card:
                 try:
-                    payment_method = stripe.PaymentMethod.retrieve(payment_method_id)
-                    card_data = payment_method.card
-                    
-                    save_card_in_db(
-                        card_data=card_data,
+                    saved_card = save_card_in_db(
+                        card_data=payment_method.card,
                         email=email,
-                        card_id=card_data.id,
+                        card_id=card_id_of(payment_method),
                         customer_id=customer["id"],
                         user=request.user
                     )
@@ -193,6 +267,12 @@ class CreateCardTokenView(APIView):
                 except Exception as e:
                     logger.error(f"Error saving card to database: {str(e)}")
                     # Don't fail the entire request if card saving fails
+            try:
+                set_default.result()
+            except Exception:
+                if saved_card is not None:
+                    saved_card.delete()
+                raise
 
             return Response({
                 "customer_id": customer["id"],
@@ -200,6 +280,8 @@ class CreateCardTokenView(APIView):
                 "message": "Card added successfully"
             }, status=status.HTTP_200_OK)
 
+        except (GatewayUnavailable, ClientRateLimited) as e:
+            return gateway_unavailable_response(e)
         except stripe.error.StripeError as e:
             logger.error(f"Stripe error in card creation: {str(e)}")
             return Response(
@@ -229,21 +311,25 @@ class ChargeCustomerView(APIView):
         Args:
             request: HTTP request containing:
                 - email: Customer email
-                - amount: Payment amount
                 - payment_method: Stripe payment method ID
                 - name: Customer name
                 - address: Delivery address
                 - ordered_item: Item description
-                - total_price: Order total
+                - product_id: Product for a single product checkout
+                  (the cart is charged otherwise)
+                - coupon_code: Coupon for a single product checkout
+              With a `Prefer: respond-async` header (or CHECKOUT_ASYNC set)
+              the order is stored as pending and charged in the background.
                 
         Returns:
-            Response with payment confirmation and order details
+            Response with payment confirmation and order details, or 202
+            with the pending order (poll ChargeStatusView for the outcome)
         """
         try:
             data = request.data
             
             # Validate required fields
-            required_fields = ["email", "amount", "payment_method", "name", "address", "total_price"]
+            required_fields = ["email", "payment_method", "name", "address"]
             for field in required_fields:
                 if not data.get(field):
                     return Response(
@@ -252,7 +338,21 @@ class ChargeCustomerView(APIView):
                     )
 
             email = data["email"]
-            amount = float(data["amount"])
+
+            # Price the order server side
+            try:
+                quote = price_checkout(request.user, data)
+            except Product.DoesNotExist:
+                return Response(
+                    {"detail": "Product not found"}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            if quote is None:
+                return Response(
+                    {"detail": "Nothing to charge, the cart is empty"}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            amount = quote.total
             
             # Validate amount
             if amount <= 0:
@@ -261,30 +361,49 @@ class ChargeCustomerView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Get customer from Stripe
-            customer_data = stripe.Customer.list(email=email).data
-            if not customer_data:
+            # Get the user's Stripe customer
+            customer_id = find_customer_id(request.user, email)
+            if customer_id is None:
                 return Response(
                     {"detail": "Customer not found"}, 
                     status=status.HTTP_404_NOT_FOUND
                 )
-            customer = customer_data[0]
+            customer = {"id": customer_id}
 
-            # Create PaymentIntent
-            payment_intent = stripe.PaymentIntent.create(
-                amount=int(amount * 100),  # Convert to cents
-                currency="inr",
-                customer=customer["id"],
-                payment_method=data["payment_method"],
-                off_session=True,
-                confirm=True,
-                description=f'Order for {data["name"]}',
-                metadata={
-                    'user_id': str(request.user.id),
-                    'order_item': data.get("ordered_item", "Not specified")
-                }
-            )
+            if wants_async_checkout(request):
+                # Store the order as pending and charge it in the background
+                with transaction.atomic():
+                    new_order = create_pending_order(request.user, data, amount)
+                    queue_charge(new_order, customer["id"], data["payment_method"], f'Order for {data["name"]}')
 
+                logger.info(f"Order {new_order.id} accepted for user {request.user.id}, charge queued")
+                return pending_checkout_response(new_order, customer["id"], "Payment is being processed")
+
+            # Create PaymentIntent; a transient error is answered as such, only
+            # clients that accept a 202 (respond-async) get charges retried
+            try:
+                payment_intent = get_gateway().create_payment_intent(
+                    idempotency_key=f"checkout-{uuid.uuid4().hex}",
+                    **payment_intent_params(
+                        amount,
+                        customer["id"],
+                        data["payment_method"],
+                        f'Order for {data["name"]}',
+                        {
+                            'user_id': str(request.user.id),
+                            'order_item': data.get("ordered_item", "Not specified")
+                        },
+                    )
+                )
+            except stripe.error.InvalidRequestError as e:
+                if not is_missing_customer(e, customer["id"]):
+                    raise
+                # a cached id of a customer deleted meanwhile, with its cards
+                replace_missing_customer(request.user, None, customer["id"])
+                return Response(
+                    {"detail": "Customer not found"}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
             # Create order in database
             new_order = OrderModel.objects.create(
                 name=data["name"],
@@ -299,6 +418,18 @@ class ChargeCustomerView(APIView):
                 user=request.user,
                 status='paid'
             )
+            # lets webhooks about this payment (refunds, disputes) find the order
+            Charge.objects.create(
+                order=new_order,
+                user=request.user,
+                customer_id=customer["id"],
+                payment_method=data["payment_method"],
+                amount=amount,
+                description=f'Order for {data["name"]}',
+                status=Charge.SUCCEEDED,
+                payment_intent_id=payment_intent.id,
+                attempts=1,
+            )
 
             logger.info(f"Order {new_order.id} created successfully for user {request.user.id}")
 
@@ -312,6 +443,8 @@ class ChargeCustomerView(APIView):
                 }
             }, status=status.HTTP_200_OK)
 
+        except (GatewayUnavailable, ClientRateLimited) as e:
+            return gateway_unavailable_response(e)
         except stripe.error.CardError as e:
             logger.error(f"Card error: {str(e)}")
             return Response(
@@ -352,16 +485,17 @@ class ChargeCustomerView(APIView):
 
 class RetrieveCardView(APIView):
     """
-    API view to retrieve card details from Stripe.
+    API view to retrieve details of a saved card.
     
-    Fetches card information using customer ID and card ID from headers.
+    Served from the card stored in the database (see cards.py), Stripe is
+    not called.
     """
     
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
         """
-        Retrieve card details from Stripe.
+        Retrieve card details.
         
         Args:
             request: HTTP request with Customer-Id and Card-Id headers
@@ -379,15 +513,14 @@ class RetrieveCardView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            card_details = stripe.Customer.retrieve_source(customer_id, card_id)
+            card_details = get_card_details(request.user.id, customer_id, card_id)
+            if card_details is None:
+                return Response(
+                    {"detail": "Card not found"}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
             return Response(card_details, status=status.HTTP_200_OK)
             
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe error retrieving card: {str(e)}")
-            return Response(
-                {"detail": f"Error retrieving card: {str(e)}"}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
         except Exception as e:
             logger.error(f"Unexpected error retrieving card: {str(e)}")
             return Response(
@@ -443,7 +576,7 @@ class CardUpdateView(APIView):
                 update_params["address_zip"] = data["address_zip"]
 
             if update_params:
-                updated_card = stripe.Customer.modify_source(
+                updated_card = get_gateway().modify_source(
                     data["customer_id"],
                     data["card_id"],
                     **update_params
@@ -454,41 +587,46 @@ class CardUpdateView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Update card in database
+            # Update card in database (card details are served from it)
             if data.get("card_number"):
-                try:
-                    db_card = StripeModel.objects.get(
-                        card_number=data["card_number"],
-                        user=request.user
-                    )
-                    
-                    # Update fields if provided
-                    if data.get("name_on_card"):
-                        db_card.name_on_card = data["name_on_card"]
-                    if data.get("exp_month"):
-                        db_card.exp_month = data["exp_month"]
-                    if data.get("exp_year"):
-                        db_card.exp_year = data["exp_year"]
-                    if data.get("address_city"):
-                        db_card.address_city = data["address_city"]
-                    if data.get("address_country"):
-                        db_card.address_country = data["address_country"]
-                    if data.get("address_state"):
-                        db_card.address_state = data["address_state"]
-                    if data.get("address_zip"):
-                        db_card.address_zip = data["address_zip"]
-                    
-                    db_card.save()
-                    logger.info(f"Card updated in database for user {request.user.id}")
-                    
-                except StripeModel.DoesNotExist:
-                    logger.warning(f"Card not found in database for user {request.user.id}")
+                lookup = {"card_number": data["card_number"]}
+            else:
+                lookup = {"card_id": data["card_id"], "customer_id": data["customer_id"]}
+            try:
+                db_card = StripeModel.objects.get(
+                    user=request.user,
+                    **lookup
+                )
+                
+                # Update fields if provided
+                if data.get("name_on_card"):
+                    db_card.name_on_card = data["name_on_card"]
+                if data.get("exp_month"):
+                    db_card.exp_month = data["exp_month"]
+                if data.get("exp_year"):
+                    db_card.exp_year = data["exp_year"]
+                if data.get("address_city"):
+                    db_card.address_city = data["address_city"]
+                if data.get("address_country"):
+                    db_card.address_country = data["address_country"]
+                if data.get("address_state"):
+                    db_card.address_state = data["address_state"]
+                if data.get("address_zip"):
+                    db_card.address_zip = data["address_zip"]
+                
+                db_card.save()
+                logger.info(f"Card updated in database for user {request.user.id}")
+                
+            except StripeModel.DoesNotExist:
+                logger.warning(f"Card not found in database for user {request.user.id}")
 
             return Response({
                 "detail": "Card updated successfully",
                 "data": {"updated_card": updated_card}
             }, status=status.HTTP_200_OK)
 
+        except (GatewayUnavailable, ClientRateLimited) as e:
+            return gateway_unavailable_response(e)
         except stripe.error.StripeError as e:
             logger.error(f"Stripe error updating card: {str(e)}")
             return Response(
@@ -549,7 +687,7 @@ class DeleteCardView(APIView):
 
             # Delete card from Stripe
             try:
-                stripe.Customer.delete_source(customer_id, card_id)
+                get_gateway().delete_source(customer_id, card_id)
                 logger.info(f"Card deleted from Stripe: {card_id}")
             except stripe.error.StripeError as e:
                 logger.error(f"Error deleting card from Stripe: {str(e)}")
@@ -561,7 +699,8 @@ class DeleteCardView(APIView):
 
             # Delete customer from Stripe (optional - for cleanup)
             try:
-                stripe.Customer.delete(customer_id)
+                get_gateway().delete_customer(customer_id)
+                forget_customer(customer_id)
                 logger.info(f"Customer deleted from Stripe: {customer_id}")
             except stripe.error.StripeError as e:
                 logger.warning(f"Could not delete customer from Stripe: {str(e)}")
@@ -577,4 +716,111 @@ class DeleteCardView(APIView):
             return Response(
                 {"detail": "An unexpected error occurred"}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
\ No newline at end of file
+            )
+
+class ChargeStatusView(APIView):
+    """
+    API view to poll the outcome of an async checkout.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, order_id):
+        """
+        Get the payment state of one of the user's orders.
+
+        Returns:
+            Response with the order status and, for orders charged in the
+            background, the charge status, error and next retry
+        """
+        try:
+            order = OrderModel.objects.get(id=order_id, user=request.user)
+        except OrderModel.DoesNotExist:
+            return Response(
+                {"detail": "Order not found"}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        charge = Charge.objects.filter(order=order).only(
+            "status", "error", "payment_intent_id", "next_attempt_at"
+        ).first()
+        return Response({
+            "order_id": order.id,
+            "status": order.status,
+            "paid_status": order.paid_status,
+            "charge_status": charge.status if charge else None,
+            "payment_intent_id": charge.payment_intent_id if charge else None,
+            "error": charge.error if charge else "",
+            "next_attempt_at": charge.next_attempt_at if charge else None,
+        }, status=status.HTTP_200_OK)
+
+
+class StripeWebhookView(APIView):
+    """
+    Webhook endpoint for gateway events (payments, refunds, disputes).
+
+    Only verifies and stores the event; it is applied to the orders in the
+    background (see webhooks.py).
+    """
+
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request):
+        try:
+            event = get_gateway().parse_webhook(request.body, request.headers.get("Stripe-Signature", ""))
+        except ImproperlyConfigured as e:
+            logger.error(f"Refused webhook: {str(e)}")
+            return Response(
+                {"detail": "Webhooks are not configured"}, 
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            logger.warning(f"Rejected webhook: {str(e)}")
+            return Response(
+                {"detail": "Invalid webhook payload or signature"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not is_valid_event(event):
+            logger.warning("Rejected webhook: not an event")
+            return Response(
+                {"detail": "Invalid webhook payload or signature"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        receive_event(event)
+        return Response({"received": True}, status=status.HTTP_200_OK)
+
+
+class RefundOrdersView(APIView):
+    """
+    Refund many orders at once (staff only).
+
+    Takes {"ids": [...]} (up to REFUND_MAX_ORDERS order ids) and returns a
+    result per order; see refunds.py. Larger batches go through
+    `manage.py refund_orders`.
+    """
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def post(self, request):
+        ids = request.data.get("ids")
+        if not isinstance(ids, list) or not ids or not all(str(order_id).isdigit() for order_id in ids):
+            return Response(
+                {"detail": "ids must be a list of order ids"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(ids) > settings.REFUND_MAX_ORDERS:
+            return Response(
+                {"detail": f"At most {settings.REFUND_MAX_ORDERS} orders can be refunded per request"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        results = refund_orders([int(order_id) for order_id in ids])
+        logger.info(f"User {request.user.id} refunded orders {ids}")
+
+        return Response({
+            "refunded": sum(1 for result in results if result["result"] == "refunded"),
+            "results": results,
+        }, status=status.HTTP_200_OK)
@@ -0,0 +1,182 @@
+"""
+Gateway webhook ingestion.
+
+The webhook view only verifies the signature and appends the event to
+WebhookEvent (a duplicate delivery hits the unique event id and is
+dropped), then answers 200. Applying the events happens on the background
+job pool: `process_pending_events` claims unprocessed events in batches of
+WEBHOOK_BATCH_SIZE and turns a whole batch into a handful of bulk order
+updates, so a burst of webhooks costs a few queries instead of tying up
+web workers.
+
+At most one processing job is queued per process at a time; events that
+arrive while it runs are picked up by its next batch. Events claimed by a
+worker that died are picked up again after WEBHOOK_CLAIM_TIMEOUT seconds,
+and `manage.py process_webhook_events` drains the queue by hand (or from
+cron).
+"""
+
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from account.models import OrderModel
+from my_project.background import run_in_background
+
+from .models import Charge, WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+SCHEDULED_KEY = "payments:webhooks:scheduled"
+
+# events that keep failing are left for a human after this many attempts
+MAX_ATTEMPTS = 5
+
+# order status each event type moves an order to
+EVENT_ORDER_STATUSES = {
+    "payment_intent.succeeded": "paid",
+    "payment_intent.payment_failed": "cancelled",
+    "charge.dispute.created": "disputed",
+    "charge.refunded": "refunded",
+}
+
+# applied in lifecycle order, so an order paid and refunded within one batch
+# ends up refunded
+STATUS_ORDER = ("paid", "cancelled", "disputed", "refunded")
+
+
+def is_valid_event(event):
+    """Whether a decoded webhook payload looks like an event we can store."""
+    return (
+        isinstance(event, dict)
+        and isinstance(event.get("id"), str) and event["id"]
+        and isinstance(event.get("type"), str) and event["type"]
+    )
+
+
+def receive_event(event):
+    """Store a verified webhook event and make sure a worker will apply it."""
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(event_id=event["id"], type=event["type"], payload=event.to_dict_recursive())],
+        ignore_conflicts=True,
+    )
+    schedule_processing()
+
+
+def schedule_processing():
+    if cache.add(SCHEDULED_KEY, 1, settings.WEBHOOK_CLAIM_TIMEOUT):
+        run_in_background(process_pending_events)
+
+
+def pending_events():
+    stale = timezone.now() - timedelta(seconds=settings.WEBHOOK_CLAIM_TIMEOUT)
+    return WebhookEvent.objects.filter(processed_at__isnull=True, attempts__lt=MAX_ATTEMPTS).filter(
+        Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale)
+    )
+
+
+def claim_batch(batch_size):
+    """Claim up to `batch_size` unprocessed events, oldest first."""
+    token = uuid.uuid4().hex
+    ids = list(pending_events().order_by("received_at").values_list("id", flat=True)[:batch_size])
+    if not ids:
+        return []
+    # a concurrent worker may have claimed some of them in the meantime
+    pending_events().filter(id__in=ids).update(
+        claimed_by=token, claimed_at=timezone.now(), attempts=F("attempts") + 1
+    )
+    return list(WebhookEvent.objects.filter(claimed_by=token, processed_at__isnull=True).order_by("received_at"))
+
+
+def event_target(event):
+    """
+    (payment intent id, order id from the metadata, new order status, problem)
+    of an event. `problem` says why an event that should move an order cannot.
+    """
+    status = EVENT_ORDER_STATUSES.get(event.type)
+    if status is None:
+        return None, None, None, None
+
+    data = event.payload.get("data") if isinstance(event.payload, dict) else None
+    obj = data.get("object") if isinstance(data, dict) else None
+    if not isinstance(obj, dict):
+        return None, None, None, "Event has no data object"
+    if event.type == "charge.refunded" and not obj.get("refunded"):
+        # partially refunded, the order stands
+        return None, None, None, None
+
+    payment_intent_id = obj.get("id") if event.type.startswith("payment_intent.") else obj.get("payment_intent")
+    if not isinstance(payment_intent_id, str):
+        payment_intent_id = None
+
+    metadata = obj.get("metadata")
+    order_id = metadata.get("order_id") if isinstance(metadata, dict) else None
+    if order_id is not None and not str(order_id).isdigit():
+        # e.g. set by another integration
+        return payment_intent_id, None, status, f"metadata.order_id {order_id!r} is not an order id"
+    return payment_intent_id, order_id and int(order_id), status, None
+
+
+def apply_events(events):
+    """Apply a batch of events with one bulk update per resulting order status."""
+    targets = [event_target(event) for event in events]
+    intent_ids = {target[0] for target in targets if target[0]}
+    order_by_intent = dict(
+        Charge.objects.filter(payment_intent_id__in=intent_ids).values_list("payment_intent_id", "order_id")
+    )
+
+    orders = {status: set() for status in STATUS_ORDER}
+    failed_intents = set()
+    # events left unapplied, by the reason why
+    skipped = {}
+    for event, (payment_intent_id, order_id, status, problem) in zip(events, targets):
+        order_id = order_by_intent.get(payment_intent_id) or order_id
+        if status is None or not order_id:
+            if problem:
+                logger.warning(f"Skipped webhook event {event.event_id}: {problem}")
+                skipped.setdefault(problem, []).append(event.id)
+            continue
+        orders[status].add(order_id)
+        if status == "cancelled" and payment_intent_id:
+            failed_intents.add(payment_intent_id)
+
+    with transaction.atomic():
+        for status in STATUS_ORDER:
+            if orders[status]:
+                OrderModel.objects.filter(id__in=orders[status]).transition(status, OrderModel.PAYMENT_TRANSITIONS)
+        if failed_intents:
+            Charge.objects.filter(payment_intent_id__in=failed_intents).exclude(status=Charge.FAILED).update(
+                status=Charge.FAILED, error="Payment failed (webhook)", updated_at=timezone.now()
+            )
+        now = timezone.now()
+        WebhookEvent.objects.filter(id__in=[event.id for event in events]).update(processed_at=now, error="")
+        for problem, event_ids in skipped.items():
+            WebhookEvent.objects.filter(id__in=event_ids).update(error=f"Skipped: {problem}")
+
+
+def process_pending_events(batch_size=None):
+    """Apply every pending event, batch by batch. Returns the number applied."""
+    batch_size = batch_size or settings.WEBHOOK_BATCH_SIZE
+    # from here on new events need a new job
+    cache.delete(SCHEDULED_KEY)
+
+    applied = 0
+    while True:
+        events = claim_batch(batch_size)
+        if not events:
+            return applied
+        try:
+            apply_events(events)
+        except Exception as e:
+            logger.exception("Could not apply webhook events")
+            WebhookEvent.objects.filter(id__in=[event.id for event in events]).update(
+                claimed_by="", claimed_at=None, error=str(e)
+            )
+            return applied
+        applied += len(events)
@@ -1,7 +1,9 @@
 from django.db import models
 
+from my_project.mixins import DirtyFieldsMixin
 
-class Product(models.Model):
+
+class Product(DirtyFieldsMixin, models.Model):
     name = models.CharField(max_length=200, blank=False, null=False)
     description = models.TextField(blank=True)
     price = models.DecimalField(max_digits=8, decimal_places=2)
@@ -9,4 +11,4 @@ class Product(models.Model):
     image = models.ImageField(null=True, blank=True)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
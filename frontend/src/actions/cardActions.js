@@ -69,7 +69,9 @@ export const createCard = (cardData) => async (dispatch, getState) => {
 
 
 // charge customer
-export const chargeCustomer = (cardData) => async (dispatch, getState) => {
+// pass the same idempotencyKey when retrying a checkout, the server then
+// replays the first response instead of charging again
+export const chargeCustomer = (cardData, idempotencyKey) => async (dispatch, getState) => {
 
     try {
 
@@ -84,7 +86,8 @@ export const chargeCustomer = (cardData) => async (dispatch, getState) => {
         const config = {
             headers: {
                 "Content-Type": "application/json",
-                Authorization: `Bearer ${userInfo.token}`
+                Authorization: `Bearer ${userInfo.token}`,
+                ...(idempotencyKey ? { "Idempotency-Key": idempotencyKey } : {})
             }
         }
 
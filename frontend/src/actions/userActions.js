@@ -90,7 +90,20 @@ export const login = (username, password) => async (dispatch) => {
 }
 
 // Logout
-export const logout = () => (dispatch) => {
+export const logout = () => (dispatch, getState) => {
+    const {
+        userLoginReducer: { userInfo },
+    } = getState()
+
+    // revoke the token on the server too (best effort, token may already be expired)
+    if (userInfo && userInfo.token) {
+        axios.post(
+            "/api/account/logout/",
+            { refresh: userInfo.refresh },
+            { headers: { Authorization: `Bearer ${userInfo.token}` } }
+        ).catch(() => {})
+    }
+
     localStorage.removeItem('userInfo')
     dispatch({
         type: USER_LOGOUT
@@ -490,7 +503,7 @@ export const deleteUserAddress = (id) => async (dispatch, getState) => {
 }
 
 // get all orders
-export const getAllOrders = () => async (dispatch, getState) => {
+export const getAllOrders = (searchTerm = "") => async (dispatch, getState) => {
     try {
         dispatch({
             type: GET_ALL_ORDERS_REQUEST
@@ -509,7 +522,7 @@ export const getAllOrders = () => async (dispatch, getState) => {
 
         // call api
         const { data } = await axios.get(
-            `/api/account/all-orders-list/`,
+            `/api/account/all-orders-list/?search=${encodeURIComponent(searchTerm)}`,
             config
         )
 
@@ -1,4 +1,4 @@
-import React, { useEffect } from 'react'
+import React, { useEffect, useRef } from 'react'
 import { useDispatch, useSelector } from 'react-redux'
 import { useSelector as useReduxSelector } from 'react-redux'
 import { Spinner, Form, Button, Card } from 'react-bootstrap'
@@ -8,6 +8,8 @@ import { getSingleAddress } from '../actions/userActions'
 import Message from './Message'
 
 
+const newIdempotencyKey = () => `checkout-${Date.now()}-${Math.random().toString(36).slice(2)}`
+
 const ChargeCardComponent = ({ product, cartItems, totalPrice, selectedAddressId, addressSelected }) => {
 
     let history = useHistory()
@@ -38,6 +40,16 @@ const ChargeCardComponent = ({ product, cartItems, totalPrice, selectedAddressId
         dispatch(getSingleAddress(selectedAddressId))
     }, [dispatch, selectedAddressId])
 
+    // one key per checkout attempt, so a double submit charges only once
+    const idempotencyKey = useRef(newIdempotencyKey())
+
+    useEffect(() => {
+        // a failed attempt is over, the next submit is a new checkout
+        if (chargeError) {
+            idempotencyKey.current = newIdempotencyKey()
+        }
+    }, [chargeError])
+
     // charge card handler
     const onSubmit = (e) => {
         e.preventDefault()
@@ -60,6 +72,7 @@ const ChargeCardComponent = ({ product, cartItems, totalPrice, selectedAddressId
             "email": (cardData && cardData.email) ? cardData.email : (userInfo ? userInfo.email : ""),
             "payment_method": paymentMethodId,
             "amount": amountToCharge,
+            "product_id": isSingleProductCheckout ? product.id : undefined,
             "name": address.name,
             "card_number": cardData && cardData.card_data ? cardData.card_data.last4 : "",
             "address": address_detail,
@@ -69,7 +82,7 @@ const ChargeCardComponent = ({ product, cartItems, totalPrice, selectedAddressId
             "is_delivered": false,
             "delivered_at": "Not Delivered",
         };
-        dispatch(chargeCustomer(data));
+        dispatch(chargeCustomer(data, idempotencyKey.current));
     };
 
     if (chargeSuccessfull) {
@@ -68,11 +68,13 @@ function OrdersListPage() {
         dispatch({
             type: CHANGE_DELIVERY_STATUS_RESET
         })
-        dispatch(getAllOrders())
+        dispatch(getAllOrders(cloneSearchTerm))
     }
 
+    // searching is done by the server
     const handleSearchTerm = (term) => {
         setCloneSearchTerm(term)
+        dispatch(getAllOrders(term))
     };
 
 
@@ -105,18 +107,7 @@ function OrdersListPage() {
                         </tr>
                     </thead>
 
-                    {/* filter orders by name, address or ordered item */}
-
-                    {orders.filter((item) => (
-
-                        item.name.toLowerCase().includes(cloneSearchTerm)
-                        ||
-                        item.ordered_item.toLowerCase().includes(cloneSearchTerm)
-                        ||
-                        item.address.toLowerCase().includes(cloneSearchTerm)
-                    )
-
-                    ).map((order, idx) => (
+                    {orders.map((order, idx) => (
                         <tbody key={idx}>
                             <tr className="text-center">
                                 <td>